@@ -95,8 +95,10 @@ def coco_anns_categories(coco_images, ann_folder):
                 ymax = max([y1,y2,y3,y4])
                 h = ymax-ymin
                 bbox = [xmin, ymin, w, h]
-                # calculate area of annotation box
-                area = float(w*h)
+                # area of the oriented polygon (shoelace), as fair1m
+                xs = [x1, x2, x3, x4]
+                ys = [y1, y2, y3, y4]
+                area = abs(sum(xs[k]*ys[k-1] - xs[k-1]*ys[k] for k in range(4)))/2
 
                 # process category
                 ann_cat_id, cat_id, coco_categories = get_make_coco_cat(c, cat_id, coco_categories)
@@ -106,6 +108,7 @@ def coco_anns_categories(coco_images, ann_folder):
                             "category_id": ann_cat_id,  
                             "area": area, 
                             "bbox": bbox, 
+                            "segmentation": [coords],
                             "difficult": int(difficult)
                             }
                 coco_anns.append(coco_ann)
@@ -141,13 +141,17 @@ def fair1m_coco_ims_cats_anns(xml_fp):
                 y1 = min(ys)
                 w = max(xs) - x1
                 h = max(ys) - y1
+
+                # keep the oriented polygon, coco style, with its shoelace area
+                polygon = [v for pt in pts for v in pt]
+                area = abs(sum(xs[k]*ys[k-1] - xs[k-1]*ys[k] for k in range(len(pts))))/2
                 
                 ann = {
                       "id": ann_count, 
                       "image_id": im_id, 
                       "category_id": ann_cat_id, 
-                      "area": None, 
-                      "segmentation": pts,
+                      "area": area, 
+                      "segmentation": [polygon],
                       "bbox": [x1, y1, w, h],
                       "iscrowd": 0
                       }
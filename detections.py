@@ -0,0 +1,322 @@
+import heapq
+import json
+import os
+import sys
+import numpy as np
+from tqdm import tqdm
+
+cwd = os.getcwd() + '/hot_coco'
+if os.path.exists(cwd):
+    sys.path.append(cwd)
+
+import stream as stream
+import evaluation as evaluation
+
+# Fields kept by default in a filtered detections file
+DT_KEYS = ('image_id', 'category_id', 'bbox', 'score')
+
+'''########################### Helper Functions ########################### '''
+
+def compact(dt, keys = DT_KEYS, decimals = None):
+    '''
+    IN:
+        - dt: one coco detection
+        - keys: fields to keep
+        - decimals: optional number of decimals bbox and score are rounded to
+    OUT:
+        - the detection with only the kept fields
+    '''
+    dt = {k: dt[k] for k in keys if k in dt}
+    if decimals is not None:
+        if 'bbox' in dt:
+            dt['bbox'] = [round(v, decimals) for v in dt['bbox']]
+        if 'score' in dt:
+            dt['score'] = round(dt['score'], decimals)
+    return dt
+
+def iter_filtered(dt_path, top_k = None, score_thresh = None, by_category = False, cat_ids = None,
+                  keys = DT_KEYS, decimals = None):
+    '''
+    PURPOSE: Stream a detections file, yielding every detection at or above score_thresh as soon as it is
+    read, then the rest of each image's top_k once the whole file has been seen
+    IN:
+        - dt_path: coco dt file
+        - top_k: optional int, detections kept per image (per image and category if by_category)
+        - score_thresh: optional minimum score, detections at or above it are always kept
+        - by_category: if True, top_k applies per image and category
+        - cat_ids: optional collection of category ids, others are dropped
+        - keys, decimals: see compact
+    OUT:
+        - generator over the kept detections, reduced to keys
+    '''
+    if top_k is None and score_thresh is None:
+        raise ValueError('Set top_k, score_thresh or both')
+    if cat_ids is not None:
+        cat_ids = set(cat_ids)
+
+    # Memory grows with the number of images times top_k, never with the size of the file
+    heaps = {}
+    seq = 0
+    for dt in tqdm(stream.iter_array(dt_path), desc = 'Filtering'):
+        if cat_ids is not None and dt['category_id'] not in cat_ids:
+            continue
+        above = score_thresh is not None and dt['score'] >= score_thresh
+        if above:
+            yield compact(dt, keys, decimals)
+
+        if top_k:
+            key = (dt['image_id'], dt['category_id']) if by_category else dt['image_id']
+            heap = heaps.setdefault(key, [])
+            # seq breaks score ties in file order and keeps dicts from being compared
+            entry = (dt['score'], -seq, above, compact(dt, keys, decimals))
+            if len(heap) < top_k:
+                heapq.heappush(heap, entry)
+            elif entry[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, entry)
+            seq += 1
+
+    # Top-k detections that were not already written for being above the threshold
+    for heap in heaps.values():
+        for score, _, above, dt in sorted(heap, reverse = True):
+            if not above:
+                yield dt
+
+'''############################## Filtering ############################## '''
+
+def filter_dt(dt_path, out_path, top_k = None, score_thresh = None, by_category = False, cat_ids = None,
+              keys = DT_KEYS, decimals = None):
+    '''
+    PURPOSE: Reduce a very large detections file in constant memory, keeping each image's top_k detections
+    and every detection at or above score_thresh
+    IN:
+        - dt_path: coco dt file
+        - out_path: output path, '.npz' writes the indexed binary form (see write_binary), anything
+                    else a compact coco dt json
+        - top_k, score_thresh, by_category, cat_ids: see iter_filtered
+        - keys, decimals: fields kept and rounding in the json output
+    OUT:
+        - n: int number of detections written
+    '''
+    kept = iter_filtered(dt_path, top_k, score_thresh, by_category, cat_ids, keys, decimals)
+    if out_path.endswith('.npz'):
+        n = write_binary(kept, out_path)
+    else:
+        n = stream.write_array(out_path, kept)
+    print(f'Kept {n} detections in {out_path}')
+    return n
+
+def write_binary(dts, out_path):
+    '''
+    PURPOSE: Save detections as columns sorted by image and descending score, with an offset index per image
+    IN:
+        - dts: iterable of coco detections
+        - out_path: path of the .npz file
+    OUT:
+        - n: int number of detections written
+    '''
+    im_ids, cat_ids, scores, bboxes = [], [], [], []
+    for dt in dts:
+        im_ids.append(dt['image_id'])
+        cat_ids.append(dt['category_id'])
+        scores.append(dt['score'])
+        bboxes.append(dt['bbox'][:4])
+    im_ids = np.array(im_ids)
+    scores = np.array(scores, dtype = float)
+
+    order = np.lexsort((-scores, im_ids))
+    index_ids, starts = np.unique(im_ids[order], return_index = True)
+    np.savez(out_path,
+             index_ids = index_ids,
+             index_starts = np.r_[starts, len(order)].astype(np.int64),
+             category_id = np.array(cat_ids, dtype = np.int64)[order],
+             score = scores[order],
+             bbox = np.array(bboxes, dtype = np.float32).reshape(-1, 4)[order])
+    return len(order)
+
+def read_binary(npz_path):
+    '''
+    IN:
+        - npz_path: file from write_binary
+    OUT:
+        - dt_index: the same per-image index as display.index_dt, with each image's arrays sliced from
+                    the shared columns
+    '''
+    with np.load(npz_path) as data:
+        ids = data['index_ids']
+        starts = data['index_starts']
+        cat_ids = data['category_id']
+        scores = data['score']
+        bboxes = data['bbox'].astype(float)
+
+    dt_index = {}
+    for i, im_id in enumerate(ids):
+        s, e = starts[i], starts[i + 1]
+        dt_index[im_id.item()] = {'bbox': bboxes[s:e], 'category_id': cat_ids[s:e], 'score': scores[s:e]}
+    return dt_index
+
+'''############################## Stitching ############################## '''
+
+def parse_chip_name(file_name):
+    '''
+    IN:
+        - file_name: name of a chip written by mods/images.chip, '{chip}_{im_id}_{row}_{col}_{h}_{w}.png'
+    OUT:
+        - parent_id: id of the image the chip was cut from
+        - x, y: the chip's top left corner in that image
+    '''
+    parts = os.path.splitext(os.path.basename(file_name))[0].split('_')
+    parent = '_'.join(parts[1:-4])
+    parent_id = int(parent) if parent.lstrip('-').isdigit() else parent
+    # chip names store the row offset first and the column offset second
+    y, x = float(parts[-4]), float(parts[-3])
+    return parent_id, x, y
+
+def chip_parent(chip_info):
+    '''
+    IN:
+        - chip_info: 'images' record of a chip
+    OUT:
+        - (parent_id, x, y, scale_x, scale_y): the image the chip was cut from, the chip's top left
+          corner in it and the scale from its pixels to the chip's, from the lineage fields
+          mods/images.chip writes ('parent_id', 'offset_x', 'offset_y', 'parent_scale',
+          'parent_scale_y'), or parsed from the file name for chips made before them
+    '''
+    if 'parent_id' in chip_info:
+        scale = chip_info.get('parent_scale', 1)
+        return chip_info['parent_id'], chip_info['offset_x'], chip_info['offset_y'], scale, chip_info.get('parent_scale_y', scale)
+    return parse_chip_name(chip_info['file_name']) + (1, 1)
+
+def chip_offsets(chip_gt):
+    '''
+    IN:
+        - chip_gt: coco gt of the chips (or loaded contents)
+    OUT:
+        - offsets: dict of chip image id to (parent_id, x, y, scale_x, scale_y), see chip_parent
+    '''
+    if isinstance(chip_gt, (str, os.PathLike)):
+        with open(chip_gt, 'r') as f:
+            chip_gt = json.load(f)
+
+    return {i['id']: chip_parent(i) for i in chip_gt['images']}
+
+def nms_clusters(p, q, n):
+    '''
+    PURPOSE: Greedy non-maximum suppression from the overlapping pairs alone, in rounds: a box whose
+    higher scoring neighbours are all decided is kept if none of them was kept, and otherwise joins the
+    highest scoring kept one, exactly as walking the boxes one at a time would
+    IN:
+        - p, q: int arrays, positions in score order (p < q) of each pair overlapping enough to merge
+        - n: int number of boxes
+    OUT:
+        - cluster: int array (n,), position of the kept box each box is merged into (itself if kept)
+    '''
+    cluster = np.arange(n)
+    # 0 undecided, 1 kept, 2 merged into a kept box
+    state = np.zeros(n, dtype = np.int8)
+    while True:
+        undecided = state == 0
+        if not undecided.any():
+            return cluster
+        waiting = np.zeros(n, dtype = bool)
+        waiting[q[state[p] == 0]] = True
+
+        # The highest scoring kept neighbour of each box
+        best = np.full(n, n)
+        hit = state[p] == 1
+        np.minimum.at(best, q[hit], p[hit])
+
+        ready = undecided & ~waiting
+        merged = ready & (best < n)
+        cluster[merged] = best[merged]
+        state[merged] = 2
+        state[ready & ~merged] = 1
+
+        # Pairs of decided boxes can't change anything any more
+        open_ = state[q] == 0
+        p, q = p[open_], q[open_]
+
+def merge_boxes(bboxes, scores, groups, iou_thresh = 0.5, method = 'nms'):
+    '''
+    PURPOSE: Greedy non-maximum suppression, or box fusion, within each group (e.g. image and category).
+    Only the pairs found by evaluation.candidate_pairs are compared, so memory grows with the number of
+    overlapping pairs rather than with the square of the group size
+    IN:
+        - bboxes: array (n, 4) of coco boxes
+        - scores: array (n,)
+        - groups: int array (n,), boxes are only merged with boxes of the same group
+        - iou_thresh: boxes overlapping a higher scoring box by more than this are merged into it
+        - method: 'nms' keeps the highest scoring box of each cluster, 'fuse' replaces it with the
+                  score weighted average of the cluster's boxes
+    OUT:
+        - keep: indices of the kept boxes, highest score first within each group
+        - bboxes: array (len(keep), 4) of the kept (or fused) boxes
+    '''
+    if method not in ('nms', 'fuse'):
+        raise ValueError(f'method must be nms or fuse, not {method}')
+
+    # Positions in score order within each group, so p < q means p scores higher
+    order = np.lexsort((-scores, groups))
+    p, q, iou = evaluation.candidate_pairs(groups[order], bboxes[order], iou_thresh)
+    over = iou > iou_thresh
+    cluster = nms_clusters(p[over], q[over], len(order))
+
+    keep_pos = np.flatnonzero(cluster == np.arange(len(order)))
+    keep = order[keep_pos]
+    if method == 'nms':
+        return keep, bboxes[keep]
+
+    # Score weighted average of each cluster, accumulated with one unbuffered add
+    w = scores[order]
+    sums = np.zeros((len(order), 4))
+    np.add.at(sums, cluster, bboxes[order]*w[:, None])
+    weights = np.bincount(cluster, weights = w, minlength = len(order))
+    return keep, sums[keep_pos]/weights[keep_pos, None]
+
+def stitch(chip_gt_path, dt_path, out_path = None, iou_thresh = 0.5, method = 'nms', conf_thresh = None):
+    '''
+    PURPOSE: Turn detections on chips back into scene detections, shifting each box by its chip's offset
+    and merging the duplicates from overlapping chips per scene and category
+    IN:
+        - chip_gt_path: coco gt of the chips, see chip_offsets
+        - dt_path: coco dt file of detections on the chips
+        - out_path: optional path to write the scene detections to, as a coco dt json
+        - iou_thresh, method: see merge_boxes
+        - conf_thresh: optional minimum score, applied before merging
+    OUT:
+        - scene_dts: list of coco detections on the parent images
+    '''
+    offsets = chip_offsets(chip_gt_path)
+
+    parents, cat_ids, scores, bboxes = [], [], [], []
+    for dt in stream.iter_array(dt_path):
+        if conf_thresh is not None and dt['score'] < conf_thresh:
+            continue
+        parent_id, x, y, sx, sy = offsets[dt['image_id']]
+        b = dt['bbox']
+        parents.append(parent_id)
+        cat_ids.append(dt['category_id'])
+        scores.append(dt['score'])
+        # Chips cut from a resized scene are scaled back to the scene's own pixels
+        bboxes.append([(b[0] + x)/sx, (b[1] + y)/sy, b[2]/sx, b[3]/sy])
+    cat_ids = np.array(cat_ids, dtype = np.int64)
+    scores = np.array(scores, dtype = float)
+    bboxes = np.array(bboxes, dtype = float).reshape(-1, 4)
+
+    # One group per scene and category
+    parent_ids, parent_codes = np.unique(np.array(parents), return_inverse = True) if parents else (np.array([]), np.zeros(0, dtype = int))
+    groups = np.unique(np.c_[parent_codes.reshape(-1), cat_ids], axis = 0, return_inverse = True)[1].reshape(-1)
+    keep, merged = merge_boxes(bboxes, scores, groups, iou_thresh, method)
+
+    scene_dts = []
+    for k, b in zip(keep, merged):
+        scene_dts.append({
+            'image_id': parent_ids[parent_codes[k]].item(),
+            'category_id': int(cat_ids[k]),
+            'bbox': [float(v) for v in b],
+            'score': float(scores[k])
+        })
+
+    if out_path is not None:
+        stream.write_array(out_path, scene_dts)
+        print(f'{len(scores)} chip detections stitched into {len(scene_dts)} scene detections: {out_path}')
+    return scene_dts
@@ -1,8 +1,35 @@
 from matplotlib import pyplot as plt
 import json
+import numpy as np
 import seaborn as sns
 import random
-from matplotlib import patches
+from matplotlib.collections import LineCollection, EllipseCollection
+import sys
+import os
+from PIL import Image
+
+cwd = os.getcwd() + '/hot_coco'
+if os.path.exists(cwd):
+    sys.path.append(cwd)
+
+import stream as stream
+
+# Above this many annotations on one image, category labels are dropped to keep drawing fast
+MAX_LABELS = 300
+
+# Pyramid levels are halved until their longest side is at most this many pixels
+PYRAMID_MIN_SIZE = 256
+
+# Colors used instead of the category palette when coloring by match status
+MATCH_COLORS = {'TP': (0.2, 0.9, 0.2), 'FP': (1.0, 0.2, 0.2), 'FN': (1.0, 0.7, 0.0)}
+
+# How each kind of annotation is drawn
+STYLES = {
+    'gt': {'ls': '-', 'ha': 'left', 'text_color': 'w'},
+    'dt': {'ls': '--', 'ha': 'left', 'text_color': 'w'},
+    'gt_under_dt': {'ls': '-', 'ha': 'right', 'text_color': 'b'},
+    'cp': {'ha': 'left', 'text_color': 'w'}
+}
 
 '''########################### Helper Functions ########################### '''
 
@@ -26,14 +53,20 @@ def anns_on_image(im_id, contents):
     
     return on_image
 
-def anns_on_image_dt(im_id, json_path):
+def anns_on_image_dt(im_id, json_path, conf_thresh = None):
     '''
     IN: 
         - im_id: int id for 'id' in 'images' of coco json
-        - json_path: path to coco gt json
+        - json_path: path to coco dt json, or an index from index_dt
+        - conf_thresh: optional minimum score, only applied when using an index
     OUT:
         - on_image: list of annotations on the given image
     '''
+    if isinstance(json_path, dict):
+        bboxes, cat_ids, scores = dt_on_image(im_id, json_path, conf_thresh)
+        return [{'image_id': im_id, 'category_id': c, 'bbox': b, 'score': s}
+                for b, c, s in zip(bboxes.tolist(), cat_ids.tolist(), scores.tolist())]
+
     # Open json
     with open(json_path, 'r') as f:
         contents = json.load(f)
@@ -46,6 +79,105 @@ def anns_on_image_dt(im_id, json_path):
     
     return on_image
 
+def index_dt(dt_path):
+    '''
+    PURPOSE: Read a detections file once into per-image arrays sorted by score, so that a
+    confidence threshold becomes a binary search instead of a scan
+    IN:
+        - dt_path: path (str or os.PathLike) to coco dt json, or to a .npz from detections.filter_dt
+                   (or an already loaded list of detections)
+    OUT:
+        - dt_index: dict of image id to a dict of 'bbox' (n, 4), 'category_id' (n,) and 'score' (n,)
+                    arrays, highest score first
+    '''
+    is_path = isinstance(dt_path, (str, os.PathLike))
+    if is_path:
+        dt_path = os.fspath(dt_path)
+    if is_path and dt_path.endswith('.npz'):
+        import detections as detections
+        return detections.read_binary(dt_path)
+
+    dts = stream.iter_array(dt_path) if is_path else dt_path
+
+    # Collect flat columns, which take far less memory than a list of dicts
+    im_ids = []
+    cat_ids = []
+    scores = []
+    bboxes = []
+    for a in dts:
+        im_ids.append(a['image_id'])
+        cat_ids.append(a['category_id'])
+        scores.append(a['score'])
+        bboxes.append(a['bbox'][:4])
+    im_ids = np.array(im_ids)
+    cat_ids = np.array(cat_ids, dtype = int)
+    scores = np.array(scores, dtype = float)
+    bboxes = np.array(bboxes, dtype = float).reshape(-1, 4)
+
+    # Sort by image, then by descending score, and cut into one slice per image
+    order = np.lexsort((-scores, im_ids))
+    im_sorted = im_ids[order]
+    starts = np.flatnonzero(np.r_[True, im_sorted[1:] != im_sorted[:-1]]) if len(order) else np.array([], dtype = int)
+    ends = np.r_[starts[1:], len(order)]
+
+    dt_index = {}
+    for start, end in zip(starts, ends):
+        rows = order[start:end]
+        dt_index[im_sorted[start].item()] = {
+            'bbox': bboxes[rows],
+            'category_id': cat_ids[rows],
+            'score': scores[rows]
+        }
+    return dt_index
+
+def dt_on_image(im_id, dt_index, conf_thresh = None):
+    '''
+    IN:
+        - im_id: int id for 'id' in 'images' of coco json
+        - dt_index: output of index_dt
+        - conf_thresh: optional minimum score
+    OUT:
+        - bboxes, cat_ids, scores: arrays of the detections on this image at or above conf_thresh
+    '''
+    dts = dt_index.get(im_id)
+    if dts is None:
+        return np.zeros((0, 4)), np.zeros(0, dtype = int), np.zeros(0)
+    n = len(dts['score'])
+    if conf_thresh is not None:
+        # scores are sorted high to low, so everything above the threshold is a prefix
+        n = np.searchsorted(-dts['score'], -conf_thresh, side = 'right')
+    return dts['bbox'][:n], dts['category_id'][:n], dts['score'][:n]
+
+def index_anns(anns):
+    '''
+    IN:
+        - anns: list of coco annotations or detections
+    OUT:
+        - by_image: dict of image id to the list of annotations on that image
+    '''
+    by_image = {}
+    for a in anns:
+        by_image.setdefault(a['image_id'], []).append(a)
+    return by_image
+
+def get_image_names(contents):
+    '''
+    IN:
+        - contents: coco json contents
+    OUT:
+        - dict of image id to image file name
+    '''
+    return {im['id']: im['file_name'] for im in contents['images']}
+
+def get_category_names(contents):
+    '''
+    IN:
+        - contents: coco json contents
+    OUT:
+        - dict of category id to category name
+    '''
+    return {c['id']: c['name'] for c in contents['categories']}
+
 
 def choose_random_ims(num_ims, contents):
     '''
@@ -75,23 +207,6 @@ def choose_random_ims(num_ims, contents):
     
     return rand_ims
 
-def get_category_gt(i, gt):
-    '''
-    IN: 
-        -i: int of 'category_id' you would like identified
-        -categories: 'categories' section of coco json
-        - gt: loaded coco gt information
-    OUT: 
-        -name of object category, or "none" if the category isn't present
-    '''
-        
-    categories = gt['categories']
-    
-    for c in categories:
-        if c['id'] == i:
-            return c['name']
-    return "None" 
-
 def make_palette(contents):
     categories = contents['categories']
     
@@ -99,11 +214,350 @@ def make_palette(contents):
         
     return palette
 
+'''############################ Image Pyramids ############################ '''
+
+def pyramid_path(im_path, level, pyramid_folder = None):
+    '''
+    IN:
+        - im_path: path to a full resolution image
+        - level: int, the image is downsampled by 2**level
+        - pyramid_folder: where levels are stored, by default a '_pyramid' folder beside the image folder
+          (not inside it, so functions that list image folders are unaffected)
+    OUT:
+        - path to that pyramid level
+    '''
+    if pyramid_folder is None:
+        pyramid_folder = os.path.dirname(os.path.abspath(im_path)) + '_pyramid/'
+    # The full file name, so images that only differ in extension keep separate levels
+    return os.path.join(pyramid_folder, f'{os.path.basename(im_path)}_{level}.png')
+
+def build_pyramid(im_path, pyramid_folder = None, min_size = PYRAMID_MIN_SIZE):
+    '''
+    PURPOSE: Decode an image once and save successive 2x reductions of it, so later displays can
+    read only the resolution they need. Levels newer than the image are reused, not rebuilt
+    IN:
+        - im_path: path to a full resolution image
+        - pyramid_folder: see pyramid_path
+        - min_size: int, stop once the longest side is at most this many pixels
+    OUT:
+        - levels: list of paths, levels[k - 1] is downsampled by 2**k
+    '''
+    with Image.open(im_path) as img:
+        n_levels = 0
+        size = max(img.size)
+        while size > min_size:
+            size = size // 2
+            n_levels += 1
+
+        levels = [pyramid_path(im_path, k, pyramid_folder) for k in range(1, n_levels + 1)]
+        src_time = os.path.getmtime(im_path)
+        if all(os.path.exists(l) and os.path.getmtime(l) >= src_time for l in levels):
+            return levels
+
+        if levels:
+            os.makedirs(os.path.dirname(levels[0]), exist_ok = True)
+
+        # Palette images cannot be averaged, so reduce their colors instead
+        level_img = img.convert('RGB') if img.mode in ('P', '1') else img
+        for l in levels:
+            level_img = level_img.reduce(2)
+            level_img.save(l)
+
+    return levels
+
+def read_for_figure(im_path, fig_size, dpi = None, pyramid = True, pyramid_folder = None):
+    '''
+    PURPOSE: Read an image at the lowest resolution that still fills a figure of fig_size
+    IN:
+        - im_path: path to a full resolution image
+        - fig_size: figure size in inches
+        - dpi: figure resolution, by default matplotlib's
+        - pyramid: if False, always read the full resolution image
+        - pyramid_folder: see pyramid_path
+    OUT:
+        - img: image array, possibly downsampled
+        - size: (width, height) of the full resolution image, for drawing in its coordinates
+    '''
+    with Image.open(im_path) as img:
+        size = img.size
+    if dpi is None:
+        dpi = plt.rcParams['figure.dpi']
+    target = max(fig_size)*dpi
+
+    # Pick the coarsest level that still has at least as many pixels as the figure
+    level = 0
+    longest = max(size)
+    while pyramid and longest // 2 >= target and longest // 2 >= PYRAMID_MIN_SIZE:
+        longest = longest // 2
+        level += 1
+
+    if level == 0:
+        return plt.imread(im_path), size
+    try:
+        levels = build_pyramid(im_path, pyramid_folder)
+    except OSError:
+        # The pyramid can't be written (e.g. a read-only folder), so reduce this once in memory
+        with Image.open(im_path) as img:
+            level_img = img.convert('RGB') if img.mode in ('P', '1') else img
+            return np.asarray(level_img.reduce(2**level)), size
+    with Image.open(levels[min(level, len(levels)) - 1]) as level_img:
+        img = np.asarray(level_img)
+    return img, size
+
+'''############################ Rendering Core ############################ '''
+
+def ann_arrays(anns, key = 'bbox', conf_thresh = None):
+    '''
+    IN:
+        - anns: list of coco annotations or detections
+        - key: 'bbox' or 'centerpoint', the geometry to pull out
+        - conf_thresh: if given, only keep detections with a 'score' at least this high
+    OUT:
+        - geometry: float array, one row per annotation
+        - cat_ids: int array of category ids
+    '''
+    if conf_thresh is not None:
+        anns = [a for a in anns if a['score'] >= conf_thresh]
+    if key == 'centerpoint':
+        geometry = centerpoint_arrays(anns)
+    else:
+        width = 4 if key == 'bbox' else 2
+        geometry = np.array([a[key][:width] for a in anns], dtype = float).reshape(-1, width)
+    cat_ids = np.array([a['category_id'] for a in anns], dtype = int)
+    return geometry, cat_ids
+
+def centerpoint_arrays(anns):
+    '''
+    IN:
+        - anns: list of coco annotations
+    OUT:
+        - points: float array (n, 2) of each annotation's centerpoint: its 'centerpoint' (or the
+                  'object_center' mods/geococo writes) if it has one, else the center of its bbox
+    '''
+    boxes = np.array([a.get('bbox', (np.nan,)*4)[:4] for a in anns], dtype = float).reshape(-1, 4)
+    points = np.trunc(boxes[:, :2] + boxes[:, 2:]/2)
+    for n, a in enumerate(anns):
+        c = a.get('centerpoint', a.get('object_center'))
+        if c is not None:
+            points[n] = c[:2]
+    return points
+
+def attach_centerpoints(gt, sidecar):
+    '''
+    PURPOSE: Set 'centerpoint' on the annotations in memory from a centerpoint sidecar
+    IN:
+        - gt: loaded coco gt contents, changed in place
+        - sidecar: .npz of 'ann_id' and 'center' columns, from mods/geococo.centerpoints_xy
+    '''
+    with np.load(sidecar) as data:
+        centers = dict(zip(data['ann_id'].tolist(), data['center'].tolist()))
+    for a in gt['annotations']:
+        if a['id'] in centers:
+            a['centerpoint'] = centers[a['id']]
+
+def palette_colors(cat_ids, pal):
+    '''
+    IN:
+        - cat_ids: int array of category ids
+        - pal: palette from make_palette, indexed by category id - 1
+    OUT:
+        - array of rgb colors, one row per category id
+    '''
+    pal = np.asarray(pal, dtype = float).reshape(-1, 3)
+    return pal[(np.asarray(cat_ids, dtype = int) - 1) % len(pal)]
+
+def boxes_to_segments(bboxes):
+    '''
+    IN:
+        - bboxes: array of shape (n, 4) of coco [x, y, w, h] boxes
+    OUT:
+        - array of shape (n, 5, 2) of closed rectangle outlines
+    '''
+    x1 = bboxes[:, 0]
+    y1 = bboxes[:, 1]
+    x2 = x1 + bboxes[:, 2]
+    y2 = y1 + bboxes[:, 3]
+    xs = np.stack([x1, x2, x2, x1, x1], axis = 1)
+    ys = np.stack([y1, y1, y2, y2, y1], axis = 1)
+    return np.stack([xs, ys], axis = 2)
+
+def draw_labels(ax, points, cat_ids, names, style, max_labels = MAX_LABELS):
+    '''
+    Label each point with its category name, unless there are more than max_labels of them
+    '''
+    if len(points) > max_labels:
+        return
+    for (x, y), c in zip(points, cat_ids):
+        ax.text(x, y, names.get(c, 'None'), ha = style['ha'], color = style['text_color'])
+    return
+
+def draw_boxes(ax, bboxes, cat_ids, pal, names, style = 'gt', text_on = True, max_labels = MAX_LABELS, colors = None):
+    '''
+    PURPOSE: Draw every box on an image as a single collection
+    IN:
+        - ax: matplotlib axis with the image on it
+        - bboxes: array of shape (n, 4) of coco boxes
+        - cat_ids: int array of category ids
+        - pal: palette from make_palette
+        - names: dict of category id to name, from get_category_names
+        - style: key into STYLES
+        - text_on: whether to label boxes with their category
+        - max_labels: labels are dropped when there are more boxes than this
+        - colors: optional array of colors overriding the category palette
+    '''
+    style = STYLES[style]
+    if len(bboxes) == 0:
+        return
+    if colors is None:
+        colors = palette_colors(cat_ids, pal)
+    ax.add_collection(LineCollection(boxes_to_segments(bboxes), colors = colors, linestyles = style['ls']))
+    if text_on:
+        draw_labels(ax, bboxes[:, :2], cat_ids, names, style, max_labels)
+    return
+
+def draw_centerpoints(ax, points, cat_ids, pal, names, radius = 2, text_on = True, max_labels = MAX_LABELS):
+    '''
+    PURPOSE: Draw every centerpoint on an image as a single collection of circles
+    IN: see draw_boxes, with points an array of shape (n, 2) and radius in pixels
+    '''
+    if len(points) == 0:
+        return
+    colors = palette_colors(cat_ids, pal)
+    circles = EllipseCollection(np.full(len(points), 2*radius), np.full(len(points), 2*radius), np.zeros(len(points)),
+                                units = 'xy', offsets = points, offset_transform = ax.transData,
+                                facecolors = colors, edgecolors = colors)
+    ax.add_collection(circles)
+    if text_on:
+        draw_labels(ax, points, cat_ids, names, STYLES['cp'], max_labels)
+    return
+
+def draw_anns(ax, im_path, layers, pal, names, fig_size = (20,20), text_on = True, max_labels = MAX_LABELS,
+              pyramid = True, dpi = None):
+    '''
+    PURPOSE: Draw one image with any number of annotation layers on an existing axis
+    IN:
+        - ax: matplotlib axis
+        - im_path: path to the image
+        - layers: list of dicts, each with 'style' (key into STYLES), 'geometry' and 'cat_ids' arrays
+                  from ann_arrays, and optionally 'text_on', 'radius' and 'colors'
+        - pal, names: palette and category names, see draw_boxes
+        - fig_size: size of the axis in inches, used to choose the image resolution
+        - pyramid: read the image at figure resolution from its pyramid, see read_for_figure
+        - dpi: figure resolution, by default matplotlib's
+    '''
+    img, (w, h) = read_for_figure(im_path, fig_size, dpi, pyramid)
+
+    # Stretch the image over the full resolution extent, so annotations keep their own coordinates
+    ax.imshow(img, extent = (0, w, h, 0))
+
+    # Labels are dropped based on everything drawn on the image, not each layer alone
+    total = sum(len(l['geometry']) for l in layers)
+    layer_max = max_labels if total <= max_labels else -1
+
+    for l in layers:
+        l_text = text_on and l.get('text_on', True)
+        if l['style'] == 'cp':
+            draw_centerpoints(ax, l['geometry'], l['cat_ids'], pal, names, l.get('radius', 2), l_text, layer_max)
+        else:
+            draw_boxes(ax, l['geometry'], l['cat_ids'], pal, names, l['style'], l_text, layer_max, l.get('colors'))
+    return
+
+def show_anns(im_path, layers, pal, names, fig_size = (20,20), title = None, text_on = True, max_labels = MAX_LABELS,
+              pyramid = True):
+    '''
+    PURPOSE: Display one image with any number of annotation layers drawn on it, see draw_anns
+    OUT:
+        - the matplotlib figure and axis
+    '''
+    f,ax = plt.subplots(1, figsize = fig_size)
+    draw_anns(ax, im_path, layers, pal, names, fig_size, text_on, max_labels, pyramid, f.dpi)
+    if title:
+        plt.title(title)
+    return f, ax
+
+def image_layers(im_id, gt_by_im = None, dt_index = None, conf_thresh = 0.9, key = 'bbox', radius = 2,
+                 color_by = 'category', iou_thresh = 0.5, show_gt = True):
+    '''
+    PURPOSE: Collect the layers drawn on one image in the standard gt, dt and centerpoint styles
+    IN:
+        - im_id: image id
+        - gt_by_im: output of index_anns for the gt annotations, or None to skip the gt
+        - dt_index: output of index_dt, or None to skip detections
+        - conf_thresh: minimum detection score drawn
+        - key: 'bbox' to draw gt boxes, 'centerpoint' to draw gt centerpoints
+        - radius: centerpoint radius in pixels
+        - color_by: 'category' to use the category palette, or 'match' to color detections TP/FP and gt
+                    boxes TP/FN (see MATCH_COLORS) after matching them with evaluation.match_image
+        - iou_thresh: minimum IoU for a match when color_by is 'match'
+        - show_gt: whether to draw the gt layer, gt_by_im may still be needed to color detections
+    OUT:
+        - layers: list of layer dicts for draw_anns
+    '''
+    layers = []
+    if gt_by_im is not None:
+        gt_geometry, gt_cats = ann_arrays(gt_by_im.get(im_id, []), key)
+    if dt_index is not None:
+        geometry, cat_ids, scores = dt_on_image(im_id, dt_index, conf_thresh)
+        layers.append({'style': 'dt', 'geometry': geometry, 'cat_ids': cat_ids})
+
+    if color_by == 'match' and dt_index is not None and gt_by_im is not None and key == 'bbox':
+        import evaluation as evaluation
+        dt_match, dt_iou, gt_match = evaluation.match_image(gt_geometry, gt_cats, geometry, cat_ids, scores, iou_thresh)
+        layers[0]['colors'] = np.array([MATCH_COLORS['TP'] if m >= 0 else MATCH_COLORS['FP'] for m in dt_match]).reshape(-1, 3)
+        gt_colors = np.array([MATCH_COLORS['TP'] if m >= 0 else MATCH_COLORS['FN'] for m in gt_match]).reshape(-1, 3)
+    elif color_by not in ('category', 'match'):
+        raise ValueError(f'color_by must be category or match, not {color_by}')
+    else:
+        gt_colors = None
+
+    if gt_by_im is not None and show_gt:
+        if key == 'centerpoint':
+            style = 'cp'
+        elif dt_index is not None:
+            style = 'gt_under_dt'
+        else:
+            style = 'gt'
+        layers.append({'style': style, 'geometry': gt_geometry, 'cat_ids': gt_cats, 'radius': radius, 'colors': gt_colors})
+    return layers
+
+def show_ims(im_ids, gt, image_folder, fig_size = (20,20), text_on = True, fig_titles = None, dt_path = None,
+             conf_thresh = 0.9, show_gt = True, key = 'bbox', radius = 2, max_labels = MAX_LABELS, pyramid = True,
+             color_by = 'category', iou_thresh = 0.5):
+    '''
+    PURPOSE: Shared loop behind every display function, drawing gt and/or detections on each image
+    IN:
+        - im_ids: list of image ids to display
+        - gt: loaded coco gt contents
+        - image_folder: folder where images in gt are located
+        - fig_titles: optional list of titles, one per image, else the image name is used
+        - dt_path: optional coco detections file or index from index_dt, drawn dashed
+        - conf_thresh: minimum detection score drawn
+        - show_gt: whether to draw the ground truth
+        - key: 'bbox' to draw gt boxes, 'centerpoint' to draw gt centerpoints
+        - radius: centerpoint radius in pixels
+        - pyramid: read each image at figure resolution from a cached pyramid, see read_for_figure
+        - color_by, iou_thresh: 'match' colors boxes by match status instead of category, see image_layers
+    '''
+    # Build every lookup once, rather than once per box or per image
+    pal = make_palette(gt)
+    names = get_category_names(gt)
+    im_names = get_image_names(gt)
+    gt_by_im = index_anns(gt['annotations']) if show_gt or color_by == 'match' else None
+    if dt_path is not None and not isinstance(dt_path, dict):
+        dt_path = index_dt(dt_path)
+
+    for n, i in enumerate(im_ids):
+        layers = image_layers(i, gt_by_im, dt_path, conf_thresh, key, radius, color_by, iou_thresh, show_gt)
+        title = fig_titles[n] if fig_titles else im_names[i]
+        show_anns(image_folder + im_names[i], layers, pal, names, fig_size, title, text_on, max_labels, pyramid)
+        plt.show()
+
+    return
 
 
 '''############################ Ground Truth ############################ '''
 
-def random_gt(num_ims, json_path, image_folder, fig_size = (20,20), text_on = True):
+def random_gt(num_ims, json_path, image_folder, fig_size = (20,20), text_on = True, max_labels = MAX_LABELS):
     '''
     PURPOSE: Display some number of images and their ground truth labels from a coco dataset, randomly selected
     IN:
@@ -118,44 +572,15 @@ def random_gt(num_ims, json_path, image_folder, fig_size = (20,20), text_on = Tr
     # open json at the start of the process
     with open(json_path, 'r') as f:
         gt = json.load(f)
-
-    # Get Color palette
-    pal = make_palette(gt)
     
     # Pick the image ids to display
     ims = choose_random_ims(num_ims, gt)
 
-    # Process each image
-    for i in ims:
-        
-        images = gt['images']
-        for im in images:
-            if im['id'] == i:
-                im_name = im['file_name']
-
-        # Get annotations on this image
-        anns = anns_on_image(i, gt)
-        
-        # Display the image
-        im_path = image_folder + im_name
-        plt.figure()
-        f,ax = plt.subplots(1, figsize = fig_size)
-        img = plt.imread(im_path)
-        plt.imshow(img)
-        for a in anns:
-            b = a['bbox']
-            cat = a['category_id']
-            cat_name = get_category_gt(cat, gt)
-            rect = patches.Rectangle((b[0], b[1]), b[2], b[3], edgecolor = pal[cat-1], facecolor = "none")
-            if text_on:
-                plt.text(b[0], b[1], cat_name, ha = "left", color = 'w')
-            ax.add_patch(rect)
-        plt.title(im_name)
-        plt.show()
+    show_ims(ims, gt, image_folder, fig_size, text_on, max_labels = max_labels)
     
     return
 
-def specific_gt(im_ids, json_path, image_folder, fig_size = (20,20), text_on = True, fig_titles=None):
+def specific_gt(im_ids, json_path, image_folder, fig_size = (20,20), text_on = True, fig_titles=None, max_labels = MAX_LABELS):
     '''
     PURPOSE: Display some number of images and their ground truth labels from a coco dataset, randomly selected
     IN:
@@ -171,50 +596,21 @@ def specific_gt(im_ids, json_path, image_folder, fig_size = (20,20), text_on = T
     with open(json_path, 'r') as f:
         gt = json.load(f)
 
-    # Get Color palette
-    pal = make_palette(gt)
-
-    # Process each image
-    for i in im_ids:
-        
-        images = gt['images']
-        for im in images:
-            if im['id'] == i:
-                im_name = im['file_name']
-
-        # Get annotations on this image
-        anns = anns_on_image(i, gt)
-        
-        # Display the image
-        im_path = image_folder + im_name
-        plt.figure()
-        f,ax = plt.subplots(1, figsize = fig_size)
-        img = plt.imread(im_path)
-        plt.imshow(img)
-        for a in anns:
-            b = a['bbox']
-            cat = a['category_id']
-            cat_name = get_category_gt(cat, gt)
-            rect = patches.Rectangle((b[0], b[1]), b[2], b[3], edgecolor = pal[cat-1], facecolor = "none")
-            if text_on:
-                plt.text(b[0], b[1], cat_name, ha = "left", color = 'w')
-            ax.add_patch(rect)
-        if not fig_titles:
-          plt.title(im_name)
-        else:
-          plt.title(fig_titles[im_ids.index(i)])
-        plt.show()
+    show_ims(im_ids, gt, image_folder, fig_size, text_on, fig_titles, max_labels = max_labels)
     
     return
 
 
-def random_gt_cp(num_ims, json_path, image_folder, fig_size = (20,20), text_on = True, radius = 2):
+def random_gt_cp(num_ims, json_path, image_folder, fig_size = (20,20), text_on = True, radius = 2, max_labels = MAX_LABELS,
+                 sidecar = None):
     '''
-    PURPOSE: Display some number of images from a coco dataset with 'centerpoint' key, randomly selected
+    PURPOSE: Display some number of images from a coco dataset as centerpoints, randomly selected
     IN:
         -num_ims: int indicating how many to display
         -json_path: coco gt file
         -image_folder: folder where images in json_path are located
+        -sidecar: optional centerpoint sidecar from mods/geococo.centerpoints_xy, else each annotation's
+                  'centerpoint' (or 'object_center') is used, or the center of its bbox computed in memory
     OUT:
         -figures with each randomly selected image and its annotations
     
@@ -223,50 +619,26 @@ def random_gt_cp(num_ims, json_path, image_folder, fig_size = (20,20), text_on =
     # open json at the start of the process
     with open(json_path, 'r') as f:
         gt = json.load(f)
-
-    # Get Color palette
-    pal = make_palette(gt)
+    
+    if sidecar is not None:
+        attach_centerpoints(gt, sidecar)
     
     # Pick the image ids to display
     ims = choose_random_ims(num_ims, gt)
 
-    # Process each image
-    for i in ims:
-        
-        images = gt['images']
-        for im in images:
-            if im['id'] == i:
-                im_name = im['file_name']
-
-        # Get annotations on this image
-        anns = anns_on_image(i, gt)
-        
-        # Display the image
-        im_path = image_folder + im_name
-        plt.figure()
-        f,ax = plt.subplots(1, figsize = fig_size)
-        img = plt.imread(im_path)
-        plt.imshow(img)
-        for a in anns:
-            b = a['centerpoint']
-            cat = a['category_id']
-            cat_name = get_category_gt(cat, gt)
-            rect = patches.Circle((b[0], b[1]), radius = radius, edgecolor = pal[cat-1], facecolor = pal[cat-1])
-            if text_on:
-                plt.text(b[0], b[1], cat_name, ha = "left", color = 'w')
-            ax.add_patch(rect)
-        plt.title(im_name)
-        plt.show()
+    show_ims(ims, gt, image_folder, fig_size, text_on, key = 'centerpoint', radius = radius, max_labels = max_labels)
     
     return
 
-def specific_gt_cp(im_ids, json_path, image_folder, fig_size = (20,20), text_on = True, radius = 2, fig_titles=None):
+def specific_gt_cp(im_ids, json_path, image_folder, fig_size = (20,20), text_on = True, radius = 2, fig_titles=None, max_labels = MAX_LABELS,
+                   sidecar = None):
     '''
-    PURPOSE: Display some number of images from a coco dataset with 'centerpoint' key, specifically selected
+    PURPOSE: Display some number of images from a coco dataset as centerpoints, specifically selected
     IN:
         -im_ids: list of ints indicating the image_ids to be displayed
         -json_path: coco gt file
         -image_folder: folder where images in json_path are located
+        -sidecar: optional centerpoint sidecar, see random_gt_cp
     OUT:
         -figures with each randomly selected image and its annotations
     
@@ -276,274 +648,110 @@ def specific_gt_cp(im_ids, json_path, image_folder, fig_size = (20,20), text_on
     with open(json_path, 'r') as f:
         gt = json.load(f)
 
-    # Get Color palette
-    pal = make_palette(gt)
-
-    # Process each image
-    for i in im_ids:
-        
-        images = gt['images']
-        for im in images:
-            if im['id'] == i:
-                im_name = im['file_name']
+    if sidecar is not None:
+        attach_centerpoints(gt, sidecar)
 
-        # Get annotations on this image
-        anns = anns_on_image(i, gt)
-        
-        # Display the image
-        im_path = image_folder + im_name
-        plt.figure()
-        f,ax = plt.subplots(1, figsize = fig_size)
-        img = plt.imread(im_path)
-        plt.imshow(img)
-        for a in anns:
-            b = a['centerpoint']
-            cat = a['category_id']
-            cat_name = get_category_gt(cat, gt)
-            rect = patches.Circle((b[0], b[1]), radius = radius, edgecolor = pal[cat-1], facecolor = pal[cat-1])
-            if text_on:
-                plt.text(b[0], b[1], cat_name, ha = "left", color = 'w')
-            ax.add_patch(rect)
-        if not fig_titles:
-          plt.title(im_name)
-        else:
-          plt.title(fig_titles[im_ids.index(i)])
-        plt.show()
+    show_ims(im_ids, gt, image_folder, fig_size, text_on, fig_titles, key = 'centerpoint', radius = radius, max_labels = max_labels)
     
     return
 
 '''############################# Detections ############################# '''
 
-def random_dt(num_ims, gt_path, dt_path, image_folder, fig_size = (20,20), conf_thresh = 0.9):
+def random_dt(num_ims, gt_path, dt_path, image_folder, fig_size = (20,20), conf_thresh = 0.9, max_labels = MAX_LABELS,
+              color_by = 'category', iou_thresh = 0.5):
     '''
     PURPOSE: Display some number of images and trheir detections cfrom a coco dataset, randomly selected
     IN:
         -num_ims: int indicating how many to display
-        -json_path: coco gt file
-        -image_folder: folder where images in json_path are located
+        -gt_path: coco gt file
+        -dt_path: coco dt file, or an index from index_dt to reuse across calls
+        -image_folder: folder where images in gt_path are located
+        -color_by: 'category', or 'match' to color detections TP/FP and gt boxes TP/FN
+        -iou_thresh: minimum IoU for a match when color_by is 'match'
     OUT:
         -figures with each randomly selected image and its annotations
     '''
     with open(gt_path, 'r') as f:
-        gt_content = json.load(f)
-
-    # Get Color palette
-    pal = make_palette(gt_content)
+        gt = json.load(f)
     
     # Pick the image ids to display
-    ims = choose_random_ims(num_ims, gt_content)
-    
-    with open(gt_path, 'r') as f:
-        gt = json.load(f)
-        
-    # Process each image
-    for i in ims:
-        
-        images = gt['images']
-        for im in images:
-            if im['id'] == i:
-                im_name = im['file_name']
-        
-        # Get annotations on this image
-        anns_dt = anns_on_image_dt(i, dt_path)
-        
-        # Display the image
-        im_path = image_folder + im_name
-        plt.figure()
-        f,ax = plt.subplots(1, figsize = fig_size)
-        img = plt.imread(im_path)
-        plt.imshow(img)
-        for a in anns_dt:
-            b = a['bbox']
-            cat = a['category_id']
-            conf = a['score']
-            if conf >= conf_thresh:
-                cat_name = get_category_gt(cat, gt)
-                rect = patches.Rectangle((b[0], b[1]), b[2], b[3], edgecolor = pal[cat-1], facecolor = "none", ls = '--')
-                plt.text(b[0], b[1], cat_name, ha = "left", color = 'w')
-                ax.add_patch(rect)
-        plt.show()
+    ims = choose_random_ims(num_ims, gt)
+
+    show_ims(ims, gt, image_folder, fig_size, dt_path = dt_path, conf_thresh = conf_thresh, show_gt = False,
+             max_labels = max_labels, color_by = color_by, iou_thresh = iou_thresh)
     
     return
 
-def specific_dt(im_ids, gt_path, dt_path, image_folder, fig_size = (20,20), conf_thresh = 0.9, fig_titles=None):
+def specific_dt(im_ids, gt_path, dt_path, image_folder, fig_size = (20,20), conf_thresh = 0.9, fig_titles=None, max_labels = MAX_LABELS,
+                color_by = 'category', iou_thresh = 0.5):
     '''
     PURPOSE: Display a specific set of images and their detections from a coco dataset
     IN:
         -im_ids: list of ints indicating the image_ids to be displayed
-        -json_path: coco gt file
-        -image_folder: folder where images in json_path are located
+        -gt_path: coco gt file
+        -dt_path: coco dt file, or an index from index_dt to reuse across calls
+        -image_folder: folder where images in gt_path are located
+        -color_by: 'category', or 'match' to color detections TP/FP and gt boxes TP/FN
+        -iou_thresh: minimum IoU for a match when color_by is 'match'
     OUT:
         -figures with each randomly selected image and its annotations
     '''
-    with open(gt_path, 'r') as f:
-        gt_content = json.load(f)
-
-    # Get Color palette
-    pal = make_palette(gt_content)
-    
     with open(gt_path, 'r') as f:
         gt = json.load(f)
-        
-    # Process each image
-    for i in im_ids:
-        
-        images = gt['images']
-        for im in images:
-            if im['id'] == i:
-                im_name = im['file_name']
-        
-        # Get annotations on this image
-        anns_dt = anns_on_image_dt(i, dt_path)
-        
-        # Display the image
-        im_path = image_folder + im_name
-        plt.figure()
-        f,ax = plt.subplots(1, figsize = fig_size)
-        img = plt.imread(im_path)
-        plt.imshow(img)
-        for a in anns_dt:
-            b = a['bbox']
-            cat = a['category_id']
-            conf = a['score']
-            if conf >= conf_thresh:
-                cat_name = get_category_gt(cat, gt)
-                rect = patches.Rectangle((b[0], b[1]), b[2], b[3], edgecolor = pal[cat-1], facecolor = "none", ls = '--')
-                plt.text(b[0], b[1], cat_name, ha = "left", color = 'w')
-                ax.add_patch(rect)
-        if not fig_titles:
-          plt.title(im_name)
-        else:
-          plt.title(fig_titles[im_ids.index(i)])
-        plt.show()
+
+    show_ims(im_ids, gt, image_folder, fig_size, fig_titles = fig_titles, dt_path = dt_path, conf_thresh = conf_thresh,
+             show_gt = False, max_labels = max_labels, color_by = color_by, iou_thresh = iou_thresh)
     
     return
 
 '''##################### Ground Truth and Detections ##################### '''
 
 
-def random_gt_dt(num_ims, gt_path, dt_path, image_folder, fig_size = (20,20), conf_thresh = 0.9):
+def random_gt_dt(num_ims, gt_path, dt_path, image_folder, fig_size = (20,20), conf_thresh = 0.9, max_labels = MAX_LABELS,
+                 color_by = 'category', iou_thresh = 0.5):
     '''
     PURPOSE: Display some number of images from a coco dataset, randomly selected
     IN:
         -num_ims: int indicating how many to display
-        -json_path: coco gt file
-        -image_folder: folder where images in json_path are located
+        -gt_path: coco gt file
+        -dt_path: coco dt file, or an index from index_dt to reuse across calls
+        -image_folder: folder where images in gt_path are located
+        -color_by: 'category', or 'match' to color detections TP/FP and gt boxes TP/FN
+        -iou_thresh: minimum IoU for a match when color_by is 'match'
     OUT:
         -figures with each randomly selected image and its annotations
     '''
 
     with open(gt_path, 'r') as f:
-        gt_content = json.load(f)
-
-    # Get Color palette
-    pal = make_palette(gt_content)
+        gt = json.load(f)
     
     # Pick the image ids to display
-    ims = choose_random_ims(num_ims, gt_content)
-    
-    with open(gt_path, 'r') as f:
-        gt = json.load(f)
-        
-    # Process each image
-    for i in ims:
-        
-        images = gt['images']
-        for im in images:
-            if im['id'] == i:
-                im_name = im['file_name']
-        
-        # Get annotations on this image
-        anns_dt = anns_on_image_dt(i, dt_path)
-        anns_gt = anns_on_image(i, gt_content)
-        
-        # Display the image
-        im_path = image_folder + im_name
-        plt.figure()
-        f,ax = plt.subplots(1, figsize = fig_size)
-        img = plt.imread(im_path)
-        plt.imshow(img)
-        for a in anns_dt:
-            b = a['bbox']
-            cat = a['category_id']
-            conf = a['score']
-            if conf >= conf_thresh:
-                cat_name = get_category_gt(cat, gt)
-                rect = patches.Rectangle((b[0], b[1]), b[2], b[3], edgecolor = pal[cat-1], facecolor = "none", ls = '--')
-                plt.text(b[0], b[1], cat_name, ha = "left", color = 'w')
-                ax.add_patch(rect)
-        for a in anns_gt:
-            b = a['bbox']
-            cat = a['category_id']
-            cat_name = get_category_gt(cat, gt)
-            rect = patches.Rectangle((b[0], b[1]), b[2], b[3], edgecolor = pal[cat-1], facecolor = "none", ls = '-')
-            plt.text(b[0], b[1], cat_name, ha = "right", color = 'b')
-            ax.add_patch(rect)
-        plt.show()
+    ims = choose_random_ims(num_ims, gt)
+
+    show_ims(ims, gt, image_folder, fig_size, dt_path = dt_path, conf_thresh = conf_thresh, max_labels = max_labels,
+             color_by = color_by, iou_thresh = iou_thresh)
     
     return
 
-def specific_gt_dt(im_ids, gt_path, dt_path, image_folder, fig_size = (20,20), conf_thresh = 0.9, fig_titles=None):
+def specific_gt_dt(im_ids, gt_path, dt_path, image_folder, fig_size = (20,20), conf_thresh = 0.9, fig_titles=None, max_labels = MAX_LABELS,
+                   color_by = 'category', iou_thresh = 0.5):
     '''
     PURPOSE: Display a specific set of images and their detections from a coco dataset
     IN:
         -im_ids: list of ints indicating the image_ids to be displayed
-        -json_path: coco gt file
-        -image_folder: folder where images in json_path are located
+        -gt_path: coco gt file
+        -dt_path: coco dt file, or an index from index_dt to reuse across calls
+        -image_folder: folder where images in gt_path are located
+        -color_by: 'category', or 'match' to color detections TP/FP and gt boxes TP/FN
+        -iou_thresh: minimum IoU for a match when color_by is 'match'
     OUT:
         -figures with each randomly selected image and its annotations
     '''
 
-    with open(gt_path, 'r') as f:
-        gt_content = json.load(f)
-
-    # Get Color palette
-    pal = make_palette(gt_content)
-    
     with open(gt_path, 'r') as f:
         gt = json.load(f)
-        
-    # Process each image
-    for i in im_ids:
-        
-        images = gt['images']
-        for im in images:
-            if im['id'] == i:
-                im_name = im['file_name']
-        
-        # Get annotations on this image
-        anns_dt = anns_on_image_dt(i, dt_path)
-        anns_gt = anns_on_image(i, gt_content)
-        
-        # Display the image
-        im_path = image_folder + im_name
-        plt.figure()
-        f,ax = plt.subplots(1, figsize = fig_size)
-        img = plt.imread(im_path)
-        plt.imshow(img)
-        for a in anns_dt:
-            b = a['bbox']
-            cat = a['category_id']
-            conf = a['score']
-            if conf >= conf_thresh:
-                cat_name = get_category_gt(cat, gt)
-                rect = patches.Rectangle((b[0], b[1]), b[2], b[3], edgecolor = pal[cat-1], facecolor = "none", ls = '--')
-                plt.text(b[0], b[1], cat_name, ha = "left", color = 'w')
-                ax.add_patch(rect)
-        for a in anns_gt:
-            b = a['bbox']
-            cat = a['category_id']
-            cat_name = get_category_gt(cat, gt)
-            rect = patches.Rectangle((b[0], b[1]), b[2], b[3], edgecolor = pal[cat-1], facecolor = "none", ls = '-')
-            plt.text(b[0], b[1], cat_name, ha = "right", color = 'b')
-            ax.add_patch(rect)
-        if not fig_titles:
-          plt.title(im_name)
-        else:
-          plt.title(fig_titles[im_ids.index(i)])
-        plt.show()
+
+    show_ims(im_ids, gt, image_folder, fig_size, fig_titles = fig_titles, dt_path = dt_path, conf_thresh = conf_thresh,
+             max_labels = max_labels, color_by = color_by, iou_thresh = iou_thresh)
     
     return
-
-
-
@@ -4,6 +4,7 @@ import numpy as np
 import seaborn as sns
 from matplotlib import pyplot as plt
 from tabulate import tabulate
+from tqdm import tqdm
 import sys
 import os
 
@@ -13,6 +14,7 @@ if os.path.exists(cwd):
 
 
 import display as display
+import stream as stream
 
 def get_ann_df(ann_fp):
 
@@ -127,25 +129,61 @@ def cat_coexist_heatmap(ann_df, im_df):
     Create a heatmap indicating how many images each pair of categories appears on together
     '''
     cat_cm_df = get_cat_cm(ann_df, im_df)
+    plot_cat_cm(cat_cm_df)
+
+    return
+
+def plot_cat_cm(cat_cm_df):
+    '''
+    Draw a category co-existence matrix, such as the one from get_cat_cm or stream_cat_cm, as a heatmap
+    '''
     t = [cat_cm_df.loc[c,c] for c in cat_cm_df.index]
-    fig, ax = plt.subplots(figsize=(15,15))
-    a = sns.heatmap(cat_cm_df.div(t).transpose(), annot=cat_cm_df, ax=ax)
-    a = plt.suptitle('Heat Map: How Often Categories Appear on Images Together', fontsize=20, x = 0.43, y=0.91)
-    a = plt.title('Colored By Percentage, Values Indicate the Total Number of Images', fontsize=12)
-    a = plt.xlabel('Reference Category')
-    a = plt.ylabel('Master Category')
+    plot_heatmap(cat_cm_df.div(t).transpose(), cat_cm_df,
+                 'Heat Map: How Often Categories Appear on Images Together',
+                 'Colored By Percentage, Values Indicate the Total Number of Images',
+                 'Reference Category', 'Master Category')
+
+    return
+
+def plot_heatmap(color_df, annot_df, title, subtitle, x_label, y_label, fig_size = (15,15), fmt = '.2g'):
+    '''
+    PURPOSE: The seaborn heatmap shared by the category matrices
+    IN:
+        - color_df: dataframe of the values the cells are colored by
+        - annot_df: dataframe of the values written in the cells
+        - title, subtitle, x_label, y_label: str
+        - fig_size: tuple
+        - fmt: format of the written values
+    '''
+    fig, ax = plt.subplots(figsize=fig_size)
+    a = sns.heatmap(color_df, annot=annot_df, fmt=fmt, ax=ax)
+    a = plt.suptitle(title, fontsize=20, x = 0.43, y=0.91)
+    a = plt.title(subtitle, fontsize=12)
+    a = plt.xlabel(x_label)
+    a = plt.ylabel(y_label)
 
     return
 
 def print_category_counts(ann_df, fig_size, font_size):
 
-    plot = ann_df['category_name'].value_counts().plot(kind='barh', 
-                                                       figsize=fig_size, 
-                                                       fontsize=font_size,
-                                                       title = 'Dataset Annotation Totals By Object Class')
+    plot_category_counts(ann_df['category_name'].value_counts(), fig_size, font_size)
     return
 
-def show_ims_most_anns_cats(im_df, ann_fp, img_fp, fig_size):
+def plot_category_counts(counts, fig_size, font_size):
+    '''
+    Bar graph of a series of annotation counts indexed by category name
+    '''
+    plot = counts.plot(kind='barh', 
+                       figsize=fig_size, 
+                       fontsize=font_size,
+                       title = 'Dataset Annotation Totals By Object Class')
+    return
+
+def show_ims_most_anns_cats(im_df, ann_fp, img_fp, fig_size, stats = None):
+    '''
+    Show the images with the most annotations and the most categories. With stats from stream_stats,
+    only those two images' annotations are streamed from ann_fp instead of loading the whole file
+    '''
 
     # Create 2 sorted dataframes prioritizing the number of categories on that image or the number of annotations
     im_anns_cats_df = im_df.sort_values(['Total Categories', 'Total Annotations'], ascending=False)
@@ -158,17 +196,525 @@ def show_ims_most_anns_cats(im_df, ann_fp, img_fp, fig_size):
     im_id_anns = im_df['id'][im_df.index == im_most_anns].values[0]
     im_id_cats = im_df['id'][im_df.index == im_most_cats].values[0]
 
-    display.specific_gt(im_ids = [im_id_anns, im_id_cats], json_path = ann_fp, 
-                image_folder = img_fp, fig_size = (max(fig_size)+1,max(fig_size)+1), text_on = True, 
-                fig_titles=[f'Image with the Most Annotations: {im_most_anns}', 
-                            f'Image with the Most Categories: {im_most_cats}'])
+    im_ids = [im_id_anns, im_id_cats]
+    fig_titles = [f'Image with the Most Annotations: {im_most_anns}', 
+                  f'Image with the Most Categories: {im_most_cats}']
+    if stats is None:
+        display.specific_gt(im_ids = im_ids, json_path = ann_fp, 
+                    image_folder = img_fp, fig_size = (max(fig_size)+1,max(fig_size)+1), text_on = True, 
+                    fig_titles = fig_titles)
+        return
+
+    display.show_ims(im_ids, stream_gt_subset(ann_fp, stats, im_ids), img_fp, (max(fig_size)+1,max(fig_size)+1),
+                     text_on = True, fig_titles = fig_titles)
+    return
+
+def stream_gt_subset(ann_fp, stats, im_ids):
+    '''
+    IN:
+        - ann_fp: path to coco gt file
+        - stats: output of stream_stats for ann_fp
+        - im_ids: ids of the images to keep
+    OUT:
+        - gt: coco contents with only those images and their annotations, streamed from ann_fp
+    '''
+    keep = set(i.item() if hasattr(i, 'item') else i for i in im_ids)
+    return {
+        'images': [i for i in stats['images'] if i['id'] in keep],
+        'categories': stats['categories'],
+        'annotations': [a for a in stream.iter_array(ann_fp, 'annotations') if a['image_id'] in keep]
+    }
+
+'''######################## Out-of-Core Statistics ######################## '''
+
+# Bin edges used for the box size histograms, the first and last bins also collect anything out of range
+SIZE_BINS = {
+    'width': np.geomspace(1, 1e4, 41),
+    'height': np.geomspace(1, 1e4, 41),
+    'area': np.geomspace(1, 1e8, 41),
+    'aspect': np.geomspace(1e-2, 1e2, 41)
+}
+
+def make_sketch(n_rows, rel_acc = 0.01, min_value = 1e-3, max_value = 1e9):
+    '''
+    PURPOSE: Create a set of mergeable quantile sketches (log-bucketed, DDSketch style), one per row
+    IN:
+        - n_rows: int, number of independent sketches, e.g. one per category
+        - rel_acc: float, relative accuracy of every quantile estimate
+        - min_value, max_value: values outside this range are clipped to it
+    OUT:
+        - sketch: dict with the bucket counts and the parameters needed to read them
+    '''
+    gamma = (1 + rel_acc)/(1 - rel_acc)
+    offset = int(np.floor(np.log(min_value)/np.log(gamma)))
+    n_buckets = int(np.ceil(np.log(max_value)/np.log(gamma))) - offset + 1
+    sketch = {
+        'gamma': gamma,
+        'offset': offset,
+        'counts': np.zeros((n_rows, n_buckets), dtype = np.int64)
+    }
+    return sketch
+
+def update_sketch(sketch, rows, values):
+    '''
+    IN:
+        - sketch: dict from make_sketch, updated in place
+        - rows: int array, the sketch row each value belongs to
+        - values: float array of positive values
+    '''
+    values = np.asarray(values, dtype = float)
+    keep = ~np.isnan(values)
+    rows = np.asarray(rows)[keep]
+    values = values[keep]
+    n_buckets = sketch['counts'].shape[1]
+
+    with np.errstate(divide = 'ignore'):
+        idx = np.ceil(np.log(values)/np.log(sketch['gamma']))
+    idx = np.clip(np.nan_to_num(idx, neginf = 0, posinf = n_buckets + sketch['offset']) - sketch['offset'], 0, n_buckets - 1)
+    np.add.at(sketch['counts'], (rows, idx.astype(np.int64)), 1)
+    return
+
+def merge_sketches(sketch_a, sketch_b):
+    '''
+    IN: two sketches created with the same parameters, e.g. from two chunks or two files
+    OUT: a new sketch summarizing the values of both
+    '''
+    merged = sketch_a.copy()
+    merged['counts'] = sketch_a['counts'] + sketch_b['counts']
+    return merged
+
+def sketch_quantiles(sketch, qs):
+    '''
+    IN:
+        - sketch: dict from make_sketch
+        - qs: list of float quantiles between 0 and 1
+    OUT:
+        - array of shape (n_rows, len(qs)) of approximate quantiles, nan for empty rows
+    '''
+    counts = sketch['counts']
+    cum = np.cumsum(counts, axis = 1)
+    totals = cum[:, -1]
+    gamma = sketch['gamma']
+
+    out = np.full((counts.shape[0], len(qs)), np.nan)
+    for j, q in enumerate(qs):
+        rank = q*(totals - 1)
+        idx = np.argmax(cum > rank[:, None], axis = 1) + sketch['offset']
+        out[:, j] = np.where(totals > 0, 2*gamma**idx/(gamma + 1), np.nan)
+    return out
+
+def id_lookup(ids, query):
+    '''
+    IN:
+        - ids: array of ids in their original order
+        - query: array of ids to find
+    OUT:
+        - array of positions of each query id in ids, -1 where it is missing
+    '''
+    if len(ids) == 0:
+        return np.full(len(query), -1)
+    order = np.argsort(ids, kind = 'stable')
+    sorted_ids = ids[order]
+    pos = np.clip(np.searchsorted(sorted_ids, query), 0, len(ids) - 1)
+    return np.where(sorted_ids[pos] == query, order[pos], -1)
+
+def binned_counts(rows, values, edges, n_rows):
+    '''
+    IN:
+        - rows: int array, the output row of each value (e.g. category index)
+        - values: float array, nan values are ignored
+        - edges: bin edges, the first and last bins also collect anything out of range
+        - n_rows: int, number of output rows
+    OUT:
+        - int array of shape (n_rows, len(edges) - 1) of counts
+    '''
+    values = np.asarray(values, dtype = float)
+    keep = ~np.isnan(values)
+    idx = np.searchsorted(edges, np.nan_to_num(values[keep], posinf = edges[-1]), side = 'right') - 1
+    idx = np.clip(idx, 0, len(edges) - 2)
+    counts = np.zeros((n_rows, len(edges) - 1), dtype = np.int64)
+    np.add.at(counts, (np.asarray(rows)[keep], idx), 1)
+    return counts
+
+def stream_stats(ann_fp, chunk_size = 100000, rel_acc = 0.01):
+    '''
+    PURPOSE: Collect the statistics behind get_im_df and get_cat_df without loading the annotations,
+    reading them in chunks so that memory depends on the number of images and categories only
+    IN:
+        - ann_fp: path to coco gt file
+        - chunk_size: int, number of annotations processed at once
+        - rel_acc: float, relative accuracy of the box size quantiles
+    OUT:
+        - stats: dict of accumulated counts, histograms and quantile sketches
+    '''
+    contents = stream.load_except(ann_fp, skip = ('annotations',))
+    images = contents['images']
+    categories = contents['categories']
+    im_ids = np.array([i['id'] for i in images])
+    cat_ids = np.array([c['id'] for c in categories])
+
+    stats = {
+        'images': images,
+        'categories': categories,
+        'n_anns': 0,
+        'cat_totals': np.zeros(len(categories), dtype = np.int64),
+        'im_cat_counts': np.zeros((len(images), len(categories)), dtype = np.int32),
+        'hists': {m: np.zeros((len(categories), len(b) - 1), dtype = np.int64) for m, b in SIZE_BINS.items()},
+        'sketches': {m: make_sketch(len(categories), rel_acc) for m in SIZE_BINS}
+    }
+
+    for chunk in tqdm(stream.iter_chunks(ann_fp, 'annotations', chunk_size), desc = 'Streaming annotations'):
+        stats['n_anns'] += len(chunk)
+
+        a_ims = id_lookup(im_ids, np.array([a['image_id'] for a in chunk]))
+        a_cats = id_lookup(cat_ids, np.array([a['category_id'] for a in chunk]))
+        boxes = np.array([a['bbox'] for a in chunk], dtype = float).reshape(-1, 4)
+
+        # Category totals include annotations whose image is missing, like value_counts on get_ann_df
+        known_cat = a_cats >= 0
+        stats['cat_totals'] += np.bincount(a_cats[known_cat], minlength = len(categories))
+
+        on_im = known_cat & (a_ims >= 0)
+        np.add.at(stats['im_cat_counts'], (a_ims[on_im], a_cats[on_im]), 1)
+
+        # Box sizes
+        w = boxes[known_cat, 2]
+        h = boxes[known_cat, 3]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            sizes = {'width': w, 'height': h, 'area': w*h, 'aspect': w/h}
+        rows = a_cats[known_cat]
+        for m, v in sizes.items():
+            stats['hists'][m] += binned_counts(rows, v, SIZE_BINS[m], len(categories))
+            update_sketch(stats['sketches'][m], rows, v)
+
+    return stats
+
+def stream_im_df(stats):
+    '''
+    Create the same dataframe as get_im_df from the output of stream_stats
+    '''
+    im_df = pd.DataFrame(stats['images'])
+    im_df['pixel_area'] = im_df['width']*im_df['height']
+
+    # per-category columns for every category that has annotations, as in get_im_df
+    counts = stats['im_cat_counts']
+    present = stats['cat_totals'] > 0
+    names = [c['name'] for c in stats['categories']]
+    for j in np.flatnonzero(present):
+        im_df[names[j]] = counts[:, j]
+
+    im_df['Total Categories'] = np.count_nonzero(counts, axis = 1)
+    im_df['Total Annotations'] = counts.sum(axis = 1)
+    im_df = im_df.set_index('file_name')
+
+    return im_df
+
+def stream_cat_cm(stats, block = 65536):
+    '''
+    Create the same category co-existence matrix as get_cat_cm from the output of stream_stats
+    '''
+    counts = stats['im_cat_counts']
+    present = stats['cat_totals'] > 0
+    names = [c['name'] for c, p in zip(stats['categories'], present) if p]
+
+    # Work through the images in blocks so the boolean matrix is never copied whole
+    cm = np.zeros((present.sum(), present.sum()), dtype = np.int64)
+    for start in range(0, len(counts), block):
+        on_im = (counts[start:start + block, present] > 0).astype(np.int64)
+        cm += on_im.T @ on_im
+
+    category_cm_df = pd.DataFrame(cm, index = names, columns = names)
+    return category_cm_df
+
+def stream_cat_df(stats):
+    '''
+    Create the same dataframe as get_cat_df from the output of stream_stats
+    '''
+    cat_df = pd.DataFrame(stats['categories'])
+    cat_df['Images with Category'] = np.count_nonzero(stats['im_cat_counts'], axis = 0)
+    cat_df['Total In Dataset'] = stats['cat_totals']
+    cat_df.sort_values(['supercategory', 'name'],inplace=True)
+    cat_df.set_index('name', inplace=True)
+
+    return cat_df
+
+def stream_size_df(stats, qs = (0.05, 0.25, 0.5, 0.75, 0.95)):
+    '''
+    IN:
+        - stats: output of stream_stats
+        - qs: quantiles to estimate
+    OUT:
+        - dataframe of approximate box width, height, area and aspect quantiles, one row per category
+    '''
+    names = [c['name'] for c in stats['categories']]
+    frames = {}
+    for m, sketch in stats['sketches'].items():
+        frames[m] = pd.DataFrame(sketch_quantiles(sketch, qs), index = names, columns = list(qs))
+    size_df = pd.concat(frames, axis = 1)
+    return size_df[stats['cat_totals'] > 0]
+
+def stream_hist_df(stats, metric):
+    '''
+    IN:
+        - stats: output of stream_stats
+        - metric: one of 'width', 'height', 'area', 'aspect'
+    OUT:
+        - dataframe of box counts, one row per category and one column per bin (named by lower edge)
+    '''
+    names = [c['name'] for c in stats['categories']]
+    hist_df = pd.DataFrame(stats['hists'][metric], index = names, columns = SIZE_BINS[metric][:-1])
+    return hist_df[stats['cat_totals'] > 0]
+
+def eda_stream(ann_fp, img_fp, fig_size = (10,7), font_size = 10, return_dfs = False, chunk_size = 100000):
+    '''
+    Give the user the same information as eda, for annotation files too large to load into pandas
+    '''
+    stats = stream_stats(ann_fp, chunk_size = chunk_size)
+    im_df = stream_im_df(stats)
+    cat_df = stream_cat_df(stats)
+
+    # number of unique things in the dataset
+    n_ims = im_df.index.nunique()
+    n_anns = stats['n_anns']
+    n_cats = int((stats['cat_totals'] > 0).sum())
+
+    meta_df = pd.DataFrame([[n_ims, n_anns, n_cats]], columns=['Total Images','Total Annotations','Total Categories'])
+
+    print(tabulate(meta_df, headers='keys', tablefmt='psql', showindex=False))
+
+    # approximate box size quantiles
+    print(tabulate(stream_size_df(stats, qs = (0.5,)).round(2), headers='keys', tablefmt='psql'))
+
+    # create a bar graph of various category counts
+    counts = cat_df['Total In Dataset']
+    plot_category_counts(counts[counts > 0].sort_values(ascending=False), fig_size, font_size)
+
+    # Show the images with the most total annotations and most categories represented
+    show_ims_most_anns_cats(im_df, ann_fp, img_fp, fig_size, stats = stats)
+
+    # Display a heatmap of how often various categories coexist on imagery
+    plot_cat_cm(stream_cat_cm(stats))
+
+    if return_dfs:
+      return cat_df, im_df
     return
 
+'''######################### Object Size and GSD ######################### '''
 
-def eda(ann_fp, img_fp, fig_size = (10,7), font_size = 10, return_dfs = False):
+# Bin edges used for box sizes measured in meters (bbox x gsd)
+SIZE_BINS_M = {
+    'width': np.geomspace(0.1, 1e3, 41),
+    'height': np.geomspace(0.1, 1e3, 41),
+    'area': np.geomspace(1e-2, 1e6, 41),
+    'aspect': np.geomspace(1e-2, 1e2, 41)
+}
+
+GSD_BINS = [0, 0.15, 0.3, 0.5, 0.75, 1, 2, 5, np.inf]
+
+def as_gsd(value):
+    '''
+    Image gsd as a float, nan when it is missing (None, or the False placeholder some converters use)
+    '''
+    if value is None or isinstance(value, bool):
+        return np.nan
+    return float(value)
+
+def get_size_arrays(ann_fp):
+    '''
+    PURPOSE: Pull the boxes, image sizes and image gsd values of a coco file into arrays
+    IN:
+        - ann_fp: path to coco gt file
+    OUT:
+        - arrays: dict with categories, images, per-image width/height/gsd, and per-annotation image index,
+                  category index, bbox and gsd (indices are -1 where the image or category is missing)
+    '''
+    with open(ann_fp, 'r') as f:
+        content = json.load(f)
+    images = content['images']
+    categories = content['categories']
+    annotations = content['annotations']
+
+    im_gsd = np.array([as_gsd(i.get('gsd')) for i in images], dtype = float)
+    ann_im = id_lookup(np.array([i['id'] for i in images]), np.array([a['image_id'] for a in annotations]))
+    ann_cat = id_lookup(np.array([c['id'] for c in categories]), np.array([a['category_id'] for a in annotations]))
+
+    arrays = {
+        'categories': categories,
+        'images': images,
+        'im_w': np.array([i['width'] for i in images], dtype = float),
+        'im_h': np.array([i['height'] for i in images], dtype = float),
+        'im_gsd': im_gsd,
+        'ann_im': ann_im,
+        'ann_cat': ann_cat,
+        'bbox': np.array([a['bbox'] for a in annotations], dtype = float).reshape(-1, 4),
+        'ann_gsd': np.where(ann_im >= 0, im_gsd[ann_im], np.nan)
+    }
+    return arrays
+
+def box_sizes(arrays, units = 'px'):
+    '''
+    IN:
+        - arrays: output of get_size_arrays
+        - units: 'px' for pixels, or 'm' for meters (bbox x gsd, nan where gsd is missing)
+    OUT:
+        - dict of width, height, area and aspect arrays, one value per annotation
+    '''
+    w = arrays['bbox'][:, 2]
+    h = arrays['bbox'][:, 3]
+    if units == 'm':
+        w = w*arrays['ann_gsd']
+        h = h*arrays['ann_gsd']
+    elif units != 'px':
+        raise ValueError(f'units must be px or m, not {units}')
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        sizes = {'width': w, 'height': h, 'area': w*h, 'aspect': w/h}
+    return sizes
+
+def size_hists(arrays, units = 'px'):
+    '''
+    PURPOSE: Per-category histograms of box width, height, area and aspect
+    IN:
+        - arrays: output of get_size_arrays
+        - units: 'px' or 'm'
+    OUT:
+        - dict of dataframes, one per size measure, with a row per category and a column per bin (lower edge)
+    '''
+    bins = SIZE_BINS if units == 'px' else SIZE_BINS_M
+    names = [c['name'] for c in arrays['categories']]
+    known = arrays['ann_cat'] >= 0
+
+    hists = {}
+    for m, v in box_sizes(arrays, units).items():
+        counts = binned_counts(arrays['ann_cat'][known], v[known], bins[m], len(names))
+        hists[m] = pd.DataFrame(counts, index = names, columns = bins[m][:-1])
+    return hists
+
+def gsd_bucket_counts(arrays, gsd_bins = GSD_BINS):
+    '''
+    PURPOSE: Count objects of each category, and images, falling into each gsd range
+    IN:
+        - arrays: output of get_size_arrays
+        - gsd_bins: list of gsd bucket edges in meters
+    OUT:
+        - dataframe with a row per category plus 'Images', and a column per gsd bucket plus 'No GSD'
+    '''
+    edges = np.asarray(gsd_bins, dtype = float)
+    labels = [f'[{edges[i]:g}, {edges[i+1]:g})' for i in range(len(edges) - 1)] + ['No GSD']
+    names = [c['name'] for c in arrays['categories']]
+
+    def bucket(gsd):
+        idx = np.clip(np.searchsorted(edges, np.nan_to_num(gsd, nan = -1), side = 'right') - 1, 0, len(edges) - 2)
+        return np.where(np.isnan(gsd), len(edges) - 1, idx)
+
+    known = arrays['ann_cat'] >= 0
+    counts = np.zeros((len(names), len(labels)), dtype = np.int64)
+    np.add.at(counts, (arrays['ann_cat'][known], bucket(arrays['ann_gsd'][known])), 1)
+    im_counts = np.bincount(bucket(arrays['im_gsd']), minlength = len(labels))
+
+    gsd_df = pd.DataFrame(np.vstack([counts, im_counts]), index = names + ['Images'], columns = labels)
+    return gsd_df
+
+def object_density(arrays):
+    '''
+    PURPOSE: Objects per square kilometer on each image, overall and per category
+    IN:
+        - arrays: output of get_size_arrays
+    OUT:
+        - dataframe indexed by file_name with gsd, ground area in km2, total and per-category densities
+          (nan for images without a gsd)
+    '''
+    names = [c['name'] for c in arrays['categories']]
+    n_ims = len(arrays['images'])
+    known = (arrays['ann_cat'] >= 0) & (arrays['ann_im'] >= 0)
+
+    counts = np.zeros((n_ims, len(names)), dtype = np.int64)
+    np.add.at(counts, (arrays['ann_im'][known], arrays['ann_cat'][known]), 1)
+    area_km2 = arrays['im_w']*arrays['im_h']*arrays['im_gsd']**2/1e6
+
+    density_df = pd.DataFrame(counts/area_km2[:, None], columns = names)
+    density_df.insert(0, 'Total Density', counts.sum(axis = 1)/area_km2)
+    density_df.insert(0, 'Total Annotations', counts.sum(axis = 1))
+    density_df.insert(0, 'area_km2', area_km2)
+    density_df.insert(0, 'gsd', arrays['im_gsd'])
+    density_df.index = pd.Index([i['file_name'] for i in arrays['images']], name = 'file_name')
+    return density_df
+
+def size_at_gsd(arrays, target_gsds, qs = (0.05, 0.5, 0.95), chip_size = None):
+    '''
+    PURPOSE: Preview object sizes in pixels after gsd_norm to each candidate target gsd
+    IN:
+        - arrays: output of get_size_arrays
+        - target_gsds: list of candidate gsd values in meters
+        - qs: quantiles of box width and height to report
+        - chip_size: optional int, also report the fraction of boxes with a side longer than a chip
+    OUT:
+        - dataframe indexed by (target gsd, category) of pixel width/height quantiles
+    '''
+    sizes = box_sizes(arrays, 'm')
+    names = [c['name'] for c in arrays['categories']]
+    has_gsd = ~np.isnan(sizes['width']) & (arrays['ann_cat'] >= 0)
+    cats = arrays['ann_cat'][has_gsd]
+    w = sizes['width'][has_gsd]
+    h = sizes['height'][has_gsd]
+
+    # Sort once by category so each category is a contiguous slice
+    order = np.argsort(cats, kind = 'stable')
+    cats, w, h = cats[order], w[order], h[order]
+    starts = np.searchsorted(cats, np.arange(len(names) + 1))
+
+    rows = []
+    for t in target_gsds:
+        for j, name in enumerate(names):
+            cw = w[starts[j]:starts[j+1]]/t
+            ch = h[starts[j]:starts[j+1]]/t
+            if len(cw) == 0:
+                continue
+            row = {'target_gsd': t, 'category': name, 'count': len(cw)}
+            for q, vw, vh in zip(qs, np.quantile(cw, qs), np.quantile(ch, qs)):
+                row[f'width_q{q:g}'] = vw
+                row[f'height_q{q:g}'] = vh
+            if chip_size is not None:
+                row[f'frac_over_{chip_size}'] = np.mean(np.maximum(cw, ch) > chip_size)
+            rows.append(row)
+
+    return pd.DataFrame(rows).set_index(['target_gsd', 'category'])
+
+def size_gsd_eda(ann_fp, units = 'm', gsd_bins = GSD_BINS, fig_size = (10,7)):
+    '''
+    Give the user an overview of object sizes and image gsd values in their dataset
+    '''
+    arrays = get_size_arrays(ann_fp)
+
+    # how many objects and images fall in each gsd range
+    print(tabulate(gsd_bucket_counts(arrays, gsd_bins), headers='keys', tablefmt='psql'))
+
+    # median size of each category
+    size_df = pd.DataFrame(box_sizes(arrays, units))
+    size_df['category_name'] = [arrays['categories'][c]['name'] if c >= 0 else None for c in arrays['ann_cat']]
+    print(tabulate(size_df.groupby('category_name').median(), headers='keys', tablefmt='psql'))
+
+    # density of objects on the ground
+    density_df = object_density(arrays)
+    print(tabulate(density_df[['gsd', 'area_km2', 'Total Annotations', 'Total Density']].describe(), headers='keys', tablefmt='psql'))
+
+    # per-category area histograms
+    hist_df = size_hists(arrays, units)['area']
+    hist_df = hist_df[hist_df.sum(axis=1) > 0]
+    fig, ax = plt.subplots(figsize=fig_size)
+    a = sns.heatmap(hist_df, ax=ax, xticklabels=[f'{e:.3g}' for e in hist_df.columns])
+    a = plt.title(f'Object Area Histogram By Category ({units}^2)')
+
+    return
+
+
+def eda(ann_fp, img_fp, fig_size = (10,7), font_size = 10, return_dfs = False, stream = False, chunk_size = 100000):
     '''
     Give the user some general information about their dataset
+    If stream is True, annotations are read in chunks of chunk_size and eda_stream is used instead
     '''
+    if stream:
+      return eda_stream(ann_fp, img_fp, fig_size, font_size, return_dfs, chunk_size)
+
     ann_df = get_ann_df(ann_fp)
     im_df = get_im_df(ann_fp)
 
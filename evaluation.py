@@ -0,0 +1,663 @@
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+cwd = os.getcwd() + '/hot_coco'
+if os.path.exists(cwd):
+    sys.path.append(cwd)
+
+import display as display
+
+'''########################### Helper Functions ########################### '''
+
+def box_iou(boxes_a, boxes_b):
+    '''
+    IN:
+        - boxes_a: array of shape (n, 4) of coco [x, y, w, h] boxes
+        - boxes_b: array of shape (m, 4) of coco [x, y, w, h] boxes
+    OUT:
+        - array of shape (n, m) of the intersection over union of every pair
+    '''
+    a = np.asarray(boxes_a, dtype = float).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype = float).reshape(-1, 4)
+
+    ix1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    iy1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    ix2 = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2])
+    iy2 = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3])
+    inter = np.clip(ix2 - ix1, 0, None)*np.clip(iy2 - iy1, 0, None)
+
+    union = (a[:, 2]*a[:, 3])[:, None] + (b[:, 2]*b[:, 3])[None, :] - inter
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        iou = np.where(union > 0, inter/union, 0.0)
+    return iou
+
+def load_gt(gt_path):
+    '''
+    IN: path to coco gt json, or its already loaded contents
+    OUT: loaded contents
+    '''
+    if isinstance(gt_path, dict):
+        return gt_path
+    with open(gt_path, 'r') as f:
+        return json.load(f)
+
+def load_dt(dt_path):
+    '''
+    IN: path to coco dt json, or an index from display.index_dt
+    OUT: an index from display.index_dt
+    '''
+    if isinstance(dt_path, dict):
+        return dt_path
+    return display.index_dt(dt_path)
+
+'''############################### Matching ############################### '''
+
+def match_image(gt_boxes, gt_cats, dt_boxes, dt_cats, dt_scores, iou_thresh = 0.5):
+    '''
+    PURPOSE: Greedily match the detections on one image to its gt boxes of the same category,
+    highest score first, each taking the unmatched gt box it overlaps most
+    IN:
+        - gt_boxes, gt_cats: arrays of gt boxes (n, 4) and category ids (n,)
+        - dt_boxes, dt_cats, dt_scores: arrays of detection boxes (m, 4), category ids and scores (m,)
+        - iou_thresh: minimum IoU for a match
+    OUT:
+        - dt_match: int array (m,), index of the matched gt box, -1 for false positives
+        - dt_iou: float array (m,), IoU with the matched gt box, 0 for false positives
+        - gt_match: int array (n,), index of the matched detection, -1 for false negatives
+    '''
+    dt_match = np.full(len(dt_scores), -1)
+    dt_iou = np.zeros(len(dt_scores))
+    gt_match = np.full(len(gt_cats), -1)
+    if len(gt_cats) == 0 or len(dt_scores) == 0:
+        return dt_match, dt_iou, gt_match
+
+    # Only compare boxes within a category, which keeps every IoU matrix small
+    for c in np.intersect1d(np.unique(gt_cats), np.unique(dt_cats)):
+        g = np.flatnonzero(gt_cats == c)
+        d = np.flatnonzero(dt_cats == c)
+        d = d[np.argsort(-dt_scores[d], kind = 'stable')]
+        iou = box_iou(dt_boxes[d], gt_boxes[g])
+
+        # Detections that overlap nothing enough can never match, so skip them up front
+        free = np.ones(len(g), dtype = bool)
+        for k in np.flatnonzero(iou.max(axis = 1) >= iou_thresh):
+            row = np.where(free, iou[k], -1)
+            j = np.argmax(row)
+            if row[j] >= iou_thresh:
+                free[j] = False
+                dt_match[d[k]] = g[j]
+                dt_iou[d[k]] = row[j]
+                gt_match[g[j]] = d[k]
+
+    return dt_match, dt_iou, gt_match
+
+def match(gt_path, dt_path, iou_thresh = 0.5, conf_thresh = None):
+    '''
+    PURPOSE: Match every detection in a dataset to its ground truth, one image at a time
+    IN:
+        - gt_path: coco gt file (or loaded contents)
+        - dt_path: coco dt file (or an index from display.index_dt)
+        - iou_thresh: minimum IoU for a match
+        - conf_thresh: optional minimum score, lower scoring detections are ignored
+    OUT:
+        - dt_df: dataframe with one row per detection: image_id, category_id, score, bbox columns,
+                 status ('TP' or 'FP'), gt_id (matched annotation id, -1 if none) and iou
+        - gt_df: dataframe with one row per gt annotation: id, image_id, category_id, bbox columns,
+                 status ('TP' or 'FN') and dt_score (score of the matched detection, nan if none)
+    '''
+    gt = load_gt(gt_path)
+    dt_index = load_dt(dt_path)
+    gt_by_im = display.index_anns(gt['annotations'])
+
+    # Detections on images missing from the gt are still reported, as false positives
+    im_ids = [i['id'] for i in gt['images']]
+    known = set(im_ids)
+    im_ids += [i for i in dt_index if i not in known]
+
+    dt_parts = []
+    gt_parts = []
+    for im_id in tqdm(im_ids, desc = 'Matching'):
+        anns = gt_by_im.get(im_id, [])
+        gt_boxes, gt_cats = display.ann_arrays(anns)
+        gt_ids = np.array([a['id'] for a in anns], dtype = np.int64)
+        dt_boxes, dt_cats, dt_scores = display.dt_on_image(im_id, dt_index, conf_thresh)
+
+        dt_match, dt_iou, gt_match = match_image(gt_boxes, gt_cats, dt_boxes, dt_cats, dt_scores, iou_thresh)
+
+        if len(dt_scores):
+            dt_parts.append((np.full(len(dt_scores), im_id), dt_cats, dt_scores, dt_boxes,
+                             np.where(dt_match >= 0, gt_ids[np.maximum(dt_match, 0)] if len(gt_ids) else -1, -1), dt_iou))
+        if len(gt_ids):
+            gt_parts.append((gt_ids, np.full(len(gt_ids), im_id), gt_cats, gt_boxes,
+                             np.where(gt_match >= 0, dt_scores[np.maximum(gt_match, 0)] if len(dt_scores) else np.nan, np.nan)))
+
+    dt_df = match_frame(dt_parts, ['image_id', 'category_id', 'score', 'bbox', 'gt_id', 'iou'])
+    dt_df['status'] = np.where(dt_df['gt_id'] >= 0, 'TP', 'FP')
+    gt_df = match_frame(gt_parts, ['id', 'image_id', 'category_id', 'bbox', 'dt_score'])
+    gt_df['status'] = np.where(gt_df['dt_score'].notna(), 'TP', 'FN')
+
+    return dt_df, gt_df
+
+def match_frame(parts, columns):
+    '''
+    Stack per-image arrays into one dataframe, spreading 'bbox' into x, y, w and h columns
+    '''
+    data = {}
+    for k, c in enumerate(columns):
+        arrays = [p[k] for p in parts]
+        if c == 'bbox':
+            boxes = np.concatenate(arrays) if arrays else np.zeros((0, 4))
+            for j, b in enumerate(['x', 'y', 'w', 'h']):
+                data[b] = boxes[:, j]
+        else:
+            data[c] = np.concatenate(arrays) if arrays else np.zeros(0)
+    return pd.DataFrame(data)
+
+def match_summary(dt_df, gt_df, gt_path = None):
+    '''
+    IN:
+        - dt_df, gt_df: output of match
+        - gt_path: optional coco gt file (or loaded contents), to name the categories
+    OUT:
+        - dataframe of TP, FP, FN, precision and recall per category, plus an 'All' row
+    '''
+    tp = dt_df[dt_df['status'] == 'TP'].groupby('category_id').size()
+    fp = dt_df[dt_df['status'] == 'FP'].groupby('category_id').size()
+    fn = gt_df[gt_df['status'] == 'FN'].groupby('category_id').size()
+
+    summary = pd.DataFrame({'TP': tp, 'FP': fp, 'FN': fn}).fillna(0).astype(int)
+    summary.loc['All'] = summary.sum()
+    summary['precision'] = summary['TP']/(summary['TP'] + summary['FP']).replace(0, np.nan)
+    summary['recall'] = summary['TP']/(summary['TP'] + summary['FN']).replace(0, np.nan)
+
+    if gt_path is not None:
+        names = display.get_category_names(load_gt(gt_path))
+        summary.index = [names.get(c, c) for c in summary.index]
+    return summary
+
+'''############################## Evaluation ############################## '''
+
+# IoU thresholds and recall points of the standard coco evaluation
+IOU_THRS = np.linspace(0.5, 0.95, 10)
+REC_THRS = np.linspace(0, 1, 101)
+
+# Object size ranges by pixel area, as in the coco evaluation
+AREA_RNGS = {'all': (0, np.inf), 'small': (0, 32**2), 'medium': (32**2, 96**2), 'large': (96**2, np.inf)}
+
+def evaluate_image(gt_boxes, gt_areas, gt_crowd, dt_boxes, dt_areas, iou_thrs = IOU_THRS, area_rngs = AREA_RNGS):
+    '''
+    PURPOSE: coco style matching of one image's detections (of one category, sorted by score) for
+    every IoU threshold and object size range at once
+    IN:
+        - gt_boxes, gt_areas, gt_crowd: gt boxes (n, 4), areas (n,) and crowd flags (n,)
+        - dt_boxes, dt_areas: detection boxes (m, 4) and areas (m,), highest score first
+        - iou_thrs: IoU thresholds
+        - area_rngs: dict of object size ranges
+    OUT:
+        - dt_tp: bool array (n_areas, n_thrs, m), detection matched a gt box
+        - dt_ig: bool array (n_areas, n_thrs, m), detection is ignored (matched an ignored gt box,
+                 or unmatched and outside the size range)
+        - n_gt: int array (n_areas,), number of gt boxes that are not ignored
+    '''
+    rngs = list(area_rngs.values())
+    n_d = len(dt_areas)
+    dt_tp = np.zeros((len(rngs), len(iou_thrs), n_d), dtype = bool)
+    dt_ig = np.zeros((len(rngs), len(iou_thrs), n_d), dtype = bool)
+    n_gt = np.zeros(len(rngs), dtype = np.int64)
+
+    iou = box_iou(dt_boxes, gt_boxes)
+    if len(gt_crowd):
+        # Crowd regions count any detection inside them, so use the detection's area as the union.
+        # The intersection comes back from the box IoU, so it needs box areas, not the gt 'area'
+        # (a polygon's area for rotated datasets)
+        gt_box_areas = gt_boxes[:, 2]*gt_boxes[:, 3]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            inter = iou*((dt_areas[:, None] + gt_box_areas[None, :]))/(1 + iou)
+            crowd_iou = np.where(dt_areas[:, None] > 0, inter/dt_areas[:, None], 0)
+        iou = np.where(gt_crowd[None, :], crowd_iou, iou)
+
+    for a, (lo, hi) in enumerate(rngs):
+        gt_ig = gt_crowd | (gt_areas < lo) | (gt_areas > hi)
+        n_gt[a] = np.count_nonzero(~gt_ig)
+        dt_out = (dt_areas < lo) | (dt_areas > hi)
+
+        for t, thr in enumerate(iou_thrs):
+            thr = min(thr, 1 - 1e-10)
+            taken = np.zeros(len(gt_areas), dtype = bool)
+            for d in range(n_d):
+                # Prefer the best free gt box that is not ignored, then the best ignored one
+                row = np.where((taken & ~gt_crowd) | (iou[d] < thr), -1, iou[d])
+                if not len(row) or row.max() < 0:
+                    continue
+                real = np.where(gt_ig, -1, row)
+                j = np.argmax(real) if real.max() >= 0 else np.argmax(row)
+                taken[j] = True
+                dt_tp[a, t, d] = True
+                dt_ig[a, t, d] = gt_ig[j]
+            dt_ig[a, t] |= ~dt_tp[a, t] & dt_out
+
+    return dt_tp, dt_ig, n_gt
+
+def accumulate(scores, dt_tp, dt_ig, n_gt):
+    '''
+    IN:
+        - scores: float array (m,) of detection scores
+        - dt_tp, dt_ig: bool arrays (n_thrs, m) from evaluate_image, concatenated across images
+        - n_gt: int, total number of gt boxes that are not ignored
+    OUT:
+        - ap: float array (n_thrs,) of interpolated average precision, nan when there is no gt
+        - ar: float array (n_thrs,) of maximum recall, nan when there is no gt
+    '''
+    n_thrs = dt_tp.shape[0]
+    if n_gt == 0:
+        return np.full(n_thrs, np.nan), np.full(n_thrs, np.nan)
+
+    order = np.argsort(-scores, kind = 'mergesort')
+    keep = ~dt_ig[:, order]
+    tps = np.cumsum(dt_tp[:, order] & keep, axis = 1)
+    fps = np.cumsum(~dt_tp[:, order] & keep, axis = 1)
+
+    rc = tps/n_gt
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        pr = np.nan_to_num(tps/(tps + fps))
+    # Make precision monotonically decreasing, then read it at each recall point
+    pr = np.maximum.accumulate(pr[:, ::-1], axis = 1)[:, ::-1]
+
+    ap = np.zeros(n_thrs)
+    ar = np.zeros(n_thrs)
+    for t in range(n_thrs):
+        if rc.shape[1] == 0:
+            continue
+        idx = np.searchsorted(rc[t], REC_THRS, side = 'left')
+        q = np.where(idx < rc.shape[1], pr[t][np.minimum(idx, rc.shape[1] - 1)], 0)
+        ap[t] = q.mean()
+        ar[t] = rc[t, -1]
+    return ap, ar
+
+def evaluate_category(task):
+    '''
+    PURPOSE: Evaluate one category over every image, every size range and every image gsd bucket
+    IN:
+        - task: dict of this category's gt and dt arrays, sorted by image (dt by descending score
+                within an image), with 'im_bucket' giving each image's gsd bucket and 'n_buckets'
+    OUT:
+        - dict of ap and ar arrays of shape (n_areas, n_thrs) overall, and (n_buckets, n_thrs) per
+          gsd bucket for the 'all' size range
+    '''
+    g_im, d_im = task['gt_im'], task['dt_im']
+    ims = np.union1d(g_im, d_im)
+    g_start = np.searchsorted(g_im, ims)
+    g_end = np.searchsorted(g_im, ims, side = 'right')
+    d_start = np.searchsorted(d_im, ims)
+    d_end = np.searchsorted(d_im, ims, side = 'right')
+
+    scores, tps, igs, bucket = [], [], [], []
+    n_gt = np.zeros((len(AREA_RNGS), task['n_buckets']), dtype = np.int64)
+    for i, gs, ge, ds, de in zip(ims, g_start, g_end, d_start, d_end):
+        de = min(de, ds + task['max_dets'])
+        dt_tp, dt_ig, im_n_gt = evaluate_image(task['gt_boxes'][gs:ge], task['gt_areas'][gs:ge], task['gt_crowd'][gs:ge],
+                                               task['dt_boxes'][ds:de], task['dt_areas'][ds:de])
+        b = task['im_bucket'][i]
+        n_gt[:, b] += im_n_gt
+        scores.append(task['dt_scores'][ds:de])
+        tps.append(dt_tp)
+        igs.append(dt_ig)
+        bucket.append(np.full(de - ds, b))
+
+    n_a, n_t = len(AREA_RNGS), len(IOU_THRS)
+    scores = np.concatenate(scores) if scores else np.zeros(0)
+    tps = np.concatenate(tps, axis = 2) if tps else np.zeros((n_a, n_t, 0), dtype = bool)
+    igs = np.concatenate(igs, axis = 2) if igs else np.zeros((n_a, n_t, 0), dtype = bool)
+    bucket = np.concatenate(bucket) if bucket else np.zeros(0, dtype = int)
+
+    result = {
+        'ap': np.zeros((n_a, n_t)), 'ar': np.zeros((n_a, n_t)),
+        'gsd_ap': np.zeros((task['n_buckets'], n_t)), 'gsd_ar': np.zeros((task['n_buckets'], n_t))
+    }
+    for a in range(n_a):
+        result['ap'][a], result['ar'][a] = accumulate(scores, tps[a], igs[a], n_gt[a].sum())
+    for b in range(task['n_buckets']):
+        sel = bucket == b
+        result['gsd_ap'][b], result['gsd_ar'][b] = accumulate(scores[sel], tps[0][:, sel], igs[0][:, sel], n_gt[0, b])
+    return result
+
+def category_tasks(gt, dt_index, gsd_bins, max_dets):
+    '''
+    PURPOSE: Split a dataset into one evaluate_category task per category, with vectorized sorting
+    OUT:
+        - tasks: list of task dicts, in the order of gt['categories']
+        - bucket_labels: list of gsd bucket names, the last one for images without a gsd
+    '''
+    import eda as eda
+
+    im_ids = np.array([i['id'] for i in gt['images']])
+    edges = np.asarray(gsd_bins, dtype = float)
+    im_gsd = np.array([eda.as_gsd(i.get('gsd')) for i in gt['images']], dtype = float)
+    im_bucket = np.clip(np.searchsorted(edges, np.nan_to_num(im_gsd, nan = -1), side = 'right') - 1, 0, len(edges) - 2)
+    im_bucket = np.where(np.isnan(im_gsd), len(edges) - 1, im_bucket)
+    # detections on images missing from the gt go to the 'No GSD' bucket
+    im_bucket = np.r_[im_bucket, len(edges) - 1]
+    bucket_labels = [f'[{edges[i]:g}, {edges[i+1]:g})' for i in range(len(edges) - 1)] + ['No GSD']
+
+    anns = gt['annotations']
+    g_im = eda.id_lookup(im_ids, np.array([a['image_id'] for a in anns]))
+    g_im = np.where(g_im < 0, len(im_ids), g_im)
+    g_cat = np.array([a['category_id'] for a in anns])
+    g_boxes = np.array([a['bbox'][:4] for a in anns], dtype = float).reshape(-1, 4)
+    g_areas = np.array([a['area'] if isinstance(a.get('area'), (int, float)) and not isinstance(a.get('area'), bool)
+                        else a['bbox'][2]*a['bbox'][3] for a in anns], dtype = float)
+    g_crowd = np.array([bool(a.get('iscrowd', 0)) for a in anns], dtype = bool)
+
+    d_keys = list(dt_index)
+    d_im = np.concatenate([np.full(len(dt_index[k]['score']), p) for p, k in enumerate(d_keys)]) if d_keys else np.zeros(0, dtype = int)
+    d_im = eda.id_lookup(im_ids, np.array(d_keys)[d_im]) if d_keys else d_im
+    d_im = np.where(d_im < 0, len(im_ids), d_im)
+    d_cat = np.concatenate([dt_index[k]['category_id'] for k in d_keys]) if d_keys else np.zeros(0, dtype = int)
+    d_scores = np.concatenate([dt_index[k]['score'] for k in d_keys]) if d_keys else np.zeros(0)
+    d_boxes = np.concatenate([dt_index[k]['bbox'] for k in d_keys]) if d_keys else np.zeros((0, 4))
+
+    # Sort once by (category, image) and (category, image, -score), then slice out each category
+    g_order = np.lexsort((g_im, g_cat))
+    d_order = np.lexsort((-d_scores, d_im, d_cat))
+
+    tasks = []
+    for c in gt['categories']:
+        g = g_order[np.searchsorted(g_cat[g_order], c['id']):np.searchsorted(g_cat[g_order], c['id'], side = 'right')]
+        d = d_order[np.searchsorted(d_cat[d_order], c['id']):np.searchsorted(d_cat[d_order], c['id'], side = 'right')]
+        tasks.append({
+            'gt_im': g_im[g], 'gt_boxes': g_boxes[g], 'gt_areas': g_areas[g], 'gt_crowd': g_crowd[g],
+            'dt_im': d_im[d], 'dt_boxes': d_boxes[d], 'dt_areas': d_boxes[d, 2]*d_boxes[d, 3], 'dt_scores': d_scores[d],
+            'im_bucket': im_bucket, 'n_buckets': len(bucket_labels), 'max_dets': max_dets
+        })
+    return tasks, bucket_labels
+
+def evaluate(gt_path, dt_path, gsd_bins = None, max_dets = 100, workers = None):
+    '''
+    PURPOSE: coco style AP/AR over IoU thresholds 0.5:0.95, per category, per object size and per image
+    gsd bucket, evaluating categories in parallel
+    IN:
+        - gt_path: coco gt file (or loaded contents)
+        - dt_path: coco dt file, in the format the display dt functions read (or an index from display.index_dt)
+        - gsd_bins: list of gsd bucket edges in meters, by default eda.GSD_BINS
+        - max_dets: int, highest scoring detections kept per image and category
+        - workers: int number of processes, by default one per cpu (1 runs in this process)
+    OUT:
+        - results_df: dataframe with a row per category (and 'mean'), with AP, AP50, AP75, AP_small,
+                      AP_medium, AP_large, AR, AR_small, AR_medium, AR_large
+        - gsd_df: dataframe with a row per category (and 'mean') and AP, AP50 and AR columns per gsd bucket
+    '''
+    import eda as eda
+    from multiprocessing import Pool
+
+    gt = load_gt(gt_path)
+    dt_index = load_dt(dt_path)
+    if gsd_bins is None:
+        gsd_bins = eda.GSD_BINS
+
+    tasks, bucket_labels = category_tasks(gt, dt_index, gsd_bins, max_dets)
+    if workers == 1:
+        results = [evaluate_category(t) for t in tqdm(tasks, desc = 'Evaluating')]
+    else:
+        with Pool(workers) as pool:
+            results = list(tqdm(pool.imap(evaluate_category, tasks), total = len(tasks), desc = 'Evaluating'))
+
+    t50 = int(np.argmin(np.abs(IOU_THRS - 0.5)))
+    t75 = int(np.argmin(np.abs(IOU_THRS - 0.75)))
+    names = [c['name'] for c in gt['categories']]
+
+    rows = []
+    for r in results:
+        row = {'AP': np.mean(r['ap'][0]), 'AP50': r['ap'][0, t50], 'AP75': r['ap'][0, t75]}
+        for a, rng in enumerate(AREA_RNGS):
+            if rng != 'all':
+                row[f'AP_{rng}'] = np.mean(r['ap'][a])
+        row['AR'] = np.mean(r['ar'][0])
+        for a, rng in enumerate(AREA_RNGS):
+            if rng != 'all':
+                row[f'AR_{rng}'] = np.mean(r['ar'][a])
+        rows.append(row)
+    results_df = pd.DataFrame(rows, index = names)
+    results_df.loc['mean'] = results_df.mean()
+
+    gsd = {}
+    for b, label in enumerate(bucket_labels):
+        gsd[(label, 'AP')] = [np.mean(r['gsd_ap'][b]) for r in results]
+        gsd[(label, 'AP50')] = [r['gsd_ap'][b, t50] for r in results]
+        gsd[(label, 'AR')] = [np.mean(r['gsd_ar'][b]) for r in results]
+    gsd_df = pd.DataFrame(gsd, index = names)
+    gsd_df.loc['mean'] = gsd_df.mean()
+    # Only keep the gsd buckets that have any images with annotations
+    gsd_df = gsd_df.loc[:, gsd_df.notna().any()]
+
+    return results_df, gsd_df
+
+'''########################### Confusion Matrix ########################### '''
+
+def pair_iou(boxes_a, boxes_b):
+    '''
+    IN:
+        - boxes_a, boxes_b: arrays of shape (n, 4) of coco [x, y, w, h] boxes
+    OUT:
+        - array of shape (n,) of the intersection over union of each row pair
+    '''
+    a = np.asarray(boxes_a, dtype = float).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype = float).reshape(-1, 4)
+    iw = np.minimum(a[:, 0] + a[:, 2], b[:, 0] + b[:, 2]) - np.maximum(a[:, 0], b[:, 0])
+    ih = np.minimum(a[:, 1] + a[:, 3], b[:, 1] + b[:, 3]) - np.maximum(a[:, 1], b[:, 1])
+    inter = np.clip(iw, 0, None)*np.clip(ih, 0, None)
+    union = a[:, 2]*a[:, 3] + b[:, 2]*b[:, 3] - inter
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(union > 0, inter/union, 0.0)
+
+def overlapping_pairs(g_im, g_boxes, d_im, d_boxes, iou_thresh, block = 10**7):
+    '''
+    PURPOSE: Every gt/dt pair on the same image that overlaps by at least iou_thresh, for all images at once
+    IN:
+        - g_im, d_im: int image codes of each gt and dt box, both sorted
+        - g_boxes, d_boxes: arrays (n, 4) and (m, 4) of boxes
+        - iou_thresh: minimum IoU of a pair
+        - block: int, the most pairs held in memory at once
+    OUT:
+        - gi, di, iou: gt index, dt index and IoU of each overlapping pair
+    '''
+    ims = np.intersect1d(g_im, d_im)
+    gs = np.searchsorted(g_im, ims)
+    n_g = np.searchsorted(g_im, ims, side = 'right') - gs
+    ds = np.searchsorted(d_im, ims)
+    n_d = np.searchsorted(d_im, ims, side = 'right') - ds
+    n_pairs = n_g*n_d
+
+    # Images are grouped so that each group expands to about block pairs
+    group = np.cumsum(n_pairs)//block
+    gi, di, ious = [], [], []
+    for b in np.unique(group):
+        sel = np.flatnonzero(group == b)
+        counts = n_pairs[sel]
+        starts = np.cumsum(counts) - counts
+        k = np.arange(counts.sum()) - np.repeat(starts, counts)
+        cols = np.repeat(n_d[sel], counts)
+        g = np.repeat(gs[sel], counts) + k//cols
+        d = np.repeat(ds[sel], counts) + k%cols
+
+        iou = pair_iou(g_boxes[g], d_boxes[d])
+        keep = iou >= iou_thresh
+        gi.append(g[keep])
+        di.append(d[keep])
+        ious.append(iou[keep])
+
+    if not gi:
+        return np.zeros(0, dtype = int), np.zeros(0, dtype = int), np.zeros(0)
+    return np.concatenate(gi), np.concatenate(di), np.concatenate(ious)
+
+def candidate_pairs(groups, boxes, iou_thresh, block = 10**6):
+    '''
+    PURPOSE: Every pair of boxes in the same group overlapping by at least iou_thresh, without comparing
+    every box with every other. Boxes are sorted by group and left edge, so each box is only compared
+    with the boxes of its group that start before it ends. Identical boxes count as IoU 1 whatever
+    their area, and boxes with negative widths or heights are compared as the region they span
+    IN:
+        - groups: int array (n,), boxes are only paired with boxes of the same group
+        - boxes: array (n, 4) of coco boxes
+        - iou_thresh: minimum IoU of a pair
+        - block: int, the most candidate pairs held in memory at once
+    OUT:
+        - i, j, iou: indices into boxes (i < j) and the IoU of each pair. Boxes that are not finite
+          are never paired
+    '''
+    boxes = np.asarray(boxes, dtype = float).reshape(-1, 4)
+    groups = np.asarray(groups, dtype = np.int64).reshape(-1)
+
+    # Boxes drawn from the far corner span the same region as their flipped selves
+    flipped = boxes.copy()
+    for k in (0, 1):
+        neg = flipped[:, k + 2] < 0
+        flipped[neg, k] += flipped[neg, k + 2]
+        flipped[neg, k + 2] *= -1
+    idx = np.flatnonzero(np.isfinite(flipped).all(axis = 1))
+    n = len(idx)
+    if n < 2:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0)
+    b_boxes, b_groups = flipped[idx], groups[idx]
+
+    # Place each group on its own stretch of one sorted axis
+    x1 = b_boxes[:, 0] - b_boxes[:, 0].min()
+    x2 = x1 + b_boxes[:, 2]
+    span = x2.max() + 1
+    order = np.lexsort((x1, b_groups))
+    start = b_groups[order]*span + x1[order]
+    end = b_groups[order]*span + x2[order]
+
+    # Boxes of the group that start at or before this one ends (touching boxes share an edge only)
+    hi = np.searchsorted(start, end, side = 'right')
+    counts = hi - np.arange(n) - 1
+
+    group = np.cumsum(counts)//block
+    out_i, out_j, ious = [], [], []
+    for b in np.unique(group):
+        sel = np.flatnonzero(group == b)
+        c = counts[sel]
+        k = np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+        p = np.repeat(sel, c)
+        q = p + 1 + k
+
+        a, o = order[p], order[q]
+        iou = pair_iou(b_boxes[a], b_boxes[o])
+        iou[np.all(b_boxes[a] == b_boxes[o], axis = 1)] = 1.0
+        keep = iou >= iou_thresh
+        out_i.append(idx[np.minimum(a[keep], o[keep])])
+        out_j.append(idx[np.maximum(a[keep], o[keep])])
+        ious.append(iou[keep])
+    return np.concatenate(out_i), np.concatenate(out_j), np.concatenate(ious)
+
+def greedy_pairs(gi, di, iou):
+    '''
+    PURPOSE: Greedy one-to-one matching over candidate pairs, highest IoU first, each gt and dt box used at
+    most once, in rounds: a pair that comes first for both its gt and its dt among the pairs still open is
+    exactly the one greedy would take, so all of those are accepted at once and the pairs they block dropped
+    IN:
+        - gi, di, iou: gt index, dt index and IoU of each candidate pair (see overlapping_pairs)
+    OUT:
+        - gi, di: the matched pairs
+    '''
+    order = np.argsort(-iou, kind = 'stable')
+    gi, di = gi[order], di[order]
+    keep_g, keep_d = [], []
+    while len(gi):
+        first_g = np.zeros(len(gi), dtype = bool)
+        first_g[np.unique(gi, return_index = True)[1]] = True
+        first_d = np.zeros(len(di), dtype = bool)
+        first_d[np.unique(di, return_index = True)[1]] = True
+        take = first_g & first_d
+        keep_g.append(gi[take])
+        keep_d.append(di[take])
+        open_ = ~np.isin(gi, gi[take]) & ~np.isin(di, di[take])
+        gi, di = gi[open_], di[open_]
+    if not keep_g:
+        return np.zeros(0, dtype = int), np.zeros(0, dtype = int)
+    return np.concatenate(keep_g), np.concatenate(keep_d)
+
+def confusion_matrix(gt_path, dt_path, iou_thresh = 0.5, conf_thresh = 0.5):
+    '''
+    PURPOSE: Count which category each gt object was detected as, across all images in one vectorized pass.
+    Boxes are matched regardless of category, highest IoU first, each gt and dt box at most once
+    IN:
+        - gt_path: coco gt file (or loaded contents)
+        - dt_path: coco dt file (or an index from display.index_dt)
+        - iou_thresh: minimum IoU for a match
+        - conf_thresh: minimum detection score
+    OUT:
+        - cm_df: dataframe of counts, rows are gt categories and columns detected categories, both with a
+                 'background' entry: unmatched gt objects (missed) are in the background column and
+                 unmatched detections (false alarms) in the background row
+    '''
+    import eda as eda
+
+    gt = load_gt(gt_path)
+    dt_index = load_dt(dt_path)
+    cat_ids = np.array([c['id'] for c in gt['categories']])
+    n = len(cat_ids)
+
+    anns = gt['annotations']
+    g_imid = np.array([a['image_id'] for a in anns])
+    g_cat = eda.id_lookup(cat_ids, np.array([a['category_id'] for a in anns]))
+    g_boxes = np.array([a['bbox'][:4] for a in anns], dtype = float).reshape(-1, 4)
+
+    d_parts = [display.dt_on_image(k, dt_index, conf_thresh) for k in dt_index]
+    d_imid = np.concatenate([np.full(len(p[2]), k) for k, p in zip(dt_index, d_parts)]) if d_parts else np.zeros(0)
+    d_cat = eda.id_lookup(cat_ids, np.concatenate([p[1] for p in d_parts])) if d_parts else np.zeros(0, dtype = int)
+    d_boxes = np.concatenate([p[0] for p in d_parts]) if d_parts else np.zeros((0, 4))
+
+    # Objects whose category is not in the gt categories can't be placed in the matrix
+    g_ok, d_ok = g_cat >= 0, d_cat >= 0
+    g_imid, g_cat, g_boxes = g_imid[g_ok], g_cat[g_ok], g_boxes[g_ok]
+    d_imid, d_cat, d_boxes = d_imid[d_ok], d_cat[d_ok], d_boxes[d_ok]
+
+    # One integer code per image id, then sort both sides by image
+    codes = np.unique(np.r_[g_imid, d_imid], return_inverse = True)[1].reshape(-1)
+    g_im, d_im = codes[:len(g_imid)], codes[len(g_imid):]
+    g_order = np.argsort(g_im, kind = 'stable')
+    d_order = np.argsort(d_im, kind = 'stable')
+    gi, di, iou = overlapping_pairs(g_im[g_order], g_boxes[g_order], d_im[d_order], d_boxes[d_order], iou_thresh)
+    gi, di = g_order[gi], d_order[di]
+
+    gi, di = greedy_pairs(gi, di, iou)
+
+    g_missed = np.ones(len(g_cat), dtype = bool)
+    g_missed[gi] = False
+    d_false = np.ones(len(d_cat), dtype = bool)
+    d_false[di] = False
+
+    rows = np.r_[g_cat[gi], g_cat[g_missed], np.full(np.count_nonzero(d_false), n)]
+    cols = np.r_[d_cat[di], np.full(np.count_nonzero(g_missed), n), d_cat[d_false]]
+    cm = np.bincount(rows*(n + 1) + cols, minlength = (n + 1)**2).reshape(n + 1, n + 1)
+
+    labels = [c['name'] for c in gt['categories']] + ['background']
+    return pd.DataFrame(cm, index = labels, columns = labels)
+
+def plot_confusion(cm_df, fig_size = (15,15)):
+    '''
+    Draw a confusion matrix from confusion_matrix with the same heatmap as eda.plot_cat_cm, colored by the
+    share of each gt category (row) detected as each category (column)
+    '''
+    import eda as eda
+
+    shares = cm_df.div(cm_df.sum(axis = 1).replace(0, np.nan), axis = 0)
+    eda.plot_heatmap(shares, cm_df,
+                     'Heat Map: Which Category Each Object Was Detected As',
+                     'Colored By Share of the Row, Values Indicate the Number of Objects',
+                     'Detected Category', 'Ground Truth Category', fig_size, fmt = 'g')
+
+    return
+
+def confusion_heatmap(gt_path, dt_path, iou_thresh = 0.5, conf_thresh = 0.5, fig_size = (15,15)):
+    '''
+    Create a heatmap of how often objects of each category are detected as each other category
+    '''
+    cm_df = confusion_matrix(gt_path, dt_path, iou_thresh, conf_thresh)
+    plot_confusion(cm_df, fig_size)
+
+    return cm_df
@@ -0,0 +1,145 @@
+import json
+import os
+import sys
+from multiprocessing import Pool
+from tqdm import tqdm
+from matplotlib import pyplot as plt
+
+cwd = os.getcwd() + '/hot_coco'
+if os.path.exists(cwd):
+    sys.path.append(cwd)
+
+import display as display
+
+# Shared by every task in a worker process, set once by init_worker
+WORKER = {}
+
+'''########################### Helper Functions ########################### '''
+
+def init_worker(pal, names, settings):
+    '''
+    Runs once in each worker process: switch to the non-interactive backend and keep the shared drawing settings
+    '''
+    plt.switch_backend('Agg')
+    WORKER['pal'] = pal
+    WORKER['names'] = names
+    WORKER['settings'] = settings
+
+def render_page(task):
+    '''
+    IN:
+        - task: (out_path, list of (im_path, layers, title)) for one output file
+    OUT:
+        - out_path, once the file is written
+    '''
+    out_path, items = task
+    s = WORKER['settings']
+    rows, cols = s['grid']
+    tile = s['fig_size']
+
+    f, axes = plt.subplots(rows, cols, figsize = (tile[0]*cols, tile[1]*rows), squeeze = False)
+    try:
+        for ax, (im_path, layers, title) in zip(axes.flat, items):
+            display.draw_anns(ax, im_path, layers, WORKER['pal'], WORKER['names'], tile, s['text_on'],
+                              s['max_labels'], s['pyramid'], s['dpi'])
+            if title:
+                ax.set_title(title)
+            if s['grid'] != (1, 1):
+                ax.set_axis_off()
+        for ax in axes.flat[len(items):]:
+            ax.set_axis_off()
+        f.savefig(out_path, dpi = s['dpi'], bbox_inches = 'tight')
+    finally:
+        # Always free the figure, so long runs don't grow in memory
+        plt.close(f)
+
+    return out_path
+
+def build_tasks(im_ids, gt, image_folder, out_folder, dt_index, conf_thresh, style, radius, grid, ext):
+    '''
+    PURPOSE: Build the drawing instructions for every output file in the main process, so that workers
+    only receive the arrays for the images they draw
+    OUT:
+        - tasks: list of (out_path, items), see render_page
+    '''
+    im_names = display.get_image_names(gt)
+    gt_by_im = display.index_anns(gt['annotations']) if style in ('gt', 'gt_dt', 'cp') else None
+    key = 'centerpoint' if style == 'cp' else 'bbox'
+    if style not in ('dt', 'gt_dt'):
+        dt_index = None
+
+    items = []
+    for i in im_ids:
+        layers = display.image_layers(i, gt_by_im, dt_index, conf_thresh, key, radius)
+        items.append((image_folder + im_names[i], layers, im_names[i]))
+
+    per_page = grid[0]*grid[1]
+    tasks = []
+    for n in range(0, len(items), per_page):
+        if per_page == 1:
+            # File names with sub folders keep them, so images of the same name in different folders don't collide
+            name = os.path.splitext(items[n][2])[0]
+            os.makedirs(os.path.dirname(os.path.join(out_folder, name)), exist_ok = True)
+        else:
+            name = f'sheet_{n // per_page}'
+        tasks.append((os.path.join(out_folder, name + ext), items[n:n + per_page]))
+    return tasks
+
+'''############################# Batch Export ############################# '''
+
+def export_ims(gt_path, image_folder, out_folder, im_ids = None, dt_path = None, style = 'gt', conf_thresh = 0.9,
+               fig_size = (10,10), dpi = 100, grid = (1,1), text_on = True, max_labels = display.MAX_LABELS,
+               radius = 2, pyramid = True, workers = None, ext = '.png'):
+    '''
+    PURPOSE: Write annotated images, or tiled contact sheets, to disk without displaying them, using the
+    same gt, dt and centerpoint styles as display and a pool of worker processes
+    IN:
+        - gt_path: coco gt file
+        - image_folder: folder where images in gt_path are located
+        - out_folder: folder the rendered files are written to
+        - im_ids: list of image ids to render, by default every image
+        - dt_path: coco dt file or index from display.index_dt, needed for 'dt' and 'gt_dt'
+        - style: 'gt', 'dt', 'gt_dt' or 'cp' (gt centerpoints)
+        - conf_thresh: minimum detection score drawn
+        - fig_size: size in inches of each image
+        - dpi: output resolution, so each image is fig_size*dpi pixels
+        - grid: (rows, cols) of images per output file, (1,1) writes one file per image named after it,
+                anything larger writes contact sheets named sheet_0, sheet_1, ...
+        - text_on, max_labels, radius, pyramid: see display.show_ims
+        - workers: int number of processes, by default one per cpu
+        - ext: output file extension
+    OUT:
+        - paths: list of the files written
+    '''
+    if style not in ('gt', 'dt', 'gt_dt', 'cp'):
+        raise ValueError(f'style must be gt, dt, gt_dt or cp, not {style}')
+
+    with open(gt_path, 'r') as f:
+        gt = json.load(f)
+    if im_ids is None:
+        im_ids = [i['id'] for i in gt['images']]
+    if dt_path is not None and not isinstance(dt_path, dict):
+        dt_path = display.index_dt(dt_path)
+
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    tasks = build_tasks(im_ids, gt, image_folder, out_folder, dt_path, conf_thresh, style, radius, tuple(grid), ext)
+    settings = {'fig_size': fig_size, 'dpi': dpi, 'grid': tuple(grid), 'text_on': text_on,
+                'max_labels': max_labels, 'pyramid': pyramid}
+
+    # Recycle workers now and then, in case a backend holds on to memory between figures
+    with Pool(workers, initializer = init_worker, initargs = (display.make_palette(gt), display.get_category_names(gt), settings),
+              maxtasksperchild = 200) as pool:
+        paths = list(tqdm(pool.imap(render_page, tasks), total = len(tasks), desc = 'Rendering'))
+
+    return paths
+
+def export_random(num_ims, gt_path, image_folder, out_folder, **kwargs):
+    '''
+    PURPOSE: export_ims for some number of randomly selected images, see export_ims for the options
+    '''
+    with open(gt_path, 'r') as f:
+        gt = json.load(f)
+    ims = display.choose_random_ims(num_ims, gt)
+    return export_ims(gt_path, image_folder, out_folder, im_ids = ims, **kwargs)
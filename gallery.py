@@ -0,0 +1,173 @@
+import html
+import json
+import os
+import sys
+import numpy as np
+
+cwd = os.getcwd() + '/hot_coco'
+if os.path.exists(cwd):
+    sys.path.append(cwd)
+
+import display as display
+import eda as eda
+import export as export
+
+# Detection counts are stored per image at each of these score thresholds, for the score filter
+SCORE_STEPS = [round(0.1*s, 1) for s in range(10)]
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>__TITLE__</title>
+<style>
+body { font-family: sans-serif; margin: 0; background: #222; color: #eee; }
+#filters { position: sticky; top: 0; background: #333; padding: 8px; z-index: 1; }
+#filters label { margin-right: 14px; }
+#grid { display: flex; flex-wrap: wrap; padding: 8px; }
+.tile { margin: 4px; width: __THUMB__px; font-size: 11px; }
+.tile img { width: 100%; display: block; }
+.tile a { color: #ccc; text-decoration: none; }
+</style>
+</head>
+<body>
+<div id="filters">
+<label>Category <select id="cat"><option value="">any</option></select></label>
+<label>Annotations <input id="min_anns" type="number" value="0" min="0" style="width:60px"> to
+<input id="max_anns" type="number" value="" min="0" style="width:60px"></label>
+<label>At least <input id="min_dts" type="number" value="0" min="0" style="width:50px"> detections with score &ge;
+<select id="score"></select></label>
+<label>Sort <select id="sort"><option value="name">name</option><option value="anns">annotations</option>
+<option value="dts">detections</option></select></label>
+<span id="count"></span>
+</div>
+<div id="grid"></div>
+<script>
+const DATA = __DATA__;
+const STEPS = __STEPS__;
+const $ = (id) => document.getElementById(id);
+const esc = (s) => String(s).replace(/[&<>"']/g, (c) => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'})[c]);
+for (const c of DATA.categories) { $('cat').add(new Option(c, c)); }
+STEPS.forEach((s, i) => $('score').add(new Option(s.toFixed(1), i)));
+
+function render() {
+  const cat = $('cat').value;
+  const minA = Number($('min_anns').value || 0);
+  const maxA = $('max_anns').value === '' ? Infinity : Number($('max_anns').value);
+  const minD = Number($('min_dts').value || 0);
+  const step = Number($('score').value || 0);
+  let ims = DATA.images.filter((im) =>
+    (!cat || (im.cats[cat] || 0) > 0) && im.n_anns >= minA && im.n_anns <= maxA &&
+    (!DATA.has_dt || im.dts[step] >= minD));
+  const sort = $('sort').value;
+  if (sort === 'anns') { ims.sort((a, b) => b.n_anns - a.n_anns); }
+  else if (sort === 'dts') { ims.sort((a, b) => b.dts[step] - a.dts[step]); }
+  else { ims.sort((a, b) => a.file_name < b.file_name ? -1 : 1); }
+
+  $('count').textContent = ims.length + ' / ' + DATA.images.length + ' images';
+  const html = ims.map((im) =>
+    '<div class="tile"><a href="' + encodeURI(im.image) + '" target="_blank"><img loading="lazy" src="' +
+    encodeURI(im.thumb) + '"></a>' + esc(im.file_name) + ' &middot; ' + im.n_anns + ' anns' +
+    (DATA.has_dt ? ' &middot; ' + im.dts[step] + ' dts' : '') + '</div>');
+  $('grid').innerHTML = html.join('');
+}
+for (const id of ['cat', 'min_anns', 'max_anns', 'min_dts', 'score', 'sort']) { $(id).addEventListener('input', render); }
+render();
+</script>
+</body>
+</html>
+'''
+
+'''########################### Helper Functions ########################### '''
+
+def thumb_name(file_name):
+    '''
+    Name of the thumbnail export.export_ims writes for an image
+    '''
+    return os.path.splitext(file_name)[0] + '.png'
+
+def image_records(gt_path, dt_path = None):
+    '''
+    PURPOSE: Collect what the gallery filters on for each image
+    IN:
+        - gt_path: coco gt file
+        - dt_path: optional coco dt file or index from display.index_dt
+    OUT:
+        - records: list of dicts with the image id, file name, annotation and category totals, per-category
+                   counts, and (with detections) the number of detections at each of SCORE_STEPS
+        - categories: list of category names with annotations
+    '''
+    # The same per-image table as eda.get_im_df, built without loading the annotations into pandas
+    stats = eda.stream_stats(gt_path)
+    im_df = eda.stream_im_df(stats)
+    categories = [c['name'] for c, n in zip(stats['categories'], stats['cat_totals']) if n > 0]
+
+    steps = -np.array(SCORE_STEPS)
+    records = []
+    for file_name, row in zip(im_df.index, im_df.to_dict('records')):
+        record = {
+            'id': row['id'],
+            'file_name': file_name,
+            'n_anns': int(row['Total Annotations']),
+            'n_cats': int(row['Total Categories']),
+            'cats': {c: int(row[c]) for c in categories if row[c] > 0}
+        }
+        if dt_path is not None:
+            bboxes, cat_ids, scores = display.dt_on_image(row['id'], dt_path)
+            # scores are sorted high to low, so the count above each step is a binary search
+            record['dts'] = np.searchsorted(-scores, steps, side = 'right').tolist()
+        records.append(record)
+
+    return records, categories
+
+'''############################### Gallery ############################### '''
+
+def make_gallery(gt_path, image_folder, gallery_folder, dt_path = None, conf_thresh = 0.5, thumb_size = (3,3),
+                 dpi = 80, title = 'hot_coco gallery', overwrite = False, workers = None):
+    '''
+    PURPOSE: Pre-render a thumbnail of every image in parallel and write a static, locally browsable
+    index.html that filters them by category, annotation count and detection score
+    IN:
+        - gt_path: coco gt file
+        - image_folder: folder where images in gt_path are located
+        - gallery_folder: folder for index.html and its thumbs/ folder
+        - dt_path: optional coco dt file or index from display.index_dt, drawn on the thumbnails and
+                   used by the score filter
+        - conf_thresh: minimum detection score drawn on the thumbnails
+        - thumb_size: thumbnail size in inches, so thumb_size*dpi pixels
+        - overwrite: if False, images that already have a thumbnail are not rendered again
+        - workers: int number of rendering processes, by default one per cpu
+    OUT:
+        - path to index.html
+    '''
+    thumb_folder = os.path.join(gallery_folder, 'thumbs')
+    if dt_path is not None and not isinstance(dt_path, dict):
+        dt_path = display.index_dt(dt_path)
+
+    records, categories = image_records(gt_path, dt_path)
+
+    # Only render the thumbnails that are missing
+    todo = [r['id'] for r in records
+            if overwrite or not os.path.exists(os.path.join(thumb_folder, thumb_name(r['file_name'])))]
+    if todo:
+        export.export_ims(gt_path, image_folder, thumb_folder, im_ids = todo, dt_path = dt_path,
+                          style = 'gt_dt' if dt_path is not None else 'gt', conf_thresh = conf_thresh,
+                          fig_size = thumb_size, dpi = dpi, text_on = False, workers = workers)
+
+    # Links are relative, so the gallery can be opened straight from disk
+    for r in records:
+        r['thumb'] = 'thumbs/' + thumb_name(r['file_name'])
+        r['image'] = os.path.relpath(os.path.join(image_folder, r['file_name']), gallery_folder)
+
+    data = {'images': records, 'categories': categories, 'has_dt': dt_path is not None}
+    page = PAGE.replace('__TITLE__', html.escape(title))
+    page = page.replace('__THUMB__', str(int(thumb_size[0]*dpi)))
+    page = page.replace('__STEPS__', json.dumps(SCORE_STEPS))
+    page = page.replace('__DATA__', json.dumps(data).replace('</', '<\\/'))
+
+    index_path = os.path.join(gallery_folder, 'index.html')
+    with open(index_path, 'w') as f:
+        f.write(page)
+
+    print('Gallery:', index_path)
+    return index_path
@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import hashlib
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import detections as detections
+import images as images
+import categories as categories
+import splits as splits
+
+# Bump to invalidate every cached record, e.g. after changing what a stage writes
+CACHE_VERSION = 1
+
+### support ###
+
+def file_hash(path, hashes):
+    '''
+    PURPOSE: Hash a file's bytes, re-reading it only when its size or
+    modification time changed since the last run
+    IN:
+     - path: str, file to hash
+     - hashes: dict of path to [size, mtime, hash], updated in place
+    OUT:
+     - str, sha256 of the file
+    '''
+    st = os.stat(path)
+    memo = hashes.get(path)
+    if memo is not None and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+        return memo[2]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    hashes[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    return hashes[path][2]
+
+def stage_key(stage, params, im_info, anns, image_hash):
+    '''
+    IN:
+     - stage: str, stage name
+     - params: dict of the stage's parameters
+     - im_info, anns: the image's coco info and annotations going into the stage
+     - image_hash: hash of the image's bytes, or None for stages that don't read it
+    OUT:
+     - str, key that changes whenever any input of the stage changes for this image
+    '''
+    payload = json.dumps([CACHE_VERSION, stage, params, im_info, anns, image_hash], sort_keys = True, default = str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def write_json_atomic(path, contents):
+    '''
+    Write a json file through a temporary file, so it is either complete or absent
+    '''
+    with open(path + '.tmp', 'w') as f:
+        json.dump(contents, f)
+    os.replace(path + '.tmp', path)
+
+### stages ###
+
+def convert_image(im_info, anns, image_folder, out_folder):
+    '''
+    PURPOSE: Per-image convert_rgb, writing to out_folder
+    OUT:
+     - (images, annotations, files written) for this image
+    '''
+    im_path = image_folder + im_info['file_name']
+    if not os.path.exists(im_path):
+        print(f'Issue with {im_info["id"]}')
+        return [], [], []
+
+    if images.convert_one(im_path, out_folder + im_info['file_name']) == 'failed':
+        return [], [], []
+    return [im_info], [], [im_info['file_name']]
+
+def keep_anns(im_info, new_images, anns):
+    '''
+    Annotations of stages that leave them unchanged
+    '''
+    return anns
+
+def clip_image(im_info, anns, image_folder, out_folder):
+    '''
+    PURPOSE: Per-image clip_anns_to_ims, annotations only
+    '''
+    new_anns = [images.clip_ann(a, im_info['width'], im_info['height']) for a in anns]
+    return [im_info], [a for a in new_anns if a is not None], []
+
+def gsd_norm_image(im_info, anns, image_folder, out_folder, target_gsd):
+    '''
+    PURPOSE: Per-image gsd_norm, writing to out_folder
+    '''
+    new_size = images.gsd_norm_size(im_info, target_gsd)
+    im_path = image_folder + im_info['file_name']
+    if new_size is None or not os.path.exists(im_path):
+        print(im_info['id'], 'problem')
+        return [], [], []
+
+    images.resize_image(im_path, new_size, out_folder + im_info['file_name'])
+
+    new_im_info = im_info.copy()
+    new_im_info['width'], new_im_info['height'] = new_size
+    new_im_info['gsd'] = target_gsd
+    return [new_im_info], [], [im_info['file_name']]
+
+def gsd_norm_anns(im_info, new_images, anns):
+    '''
+    Annotations of gsd_norm_image, rescaled to the resized image
+    '''
+    if not new_images:
+        return []
+    return images.scale_anns(anns, im_info['width'], im_info['height'], new_images[0]['width'], new_images[0]['height'])
+
+def chip_image(im_info, anns, image_folder, out_folder, chip_size):
+    '''
+    PURPOSE: Per-image chip, writing to out_folder. Chips are numbered within
+    the scene, and run_stage renumbers them and renames their files to match
+    '''
+    im_path = image_folder + im_info['file_name']
+    if not os.path.exists(im_path):
+        print(f'Issue with {im_info["id"]}')
+        return [], [], []
+
+    new_images, new_anns, chips = images.plan_chips(im_info, anns, im_info['width'], im_info['height'], chip_size, 0, out_folder)
+
+    # A chip left behind by an earlier version of this scene may have the same name
+    for c in chips:
+        if os.path.exists(c[0]):
+            os.remove(c[0])
+    images.resample_and_chip((im_path, None, chips))
+    return new_images, new_anns, [i['file_name'] for i in new_images]
+
+def chip_rename(chip_info):
+    '''
+    The file name of a renumbered chip, its new id in front as in images.chip_name
+    '''
+    name = chip_info['file_name']
+    return str(chip_info['id']) + name[name.index('_'):]
+
+### functions ###
+
+def run_stage(stage, gt, image_folder, out_folder, fn, params, cache_folder, renumber = False, ann_fn = None, rename = None):
+    '''
+    PURPOSE: Run one pipeline stage image by image, reusing the cached output of
+    every image whose inputs (image bytes, annotations, image info and
+    parameters) are unchanged since an earlier run. Records no image used this
+    time are deleted along with the files only they wrote, so out_folder only
+    holds the current output (a cache folder serves one pipeline)
+    IN:
+     - stage: str, stage name, also the cache sub folder
+     - gt: coco contents going into the stage
+     - image_folder: folder of the input images, or None if the stage doesn't read them
+     - out_folder: folder the stage writes images to, or None
+     - fn: fn(im_info, anns, image_folder, out_folder, **params) returning the
+       image's output (images, annotations, files written to out_folder)
+     - params: dict of json serializable parameters of fn
+     - cache_folder: folder of the cache
+     - renumber: if True, output images are given new sequential ids (for stages
+       that turn one image into several)
+     - ann_fn: optional ann_fn(im_info, new_images, anns) for stages whose image
+       output doesn't depend on the annotations. The cache then ignores the
+       annotations, and ann_fn (cheap) makes the output annotations on every run
+     - rename: optional rename(image) giving the file name of a renumbered image,
+       whose file is renamed to match its new id
+    OUT:
+     - new_gt: coco contents coming out of the stage
+    '''
+    record_folder = os.path.join(cache_folder, stage)
+    if not os.path.exists(record_folder):
+        os.makedirs(record_folder)
+    if out_folder is not None and not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    hashes_path = os.path.join(cache_folder, 'hashes.json')
+    hashes = {}
+    if os.path.exists(hashes_path):
+        with open(hashes_path, 'r') as f:
+            hashes = json.load(f)
+
+    anns_by_image = images.index_by_image(gt['annotations'])
+    new_images = []
+    new_anns = []
+    computed = 0
+    live = set()
+    keep = set()
+    for im_info in tqdm(gt['images'], desc = stage):
+        anns = anns_by_image.get(im_info['id'], [])
+        im_hash = None
+        if image_folder is not None and os.path.exists(image_folder + im_info['file_name']):
+            im_hash = file_hash(image_folder + im_info['file_name'], hashes)
+        key_anns = anns if ann_fn is None else None
+        record_path = os.path.join(record_folder, stage_key(stage, params, im_info, key_anns, im_hash) + '.json')
+
+        # A record only counts if everything it wrote is still there
+        record = None
+        if os.path.exists(record_path):
+            with open(record_path, 'r') as f:
+                record = json.load(f)
+            if not all(os.path.exists(out_folder + n) for n in record['files']):
+                record = None
+        if record is None:
+            out_images, out_anns, files = fn(im_info, [a.copy() for a in anns], image_folder, out_folder, **params)
+            record = {'images': out_images, 'annotations': out_anns, 'files': files}
+            write_json_atomic(record_path, record)
+            computed += 1
+        live.add(record_path)
+        if ann_fn is not None:
+            record['annotations'] = ann_fn(im_info, record['images'], [a.copy() for a in anns])
+
+        if renumber:
+            ids = {}
+            moved = False
+            for i in record['images']:
+                ids[i['id']] = len(new_images)
+                i['id'] = len(new_images)
+                new_images.append(i)
+
+                # Keep file names in step with the new ids
+                new_name = i['file_name'] if rename is None else rename(i)
+                if new_name != i['file_name']:
+                    os.replace(out_folder + i['file_name'], out_folder + new_name)
+                    record['files'] = [new_name if n == i['file_name'] else n for n in record['files']]
+                    i['file_name'] = new_name
+                    moved = True
+            for a in record['annotations']:
+                a['image_id'] = ids[a['image_id']]
+                new_anns.append(a)
+            if moved:
+                write_json_atomic(record_path, record)
+        else:
+            new_images += record['images']
+            new_anns += record['annotations']
+        keep.update(record['files'])
+
+    # Drop superseded records, and whatever they wrote that nothing current uses
+    removed = 0
+    for name in os.listdir(record_folder):
+        record_path = os.path.join(record_folder, name)
+        if not name.endswith('.json') or record_path in live:
+            continue
+        with open(record_path, 'r') as f:
+            old_files = json.load(f)['files']
+        for n in old_files:
+            if n not in keep and os.path.exists(out_folder + n):
+                os.remove(out_folder + n)
+                removed += 1
+        os.remove(record_path)
+
+    write_json_atomic(hashes_path, hashes)
+    print(f'{stage}: {computed} images processed, {len(gt["images"]) - computed} reused from cache, {removed} old files removed')
+
+    new_gt = gt.copy()
+    new_gt['images'] = new_images
+    new_gt['annotations'] = new_anns
+    return new_gt
+
+def pipeline(gt_path, image_folder, work_dir, chip_size, target_gsd = None, cat_list = None,
+             test_percentage = 0.2, val_percentage = 0.0, cache_folder = None):
+    '''
+    PURPOSE: convert -> clip -> reduce -> gsd_norm -> chip -> split, where a rerun
+    only redoes the images whose inputs changed, so a few label fixes don't mean
+    rebuilding the whole dataset
+    IN:
+     - gt_path: str, coco gt file of the scenes
+     - image_folder: str, folder of the scenes
+     - work_dir: str, folder for every stage's images and gt files
+     - chip_size: int, size of the square chips
+     - target_gsd: optional float, gsd the scenes are normalized to before chipping
+     - cat_list: optional list of int category ids to keep, see categories.reduce
+     - test_percentage, val_percentage: see splits.split_by_hash, chips of one
+       scene always go to the same split
+     - cache_folder: str, defaults to work_dir + 'cache/'
+    OUT:
+     - paths: dict of split name to its coco gt file, plus 'all' for every chip
+    '''
+    if cache_folder is None:
+        cache_folder = work_dir + 'cache/'
+
+    with open(gt_path, 'r') as f:
+        gt = json.load(f)
+
+    gt = run_stage('convert', gt, image_folder, work_dir + 'rgb/', convert_image, {}, cache_folder, ann_fn = keep_anns)
+    gt = run_stage('clip', gt, None, None, clip_image, {}, cache_folder)
+    im_folder = work_dir + 'rgb/'
+
+    # reduce only rewrites the annotation file, which is cheap
+    if cat_list is not None:
+        clip_path = work_dir + 'clip.json'
+        write_json_atomic(clip_path, gt)
+        with open(categories.reduce(clip_path, cat_list, ims_no_anns = True), 'r') as f:
+            gt = json.load(f)
+
+    if target_gsd is not None:
+        gt = run_stage('gsd_norm', gt, im_folder, work_dir + 'gsd/', gsd_norm_image, {'target_gsd': target_gsd},
+                       cache_folder, ann_fn = gsd_norm_anns)
+        im_folder = work_dir + 'gsd/'
+
+    gt = run_stage('chip', gt, im_folder, work_dir + 'chips/', chip_image, {'chip_size': chip_size}, cache_folder,
+                   renumber = True, rename = chip_rename)
+
+    paths = {'all': work_dir + f'chips_{chip_size}.json'}
+    write_json_atomic(paths['all'], gt)
+    parent = lambda i: detections.chip_parent(i)[0]
+    for name, contents in splits.split_by_hash(gt, test_percentage, val_percentage, parent).items():
+        paths[name] = work_dir + f'{name}_{chip_size}.json'
+        write_json_atomic(paths[name], contents)
+
+    print('Chips:', work_dir + 'chips/')
+    for name, path in paths.items():
+        print(f'{name}:', path)
+    return paths
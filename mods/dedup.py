@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import numpy as np
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import evaluation as evaluation
+
+### support ###
+
+def box_arrays(anns, by_category = True):
+    '''
+    IN:
+     - anns: list of coco annotations
+     - by_category: if True, only annotations of the same category can duplicate each other
+    OUT:
+     - groups: int array (n,), annotations can only duplicate others of their group
+       (same image, and same category if by_category)
+     - boxes: float array (n, 4) of coco bboxes
+    '''
+    groups = np.unique([a['image_id'] for a in anns], return_inverse = True)[1].reshape(-1).astype(np.int64)
+    if by_category:
+        cats, cat_codes = np.unique([a['category_id'] for a in anns], return_inverse = True)
+        groups = groups*len(cats) + cat_codes.reshape(-1)
+    boxes = np.array([a['bbox'][:4] for a in anns], dtype = float).reshape(-1, 4)
+    return groups, boxes
+
+### functions ###
+
+def find_duplicates(anns, iou_thresh = 0.9, by_category = True):
+    '''
+    PURPOSE: Find exact and near duplicate annotations in one pass over all images
+    IN:
+     - anns: coco gt contents, or a list of annotations
+     - iou_thresh: annotations on the same image overlapping by at least this much are duplicates
+     - by_category: if True, only annotations of the same category are compared
+    OUT:
+     - duplicates: dict of the id of each duplicate annotation to (id of the
+       annotation it duplicates, IoU). Of each set of duplicates, the annotation
+       first in the file is kept, and the others point to it
+    '''
+    if isinstance(anns, dict):
+        anns = anns['annotations']
+    groups, boxes = box_arrays(anns, by_category)
+
+    # Degenerate boxes are compared as the region they span, or left out if not finite
+    flipped = np.count_nonzero((boxes[:, 2:] < 0).any(axis = 1))
+    bad = np.count_nonzero(~np.isfinite(boxes).all(axis = 1))
+    if flipped or bad:
+        print(f'{flipped} boxes with a negative width or height compared as the region they span, {bad} boxes that are not finite skipped')
+    i, j, iou = evaluation.candidate_pairs(groups, boxes, iou_thresh)
+
+    # Walk the pairs in file order, dropping j only if what it duplicates is kept
+    order = np.lexsort((i, j))
+    dropped = {}
+    for a, b, v in tqdm(zip(i[order].tolist(), j[order].tolist(), iou[order].tolist()), total = len(order), desc = 'Duplicates'):
+        if b in dropped or a in dropped:
+            continue
+        dropped[b] = (a, v)
+
+    return {anns[b]['id']: (anns[a]['id'], v) for b, (a, v) in dropped.items()}
+
+def dedup(coco_gt, iou_thresh = 0.9, by_category = True, output_fp = False, report_only = False):
+    '''
+
+    Parameters
+    ----------
+    coco_gt : str,
+        file path to a set of coco ground truth annotations
+    iou_thresh : float, optional
+        annotations on the same image overlapping by at least this much are
+        duplicates, 1 only finds exact ones. The default is 0.9.
+    by_category : boolean, optional
+        If True, only annotations of the same category are compared. The
+        default is True.
+    output_fp : str, optional
+        where the deduplicated annotations are written, by default -dedup is
+        added before .json
+    report_only : boolean, optional
+        If True, the duplicates are counted but no file is written. The
+        default is False.
+
+    Reports the number of exact and near duplicates per category, and writes
+    the annotations without them, keeping the first of each set of duplicates
+    -------
+    Returns the duplicates found (see find_duplicates) and the path written,
+    or None with report_only
+
+    '''
+    with open(coco_gt, 'r') as f:
+        gt = json.load(f)
+
+    duplicates = find_duplicates(gt, iou_thresh, by_category)
+
+    # Report
+    cat_names = {c['id']: c.get('name', c['id']) for c in gt.get('categories', [])}
+    per_cat = {}
+    n_exact = 0
+    for a in gt['annotations']:
+        if a['id'] in duplicates:
+            exact = duplicates[a['id']][1] == 1
+            n_exact += exact
+            counts = per_cat.setdefault(cat_names.get(a['category_id'], a['category_id']), [0, 0])
+            counts[0 if exact else 1] += 1
+    print(f'{len(duplicates)} duplicates in {len(gt["annotations"])} annotations: {n_exact} exact, {len(duplicates) - n_exact} near (IoU >= {iou_thresh})')
+    for name, (exact, near) in sorted(per_cat.items(), key = lambda kv: -sum(kv[1])):
+        print(f'  {name}: {exact} exact, {near} near')
+
+    if report_only:
+        return duplicates, None
+
+    if not output_fp:
+        output_fp = coco_gt.replace('.json', '-dedup.json')
+    new_gt = gt.copy()
+    new_gt['annotations'] = [a for a in gt['annotations'] if a['id'] not in duplicates]
+    if os.path.exists(output_fp):
+        os.remove(output_fp)
+    with open(output_fp, 'w') as f:
+        json.dump(new_gt, f)
+
+    print('Deduplicated ground truth:', output_fp)
+    return duplicates, output_fp
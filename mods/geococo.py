@@ -1,7 +1,43 @@
 import json
 import os
+import numpy as np
 
-def centerpoints_xy(anns_fp, output_fp = False):
+def bbox_centers(bboxes):
+    '''
+    IN:
+        - bboxes: array of shape (n, 4) of coco [x, y, w, h] boxes
+    OUT:
+        - centers: int array of shape (n, 2) of [xc, yc], truncated like int()
+    '''
+    b = np.asarray(bboxes, dtype = float).reshape(-1, 4)
+    return np.trunc(b[:, :2] + b[:, 2:]/2).astype(np.int64)
+
+def centerpoints(anns):
+    '''
+    PURPOSE: Centerpoints of every annotation in memory, without writing a file
+    IN:
+        - anns: coco gt contents, or a list of annotations
+    OUT:
+        - ann_ids: int array of annotation ids
+        - centers: int array of shape (n, 2) of [xc, yc]
+    '''
+    if isinstance(anns, dict):
+        anns = anns['annotations']
+    ann_ids = np.array([a['id'] for a in anns], dtype = np.int64)
+    centers = bbox_centers([a['bbox'][:4] for a in anns])
+    return ann_ids, centers
+
+def load_centerpoints(sidecar_fp):
+    '''
+    IN:
+        - sidecar_fp: str, file written by centerpoints_xy with sidecar = True
+    OUT:
+        - ann_ids, centers: see centerpoints
+    '''
+    with np.load(sidecar_fp) as data:
+        return data['ann_id'], data['center']
+
+def centerpoints_xy(anns_fp, output_fp = False, sidecar = False):
     '''
 
     Parameters
@@ -9,38 +45,256 @@ def centerpoints_xy(anns_fp, output_fp = False):
     anns_fp : str,
         file path to a set of coco ground truth annotations
     output_fp : boolean, optional
-        If an output fp is specified, that's where the modified anns will be 
-        writen. Else, a version of the fp with -cp added before .json will be 
+        If an output fp is specified, that's where the modified anns will be
+        writen. Else, a version of the fp with -cp added before .json will be
         used. The default is False.
+    sidecar : boolean, optional
+        If True, the annotations are left alone and the centerpoints are
+        written as columns (annotation ids and centers) to a compact .npz
+        sidecar instead, -cp.npz by default, see load_centerpoints. The
+        default is False.
 
-    Modifies the file using the bbox key to add centerpoint values to each 
+    Modifies the file using the bbox key to add centerpoint values to each
     annotation using the format ['object_center'] = [xc, yc]
     -------
+    Returns the path of the file written
 
     '''
-    
+
     with open(anns_fp, 'r') as f:
       anns = json.load(f)
-    annotations = anns['annotations']
-    new_anns = []
-    for a in annotations:
-      new_a = a.copy()
-      [x,y,w,h] = a['bbox']
-      xc = int(x+(w/2))
-      yc = int(y+(h/2))
-      new_a['object_center'] = [xc, yc]
-      new_anns.append(new_a)
-    anns['annotations'] = new_anns
-    if output_fp:
-        if os.path.exists(output_fp):
-            os.remove(output_fp)
-        with open(output_fp, 'w') as f:
-          json.dump(anns, f, indent = 5)
-    else:
+    ann_ids, centers = centerpoints(anns)
+
+    if sidecar:
+        if not output_fp:
+            output_fp = anns_fp.replace('.json', '-cp.npz')
+        np.savez(output_fp, ann_id = ann_ids, center = centers)
+        return output_fp
+
+    for a, c in zip(anns['annotations'], centers.tolist()):
+      a['object_center'] = c
+    if not output_fp:
         output_fp = anns_fp.replace('.json', '-cp.json')
-        if os.path.exists(output_fp):
-            os.remove(output_fp)
-        with open(output_fp, 'w') as f:
-          json.dump(anns, f, indent = 5)
-     
-    return
\ No newline at end of file
+    if os.path.exists(output_fp):
+        os.remove(output_fp)
+    with open(output_fp, 'w') as f:
+      json.dump(anns, f)
+
+    return output_fp
+
+### geographic index ###
+
+# Meters per degree of latitude, for radius queries
+M_PER_DEG = 111320.0
+EARTH_RADIUS_M = 6371008.8
+
+def geo_bounds(anns):
+    '''
+    IN:
+        - anns: list of coco annotations with 'bbox_geos', as the xview converter writes them
+          ([lon, lat, width, height] in degrees, in geojson coordinate order)
+    OUT:
+        - bounds: float array of shape (n, 4) of [lon_min, lat_min, lon_max, lat_max], nan where
+          an annotation has no 'bbox_geos'
+    '''
+    b = np.array([a.get('bbox_geos') or [np.nan]*4 for a in anns], dtype = float).reshape(-1, 4)
+    return np.c_[b[:, :2], b[:, :2] + b[:, 2:]]
+
+def build_geo_index(gt, cell_deg = None):
+    '''
+    PURPOSE: Bucket every annotation's geographic bounds into a uniform lat/lon grid, so that
+    location queries only look at the few cells they touch
+    IN:
+        - gt: coco gt contents, or a path to them
+        - cell_deg: optional grid cell size in degrees, by default about 8 annotations per cell
+    OUT:
+        - index: dict of the annotation and image ids and bounds, and the grid
+    '''
+    if isinstance(gt, str):
+        with open(gt, 'r') as f:
+            gt = json.load(f)
+    anns = [a for a in gt['annotations'] if a.get('bbox_geos')]
+    bounds = geo_bounds(anns)
+    ann_ids = np.array([a['id'] for a in anns], dtype = np.int64)
+    ann_ims = np.array([a['image_id'] for a in anns])
+
+    # Each image's extent is the union of its annotations' bounds
+    im_ids, im_rows = np.unique(ann_ims, return_inverse = True) if len(anns) else (np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64))
+    im_bounds = np.full((len(im_ids), 4), np.nan)
+    im_bounds[:, :2] = np.inf
+    im_bounds[:, 2:] = -np.inf
+    np.fmin.at(im_bounds[:, 0], im_rows, bounds[:, 0])
+    np.fmin.at(im_bounds[:, 1], im_rows, bounds[:, 1])
+    np.fmax.at(im_bounds[:, 2], im_rows, bounds[:, 2])
+    np.fmax.at(im_bounds[:, 3], im_rows, bounds[:, 3])
+
+    origin = bounds[:, :2].min(axis = 0) if len(anns) else np.zeros(2)
+    if cell_deg is None:
+        extent = bounds[:, 2:].max(axis = 0) - origin if len(anns) else np.ones(2)
+        cell_deg = max(float(np.sqrt(extent[0]*extent[1]/max(len(anns)/8, 1))), 1e-9)
+
+    # Expand every annotation into each of the cells it covers
+    c0 = np.floor((bounds[:, :2] - origin)/cell_deg).astype(np.int64)
+    c1 = np.maximum(np.floor((bounds[:, 2:] - origin)/cell_deg).astype(np.int64), c0)
+    n_cols = int(c1[:, 0].max()) + 1 if len(anns) else 1
+    wx = c1[:, 0] - c0[:, 0] + 1
+    n_cells = wx*(c1[:, 1] - c0[:, 1] + 1)
+    rows = np.repeat(np.arange(len(anns)), n_cells)
+    k = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    keys = (c0[rows, 1] + k//wx[rows])*n_cols + c0[rows, 0] + k%wx[rows]
+    order = np.argsort(keys, kind = 'stable')
+
+    return {
+        'ann_ids': ann_ids, 'ann_ims': ann_ims, 'bounds': bounds,
+        'im_ids': im_ids, 'im_bounds': im_bounds,
+        'origin': origin, 'cell': cell_deg, 'n_cols': n_cols, 'keys': keys[order], 'rows': rows[order]
+    }
+
+def grid_candidates(index, lon_min, lat_min, lon_max, lat_max):
+    '''
+    IN:
+        - index: output of build_geo_index
+        - lon_min, lat_min, lon_max, lat_max: query box in degrees
+    OUT:
+        - int array of the annotation rows in the grid cells the box touches
+    '''
+    cell = index['cell']
+    ox, oy = index['origin']
+    cx0 = max(int(np.floor((lon_min - ox)/cell)), 0)
+    cy0 = max(int(np.floor((lat_min - oy)/cell)), 0)
+    cx1 = min(int(np.floor((lon_max - ox)/cell)), index['n_cols'] - 1)
+    cy1 = int(np.floor((lat_max - oy)/cell))
+    if cx1 < cx0 or cy1 < cy0 or len(index['keys']) == 0:
+        return np.zeros(0, dtype = np.int64)
+
+    # Each grid row of the box is one contiguous run of keys
+    cy = np.arange(cy0, cy1 + 1)
+    lo = np.searchsorted(index['keys'], cy*index['n_cols'] + cx0)
+    hi = np.searchsorted(index['keys'], cy*index['n_cols'] + cx1, side = 'right')
+    return np.unique(np.concatenate([index['rows'][l:h] for l, h in zip(lo, hi)]))
+
+def query_box(index, lat_min, lon_min, lat_max, lon_max):
+    '''
+    PURPOSE: Find the annotations and images overlapping a lat/lon box
+    IN:
+        - index: output of build_geo_index
+        - lat_min, lon_min, lat_max, lon_max: query box in degrees
+    OUT:
+        - ann_ids: array of the ids of annotations overlapping the box
+        - im_ids: array of the ids of images whose extent overlaps the box
+    '''
+    rows = grid_candidates(index, lon_min, lat_min, lon_max, lat_max)
+    b = index['bounds'][rows]
+    hit = (b[:, 0] <= lon_max) & (b[:, 2] >= lon_min) & (b[:, 1] <= lat_max) & (b[:, 3] >= lat_min)
+
+    ib = index['im_bounds']
+    im_hit = (ib[:, 0] <= lon_max) & (ib[:, 2] >= lon_min) & (ib[:, 1] <= lat_max) & (ib[:, 3] >= lat_min)
+    return index['ann_ids'][rows[hit]], index['im_ids'][im_hit]
+
+def distance_to_bounds(bounds, lat, lon):
+    '''
+    IN:
+        - bounds: array (n, 4) of [lon_min, lat_min, lon_max, lat_max]
+        - lat, lon: point in degrees
+    OUT:
+        - float array (n,) of great circle distances in meters from the point to the nearest
+          point of each box, 0 inside it
+    '''
+    near_lon = np.clip(lon, bounds[:, 0], bounds[:, 2])
+    near_lat = np.clip(lat, bounds[:, 1], bounds[:, 3])
+    p1, p2 = np.radians(lat), np.radians(near_lat)
+    dlat = p2 - p1
+    dlon = np.radians(near_lon - lon)
+    a = np.sin(dlat/2)**2 + np.cos(p1)*np.cos(p2)*np.sin(dlon/2)**2
+    return 2*EARTH_RADIUS_M*np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def query_radius(index, lat, lon, radius_m):
+    '''
+    PURPOSE: Find the annotations and images within some distance of a point
+    IN:
+        - index: output of build_geo_index
+        - lat, lon: point in degrees
+        - radius_m: distance in meters
+    OUT:
+        - ann_ids, im_ids: see query_box
+    '''
+    # The box around the circle narrows the candidates, the distance decides
+    d_lat = radius_m/M_PER_DEG
+    d_lon = radius_m/(M_PER_DEG*max(np.cos(np.radians(lat)), 1e-6))
+    rows = grid_candidates(index, lon - d_lon, lat - d_lat, lon + d_lon, lat + d_lat)
+    hit = distance_to_bounds(index['bounds'][rows], lat, lon) <= radius_m
+    im_hit = distance_to_bounds(index['im_bounds'], lat, lon) <= radius_m
+    return index['ann_ids'][rows[hit]], index['im_ids'][im_hit]
+
+def aoi_subset(anns_fp, output_fp, box = None, center = None, radius_m = None, whole_images = False, index = None):
+    '''
+
+    Parameters
+    ----------
+    anns_fp : str,
+        file path to a set of coco ground truth annotations with 'bbox_geos'
+    output_fp : str,
+        where the subset is written
+    box : list, optional
+        [lat_min, lon_min, lat_max, lon_max] area of interest
+    center, radius_m : optional
+        (lat, lon) and a distance in meters, instead of box
+    whole_images : boolean, optional
+        If True, every annotation of an image that reaches into the area is
+        kept, else only the annotations inside it. The default is False.
+    index : dict, optional
+        a build_geo_index of anns_fp, to reuse across many areas
+
+    Writes a coco file with the annotations in the area of interest and
+    their images
+    -------
+    Returns output_fp
+
+    '''
+    with open(anns_fp, 'r') as f:
+      anns = json.load(f)
+    if index is None:
+        index = build_geo_index(anns)
+    if box is not None:
+        ann_ids, _ = query_box(index, *box)
+    else:
+        ann_ids, _ = query_radius(index, center[0], center[1], radius_m)
+
+    keep_anns = set(ann_ids.tolist())
+    keep_ims = set(index['ann_ims'][np.isin(index['ann_ids'], ann_ids)].tolist())
+    if whole_images:
+        keep_anns = None
+    new = anns.copy()
+    new['images'] = [i for i in anns['images'] if i['id'] in keep_ims]
+    new['annotations'] = [a for a in anns['annotations'] if a['image_id'] in keep_ims and (keep_anns is None or a['id'] in keep_anns)]
+
+    with open(output_fp, 'w') as f:
+      json.dump(new, f)
+    print(f"{len(new['annotations'])} annotations on {len(new['images'])} images:", output_fp)
+    return output_fp
+
+def fit_georef(anns):
+    '''
+    PURPOSE: Estimate a north-up image's georeference from its annotations, which
+    carry both a pixel 'bbox' and a 'bbox_geos'
+    IN:
+        - anns: annotations of one image
+    OUT:
+        - (a, b, c, d) with lon = a*x + b and lat = c*y + d, or None if the annotations
+          don't span enough of the image to tell
+    '''
+    anns = [a for a in anns if a.get('bbox_geos')]
+    if not anns:
+        return None
+    px = np.array([a['bbox'][:4] for a in anns], dtype = float)
+    geo = geo_bounds(anns)
+    # Left and right edges give two points per annotation, top is the north edge
+    x = np.r_[px[:, 0], px[:, 0] + px[:, 2]]
+    y = np.r_[px[:, 1], px[:, 1] + px[:, 3]]
+    lon = np.r_[geo[:, 0], geo[:, 2]]
+    lat = np.r_[geo[:, 3], geo[:, 1]]
+    if np.ptp(x) == 0 or np.ptp(y) == 0:
+        return None
+    a, b = np.polyfit(x, lon, 1)
+    c, d = np.polyfit(y, lat, 1)
+    return a, b, c, d
@@ -1,8 +1,17 @@
 import os
+import sys
 import json
+import shutil
+import numpy as np
+from multiprocessing import Pool
 from PIL import Image
 from tqdm import tqdm
-from matplotlib import pyplot as plt
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import geococo as geococo
+import detections as detections
 
 ### support ###
 
@@ -70,7 +79,9 @@ def get_anns_in_box(box, anns):
             new_a['bbox'] = [n_x1, n_y1, n_w, n_h]
             
             b_anns.append(new_a)
-    return b_anns 
+    
+    # Polygons are clipped to the chip, and give the tighter bbox and area
+    return clip_segmentations(b_anns, box)
 
 def anns_on_image(im_id, contents):
     '''
@@ -139,14 +150,669 @@ def get_im_info(im_id, gt_content):
             return i
     return None
 
+def chip_record(chip_num, chip_name, chip_size, parent_info, x, y, gsd = None, scale = None, scale_y = None):
+    '''
+    PURPOSE: The image record of one chip, linked to the image it was cut from
+    IN:
+     - chip_num: int, id of the chip
+     - chip_name: str, file name of the chip
+     - chip_size: int, size of the square chip
+     - parent_info: the 'images' record of the parent image
+     - x, y: int, the chip's top left corner in the parent image
+     - gsd: optional gsd of the chip, by default the parent's
+     - scale: optional factor from parent pixels to chip pixels, if the parent was
+       resized before chipping (x and y are then in the resized parent's pixels)
+     - scale_y: optional factor along y, when it differs from scale along x
+    OUT:
+     - new_image: coco image record with 'parent_id', 'offset_x', 'offset_y' and the gsd
+    '''
+    new_image = {
+        'file_name' : chip_name,
+        'width' : chip_size,
+        'height' : chip_size,
+        'id' : chip_num,
+        'license' : 1,
+        'parent_id' : parent_info['id'],
+        'offset_x' : x,
+        'offset_y' : y
+    }
+    if gsd is not None:
+        new_image['gsd'] = gsd
+    elif 'gsd' in parent_info:
+        new_image['gsd'] = parent_info['gsd']
+    if scale is not None:
+        new_image['parent_scale'] = scale
+    if scale_y is not None and scale_y != scale:
+        new_image['parent_scale_y'] = scale_y
+    return new_image
+
+def chip_name(chip_num, im_id, row, col, chip_size):
+    '''
+    The file name of a chip, '{chip}_{im_id}_{row}_{col}_{h}_{w}.png'
+    '''
+    return str(chip_num) + '_' + str(im_id) + '_{}_{}_{}_{}'.format(row, col, chip_size, chip_size) + '.png'
+
+def plan_chips(im_info, anns, width, height, chip_size, chip_num, folder = '', gsd = None, scale = None, scale_y = None):
+    '''
+    PURPOSE: The chips of one scene: every window with annotations on it, its
+    name, image record and annotations. Shared by chip, gsd_norm_chip and the
+    cached pipeline, so they all cut the same chips
+    IN:
+     - im_info: 'images' record of the scene
+     - anns: the scene's annotations, in the pixels of the image being chipped
+     - width, height: int, size of the image being chipped
+     - chip_size: int, size of the square chips
+     - chip_num: int, id of the first chip
+     - folder: str, added in front of the chip paths
+     - gsd, scale, scale_y: see chip_record, if the scene was resized before chipping
+    OUT:
+     - new_images, new_anns: the chips' records and annotations
+     - chips: list of (chip path, col, row, chip_size), see resample_and_chip
+    '''
+    new_images = []
+    new_anns = []
+    chips = []
+    for row in window_offsets(height, chip_size):
+        for col in window_offsets(width, chip_size):
+            chip_anns = get_anns_in_box([col, row, chip_size, chip_size], anns)
+            if len(chip_anns) == 0:
+                continue
+            name = chip_name(chip_num, im_info['id'], row, col, chip_size)
+            new_images.append(chip_record(chip_num, name, chip_size, im_info, col, row, gsd = gsd, scale = scale, scale_y = scale_y))
+            for a in chip_anns:
+                a['image_id'] = chip_num
+                new_anns.append(a)
+            chips.append((folder + name, col, row, chip_size))
+            chip_num += 1
+    return new_images, new_anns, chips
+
+def gsd_norm_size(im_info, target_gsd):
+    '''
+    IN:
+     - im_info: 'images' record with a 'gsd'
+     - target_gsd: float, gsd to resample to
+    OUT:
+     - (new_w, new_h) of the image at target_gsd, or None if its gsd is missing
+    '''
+    old_gsd = im_info.get('gsd')
+    if old_gsd is None or isinstance(old_gsd, bool) or not old_gsd > 0:
+        return None
+    return (int(float((im_info['width']*old_gsd)/target_gsd)), int(float((im_info['height']*old_gsd)/target_gsd)))
+
+def window_offsets(length, chip_size, stride = None, pad = False):
+    '''
+    PURPOSE: Start positions of the windows along one image axis
+    IN:
+     - length: int, size of the image along this axis
+     - chip_size: int, size of each window
+     - stride: int, distance between window starts, defaults to chip_size (no overlap)
+     - pad: bool, if True a last window is added that runs past the edge, so the
+       whole axis is covered; if False only windows fully on the image are used
+    OUT:
+     - offsets: list of int window starts
+    '''
+    if stride is None:
+        stride = chip_size
+    if pad:
+        n = int(np.ceil(max(length - chip_size, 0)/stride)) + 1 if length > 0 else 0
+    else:
+        n = (length - chip_size)//stride + 1 if length >= chip_size else 0
+    return [i*stride for i in range(n)]
+
+def read_uint8(image):
+    '''
+    IN:
+     - image: str path to an image, or an already loaded array
+    OUT:
+     - img: uint8 array of shape (h, w) or (h, w, c)
+    '''
+    if isinstance(image, np.ndarray):
+        img = image
+    else:
+        with Image.open(image) as im:
+            if im.mode not in ('L', 'RGB', 'RGBA'):
+                im = im.convert('RGB')
+            img = np.asarray(im)
+    if img.dtype != np.uint8:
+        # Float images in [0, 1], as plt.imread returns for png
+        if img.dtype.kind == 'f' and img.max() <= 1:
+            img = img*255
+        img = np.clip(img, 0, 255).astype(np.uint8)
+    return img
+
+def index_by_image(anns):
+    '''
+    IN:
+     - anns: list of coco annotations
+    OUT:
+     - by_image: dict of image id to the list of its annotations
+    '''
+    by_image = {}
+    for a in anns:
+        by_image.setdefault(a['image_id'], []).append(a)
+    return by_image
+
+def scale_anns(anns, old_w, old_h, new_w, new_h):
+    '''
+    PURPOSE: Rescale annotation boxes to a resized image, as gsd_norm does
+    OUT:
+     - new_anns: copies of anns with scaled bboxes
+    '''
+    new_anns = []
+    for a in anns:
+        new_a = a.copy()
+        [x1, y1, w, h] = a['bbox']
+        new_a['bbox'] = [x1/old_w*new_w, y1/old_h*new_h, w/old_w*new_w, h/old_h*new_h]
+        if has_polygons(a):
+            new_a['segmentation'] = scale_segmentation(a['segmentation'], new_w/old_w, new_h/old_h)
+        new_anns.append(new_a)
+    return new_anns
+
+def has_polygons(a):
+    '''
+    IN:
+     - a: coco annotation
+    OUT:
+     - True if its 'segmentation' is polygons: coco's list of flat [x1, y1, x2, y2, ...]
+       lists, or a list of [x, y] points as older fair1m conversions wrote
+    '''
+    seg = a.get('segmentation')
+    return isinstance(seg, list) and len(seg) > 0 and isinstance(seg[0], list)
+
+def ann_polygons(anns):
+    '''
+    PURPOSE: Pack the polygons of many annotations into one padded array
+    IN:
+     - anns: list of coco annotations with polygon segmentations (see has_polygons)
+    OUT:
+     - owner: int array (m,), the index in anns of each polygon
+     - polys: float array (m, v, 2) of vertices, padded past each polygon's count
+     - counts: int array (m,) of the number of vertices of each polygon
+    '''
+    owner, rings = [], []
+    for k, a in enumerate(anns):
+        seg = a['segmentation']
+        # A list of [x, y] points is a single polygon
+        if len(seg[0]) == 2 and not isinstance(seg[0][0], list):
+            seg = [[v for pt in seg for v in pt]]
+        for ring in seg:
+            owner.append(k)
+            rings.append(np.asarray(ring, dtype = float).reshape(-1, 2))
+    counts = np.array([len(r) for r in rings], dtype = np.int64)
+    polys = np.zeros((len(rings), counts.max() if len(rings) else 0, 2))
+    for k, r in enumerate(rings):
+        polys[k, :len(r)] = r
+    return np.array(owner, dtype = np.int64), polys, counts
+
+def clip_polygons(polys, counts, rect):
+    '''
+    PURPOSE: Clip every polygon to a rectangle at once (Sutherland-Hodgman, one
+    pass per rectangle edge over all polygons and vertices together)
+    IN:
+     - polys, counts: see ann_polygons
+     - rect: (x1, y1, x2, y2)
+    OUT:
+     - polys, counts: the clipped polygons, a count of 0 where nothing is left
+    '''
+    n = len(polys)
+    for axis, sign, bound in ((0, 1, rect[0]), (0, -1, rect[2]), (1, 1, rect[1]), (1, -1, rect[3])):
+        v = polys.shape[1]
+        if n == 0 or v == 0:
+            break
+        k = np.arange(v)
+        valid = k < counts[:, None]
+        prev_k = np.where(k == 0, np.maximum(counts[:, None] - 1, 0), k - 1)
+        prev = np.take_along_axis(polys, prev_k[:, :, None], axis = 1)
+
+        d = sign*(polys[:, :, axis] - bound)
+        d_prev = sign*(prev[:, :, axis] - bound)
+        inside = d >= 0
+        crosses = valid & (inside != (d_prev >= 0))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            t = np.where(crosses, d_prev/(d_prev - d), 0)
+        cross_pt = prev + t[:, :, None]*(polys - prev)
+
+        # Each vertex emits the edge's crossing (if any) then itself (if inside)
+        out = np.stack([cross_pt, polys], axis = 2).reshape(n, 2*v, 2)
+        keep = np.stack([crosses, valid & inside], axis = 2).reshape(n, 2*v)
+        order = np.argsort(~keep, axis = 1, kind = 'stable')
+        counts = keep.sum(axis = 1)
+        polys = np.take_along_axis(out, order[:, :, None], axis = 1)[:, :max(counts.max(), 1)]
+    return polys, counts
+
+def polygon_areas(polys, counts):
+    '''
+    OUT:
+     - float array (m,) of the shoelace area of each polygon
+    '''
+    if len(polys) == 0:
+        return np.zeros(0)
+    k = np.arange(polys.shape[1])
+    valid = k < counts[:, None]
+    nxt = np.take_along_axis(polys, np.where(k + 1 < counts[:, None], k + 1, 0)[:, :, None], axis = 1)
+    cross = polys[:, :, 0]*nxt[:, :, 1] - nxt[:, :, 0]*polys[:, :, 1]
+    return np.abs(np.where(valid, cross, 0).sum(axis = 1))/2
+
+def scale_segmentation(seg, sx, sy):
+    '''
+    OUT:
+     - seg with every x multiplied by sx and y by sy, in the same layout
+    '''
+    if len(seg[0]) == 2 and not isinstance(seg[0][0], list):
+        return [[x*sx, y*sy] for x, y in seg]
+    return [[v*(sx if i % 2 == 0 else sy) for i, v in enumerate(ring)] for ring in seg]
+
+def clip_segmentations(anns, box, scale = (1, 1)):
+    '''
+    PURPOSE: Carry polygon annotations onto a chip: polygons are moved to the
+    chip's origin, clipped to it (all of the chip's polygons at once) and scaled
+    to its pixels, and bbox and area are recomputed from what is left
+    IN:
+     - anns: annotations assigned to the chip, segmentations still in scene pixels
+     - box: [x, y, w, h] of the chip in scene pixels
+     - scale: (sx, sy) from scene pixels to chip pixels
+    OUT:
+     - new_anns: anns with polygons rebased to the chip; annotations without
+       polygons are unchanged, and ones whose polygons miss the chip are dropped
+    '''
+    poly_k = [k for k, a in enumerate(anns) if has_polygons(a)]
+    if not poly_k:
+        return anns
+
+    owner, polys, counts = ann_polygons([anns[k] for k in poly_k])
+    polys = (polys - [box[0], box[1]])*scale
+    polys, counts = clip_polygons(polys, counts, (0, 0, box[2]*scale[0], box[3]*scale[1]))
+    areas = polygon_areas(polys, counts)
+    valid = np.arange(polys.shape[1]) < counts[:, None]
+    lo = np.where(valid[:, :, None], polys, np.inf).min(axis = 1)
+    hi = np.where(valid[:, :, None], polys, -np.inf).max(axis = 1)
+
+    new_anns = list(anns)
+    for j, k in enumerate(poly_k):
+        rings = np.flatnonzero((owner == j) & (counts >= 3))
+        if len(rings) == 0:
+            new_anns[k] = None
+            continue
+        x1, y1 = lo[rings].min(axis = 0)
+        x2, y2 = hi[rings].max(axis = 0)
+        new_a = anns[k].copy()
+        new_a['segmentation'] = [polys[r, :counts[r]].reshape(-1).tolist() for r in rings]
+        new_a['bbox'] = [float(x1), float(y1), float(x2 - x1), float(y2 - y1)]
+        new_a['area'] = float(areas[rings].sum())
+        new_anns[k] = new_a
+    return [a for a in new_anns if a is not None]
+
+def clip_ann(a, im_w, im_h):
+    '''
+    PURPOSE: The check clip_anns_to_ims makes on each annotation
+    IN:
+     - a: coco annotation
+     - im_w, im_h: size of its image
+    OUT:
+     - new_ann: copy of a with its bbox clipped to the image, or None if
+       nothing of it is left
+    '''
+    new_ann = a.copy()
+    x1,y1,w,h = a['bbox']
+    x2 = x1+w
+    y2 = y1+h
+        
+    # check coordinates which are too large 
+    if (y2 > im_h) or (x2 > im_w):
+        xc = (x1+x2)/2
+        yc = (y1+y2)/2
+        if (x1 < im_h) and (y2 < im_h):
+            if (xc < im_h) and (yc < im_h):
+              if (x2 > im_w):
+                w = im_w - x1
+                x2 = x1 + w
+              if (y2 > im_h):
+                h = im_h - y1
+                y2 = y1 + h
+    # check coordinates which are too small         
+    if (y1 < 0) or (x2 < 0):
+        xc = (x1+x2)/2
+        yc = (y1+y2)/2
+        if (xc > 0) and (yc > 0):
+          if y1 < 0:
+            y1 = 0
+            h = y2 - y1
+          if x1 < 0:
+            x1 = 0
+            w = x2 - x1
+    
+    # make sure that after all modifications the annotation still has
+    # a width and a height
+    if (w > 0) and (h > 0):
+        new_ann['bbox'] = [x1,y1,w,h]
+        return new_ann
+    return None
+
+def read_manifest(manifest_path):
+    '''
+    PURPOSE: Read the scenes finished by an earlier resumable chip run
+    IN:
+     - manifest_path: str, json lines file written by append_manifest
+    OUT:
+     - done: set of finished image ids
+     - images, anns: the chip images and annotations of those scenes
+    '''
+    done = set()
+    images = []
+    anns = []
+    if not os.path.exists(manifest_path):
+        return done, images, anns
+
+    complete = 0
+    with open(manifest_path, 'rb') as f:
+        for line in f:
+            # A record only counts once its newline is written. A line without one
+            # was cut short by a crash (even if it parses), and that scene is simply redone
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            done.add(record['im_id'])
+            images += record['images']
+            anns += record['annotations']
+            complete += len(line)
+
+    # Drop anything after the last complete record, so new records start on a fresh line
+    if complete < os.path.getsize(manifest_path):
+        os.truncate(manifest_path, complete)
+    return done, images, anns
+
+def append_manifest(manifest, im_id, images, anns):
+    '''
+    PURPOSE: Record one finished scene, and make sure it reaches the disk
+    IN:
+     - manifest: file open for appending
+     - im_id: id of the finished scene
+     - images, anns: the chip images and annotations made from it
+    '''
+    manifest.write(json.dumps({'im_id': im_id, 'images': images, 'annotations': anns}) + '\n')
+    manifest.flush()
+    os.fsync(manifest.fileno())
+
+def resume_manifest(gt_new_path):
+    '''
+    PURPOSE: Open the manifest of a resumable chip run, beside its new coco json
+    OUT:
+     - done, images, anns: see read_manifest
+     - manifest: the manifest, open for appending
+    '''
+    manifest_path = gt_new_path + '.manifest'
+    done, images, anns = read_manifest(manifest_path)
+    if done:
+        print(f'Resuming: {len(done)} scenes already chipped')
+    return done, images, anns, open(manifest_path, 'a')
+
+def write_chips(worker, tasks, new_images, new_anns, workers = None, manifest = None):
+    '''
+    PURPOSE: Cut the planned chips of every scene in parallel. Scenes finish in the
+    order they were planned, and each one's chips and annotations are added to
+    new_images and new_anns (and the manifest of a resumable run) once its chips
+    are on disk, so a crash leaves the manifest with whole scenes only
+    IN:
+     - worker: resample_and_chip or crop_windows
+     - tasks: list of (im_id, chip images, chip annotations, task for worker)
+     - new_images, new_anns: lists the chips and annotations are added to
+     - workers: int number of processes, by default one per cpu
+     - manifest: optional manifest open for appending, see resume_manifest
+    OUT:
+     - written: int number of chips written
+    '''
+    written = 0
+    with Pool(workers) as pool:
+        results = pool.imap(worker, [t[3] for t in tasks])
+        for (im_id, images, anns, _), n in zip(tasks, tqdm(results, total = len(tasks), desc = 'Chipping')):
+            written += n
+            new_images += images
+            new_anns += anns
+            if manifest is not None:
+                append_manifest(manifest, im_id, images, anns)
+    if manifest is not None:
+        manifest.close()
+    return written
+
+def convert_one(im_path, new_path = None):
+    '''
+    PURPOSE: Worker for convert_rgb
+    IN:
+     - im_path: str, image to convert to RGB in place
+     - new_path: optional str, write the RGB image here instead (a copy if it
+       already is RGB), leaving im_path as it is
+    OUT:
+     - 'converted', 'skipped' (already RGB) or 'failed'
+    '''
+    if new_path is None:
+        new_path = im_path
+    tmp_path = new_path + '.tmp'
+    try:
+        # Opening only reads the header, the pixels are decoded on convert
+        with Image.open(im_path) as img:
+            if img.mode == 'RGB':
+                if new_path != im_path:
+                    shutil.copyfile(im_path, tmp_path)
+                    os.replace(tmp_path, new_path)
+                return 'skipped'
+            fmt = img.format
+            img.convert('RGB').save(tmp_path, format = fmt)
+        os.replace(tmp_path, new_path)
+        return 'converted'
+    except Exception as e:
+        print(f'Issue with {im_path}: {e}')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return 'failed'
+
+def resample_and_chip(task):
+    '''
+    PURPOSE: Worker for chip and gsd_norm_chip: decode one scene, resize it if asked and
+    save its planned chips
+    IN:
+     - task: (image path, (new_w, new_h) or None to chip it as it is,
+       list of (chip path, col, row, chip_size))
+    OUT:
+     - int number of chips written
+    '''
+    im_path, new_size, chips = task
+    todo = [c for c in chips if not os.path.exists(c[0])]
+    if not todo:
+        return 0
+    with Image.open(im_path) as img:
+        img = img.resize(new_size) if new_size is not None else img.copy()
+    for chip_path, col, row, size in todo:
+        # Write then rename, so a crash never leaves a partial chip behind
+        img.crop((col, row, col + size, row + size)).save(chip_path + '.tmp', format = 'png')
+        os.replace(chip_path + '.tmp', chip_path)
+    return len(todo)
+
+def resize_image(im_path, new_size, new_path):
+    '''
+    PURPOSE: Write a resized copy of an image, for gsd_norm
+    IN:
+     - im_path: str, image to resize
+     - new_size: (new_w, new_h), see gsd_norm_size
+     - new_path: str, where the resized image is written
+    '''
+    with Image.open(im_path) as img:
+        img.resize(new_size).save(new_path)
+
+def crop_windows(task):
+    '''
+    PURPOSE: Worker for geo_chip: decode one scene and save its planned windows,
+    each resampled to its chip size. The whole scene is decoded once, as PIL has
+    no windowed read for png or jpeg
+    IN:
+     - task: (image path, list of (chip path, (x1, y1, x2, y2) in scene pixels, chip_size))
+    OUT:
+     - int number of chips written
+    '''
+    im_path, chips = task
+    todo = [c for c in chips if not os.path.exists(c[0])]
+    if not todo:
+        return 0
+    with Image.open(im_path) as img:
+        img.load()
+        for chip_path, (x1, y1, x2, y2), size in todo:
+            # Crop whole pixels (padding past the edges), then resample the exact window
+            ix1, iy1 = int(np.floor(x1)), int(np.floor(y1))
+            ix2, iy2 = int(np.ceil(x2)), int(np.ceil(y2))
+            tile = img.crop((ix1, iy1, ix2, iy2))
+            tile = tile.resize((size, size), box = (x1 - ix1, y1 - iy1, x2 - ix1, y2 - iy1))
+            tile.save(chip_path + '.tmp', format = 'png')
+            os.replace(chip_path + '.tmp', chip_path)
+    return len(todo)
+
+def window_anns(anns, bboxes, window, size):
+    '''
+    PURPOSE: The annotations geo_chip puts on one chip: those whose centerpoint
+    falls inside the window, clipped to it and resampled to the chip's pixels
+    IN:
+     - anns: the scene's annotations
+     - bboxes: float array (n, 4) of their bboxes
+     - window: (x1, y1, x2, y2) in scene pixels, may run past the scene's edges
+     - size: int, chip size in pixels
+    OUT:
+     - new_anns: copies of the annotations on the chip
+    '''
+    x1, y1, x2, y2 = window
+    c = bboxes[:, :2] + bboxes[:, 2:]/2
+    on = np.flatnonzero((c[:, 0] > x1) & (c[:, 0] < x2) & (c[:, 1] > y1) & (c[:, 1] < y2))
+    if len(on) == 0:
+        return []
+    b = bboxes[on]
+    s = np.array([size/(x2 - x1), size/(y2 - y1)])
+    lo = np.clip((b[:, :2] - [x1, y1])*s, 0, size)
+    hi = np.clip((b[:, :2] + b[:, 2:] - [x1, y1])*s, 0, size)
+    new_anns = []
+    for k, box in zip(on, np.c_[lo, hi - lo].tolist()):
+        new_a = anns[k].copy()
+        new_a['bbox'] = box
+        new_anns.append(new_a)
+    return clip_segmentations(new_anns, [x1, y1, x2 - x1, y2 - y1], s)
+
+def footprint_windows(im_info, anns, footprint_m, align, cell_deg):
+    '''
+    PURPOSE: The windows geo_chip cuts from one scene
+    IN:
+     - im_info, anns: the scene's coco image record and annotations
+     - footprint_m, align, cell_deg: see geo_chip
+    OUT:
+     - windows: list of (x1, y1, x2, y2) float windows in scene pixels, or None if
+       the scene can't be placed (no gsd, or no georeferenced annotations)
+    '''
+    im_w, im_h = im_info['width'], im_info['height']
+    if align == 'image':
+        # Missing gsd may be None or the False placeholder some converters leave
+        gsd = im_info.get('gsd')
+        if gsd is None or isinstance(gsd, bool) or not float(gsd) > 0:
+            return None
+        side = footprint_m/float(gsd)
+        xs = np.arange(int(im_w//side))*side
+        ys = np.arange(int(im_h//side))*side
+        return [(x, y, x + side, y + side) for y in ys for x in xs]
+
+    georef = geococo.fit_georef(anns)
+    if georef is None:
+        return None
+    a, b, c, d = georef
+    lon_deg, lat_deg = cell_deg
+
+    # Grid lines sit on multiples of the cell size, so overlapping scenes share them
+    lons = sorted([b, a*im_w + b])
+    lats = sorted([d, c*im_h + d])
+    k_lon = np.arange(np.floor(lons[0]/lon_deg), np.ceil(lons[1]/lon_deg))
+    k_lat = np.arange(np.floor(lats[0]/lat_deg), np.ceil(lats[1]/lat_deg))[::-1]
+    windows = []
+    for j in k_lat:
+        for i in k_lon:
+            x = sorted([(i*lon_deg - b)/a, ((i + 1)*lon_deg - b)/a])
+            y = sorted([(j*lat_deg - d)/c, ((j + 1)*lat_deg - d)/c])
+            windows.append((x[0], y[0], x[1], y[1]))
+    return windows
+
 ### functions ###
 
-def chip(coco_gt, image_folder, new_image_folder, chip_size):
+def iter_tiles(image, chip_size, stride = None, overlap = 0, pad = True, pad_value = 0, batch_size = None):
+    '''
+    PURPOSE: Slide a window over one scene in memory, for running a detector
+    without writing chips to disk
+    IN:
+     - image: str path to an image, or an already loaded array
+     - chip_size: int, size of each square tile
+     - stride: int, distance between tiles, defaults to chip_size - overlap
+     - overlap: int, pixels shared by neighboring tiles, used if stride is None
+     - pad: bool, if True edge tiles run past the image and are filled with
+       pad_value, so the whole scene is covered; if False partial tiles are skipped
+     - pad_value: value of padded pixels
+     - batch_size: int, if set tiles are grouped into arrays of up to this many
+    OUT:
+     - generator over ((x, y), tile) with (x, y) the tile's top left corner in
+       the scene and tile a uint8 array of shape (chip_size, chip_size[, c]), or
+       if batch_size is set over (offsets, tiles) arrays of shape (n, 2) and
+       (n, chip_size, chip_size[, c])
+    '''
+    if stride is None:
+        stride = chip_size - overlap
+    if stride <= 0:
+        raise ValueError('overlap must be smaller than chip_size')
+
+    img = read_uint8(image)
+    h, w = img.shape[:2]
+    shape = (chip_size, chip_size) + img.shape[2:]
+
+    offsets = []
+    tiles = []
+    for y in window_offsets(h, chip_size, stride, pad):
+        for x in window_offsets(w, chip_size, stride, pad):
+            window = img[y:y + chip_size, x:x + chip_size]
+            if window.shape != shape:
+                tile = np.full(shape, pad_value, dtype = np.uint8)
+                tile[:window.shape[0], :window.shape[1]] = window
+            else:
+                tile = window
+
+            if batch_size is None:
+                yield (x, y), tile
+                continue
+            offsets.append((x, y))
+            tiles.append(tile)
+            if len(tiles) == batch_size:
+                yield np.array(offsets), np.stack(tiles)
+                offsets = []
+                tiles = []
+
+    if tiles:
+        yield np.array(offsets), np.stack(tiles)
+
+def chip(coco_gt, image_folder, new_image_folder, chip_size, resume = False, footprint_m = None, align = 'image',
+         workers = None):
     '''
     Purpose: Take a coco style json and associated image folder, 
     and create a new coco json and image folder containing new images 
     of the specified size
+
+    Chips are planned from the annotations and each image's header, then the
+    scenes are cut in parallel with workers processes (by default one per cpu).
+    Each worker decodes its whole scene once, as PIL has no windowed read for
+    png or jpeg, and chips keep the scene's mode (e.g. RGB).
+
+    With footprint_m set, chips cover a fixed ground footprint in meters instead
+    (see geo_chip), resampled to chip_size pixels, tiled from each scene's corner
+    or on a shared lat/lon grid with align = 'geo'.
+
+    With resume = True, each finished scene's chips and annotations are appended
+    to a manifest beside the new coco json as soon as the scene is done. Running
+    again after a crash skips the scenes in the manifest and continues the chip
+    numbering where it stopped.
     '''
+    if footprint_m is not None:
+        return geo_chip(coco_gt, image_folder, new_image_folder, footprint_m, chip_size, align,
+                        workers = workers, resume = resume)
     
     # Open gt json
     with open(coco_gt, 'r') as f:
@@ -162,74 +828,36 @@ def chip(coco_gt, image_folder, new_image_folder, chip_size):
     if not os.path.exists(new_image_folder):
         os.mkdir(new_image_folder)
     
-    chip_num = 0
+    # Pick up the scenes finished by an earlier run
+    done = set()
+    manifest = None
+    if resume:
+        done, new_images, new_anns, manifest = resume_manifest(gt_new_path)
+    chip_num = max([i['id'] for i in new_images], default = -1) + 1
     
-    # Iterate through data one image at a time
-    image_ids = get_im_ids(coco_gt)
-    images_processed = 0
-    for im_id in tqdm(image_ids):
-        # Get all original annotations on this image
-        im_anns = anns_on_image(im_id, gt_og)
-        
-        # Open the image
-        im_str = get_im_name_from_id(im_id, gt_og)
-        im_name = image_folder + im_str
-        if os.path.exists(im_name):
-            img = plt.imread(im_name)
-            
-            # Get image dimensions
-            try:
-              (x,y,c) = img.shape
-            except:
-              (x,y) = img.shape
-            num_x = int(x/chip_size)
-            num_y = int(y/chip_size)
-            
-            # Process each individual chip on this image
-            for x_i in range(num_x):
-                for y_i in range(num_y):
-                    
-                    # Get chip coords
-                    c_x1 = x_i * chip_size
-                    c_y1 = y_i * chip_size
-                    bbox = [c_y1, c_x1, chip_size, chip_size]
-                    
-                    # If there are annotations on this image, save out a chip
-                    anns = get_anns_in_box(bbox, im_anns)
-                    if len(anns) > 0:
-                        chip_name = str(chip_num) + '_' + str(im_id) + '_{}_{}_{}_{}'.format(c_x1, c_y1, chip_size, chip_size) + '.png'
-                        chip_path = new_image_folder + chip_name
-                        
-                        # Update image annotation
-                        new_image = {
-                            'file_name' : chip_name,
-                            'width' : chip_size,
-                            'height' : chip_size,
-                            'id' : chip_num,
-                            'license' : 1
-                        }
-                        new_images.append(new_image)
-                        
-                        # Update object annotations
-                        for a in anns:
-                            new_a = a.copy()
-                            new_a['image_id'] = chip_num
-                            new_anns.append(new_a)
-                        
-                        
-                        chip_num += 1
-                        image_chip = img[c_x1:c_x1 + chip_size, c_y1:c_y1 + chip_size]
-                        
-                        if not os.path.exists(chip_path):
-                            try:
-                                plt.imsave(chip_path, image_chip)
-                            except:
-                                continue
-            
-                            
-            images_processed += 1
-        else:
+    # Look up names and annotations once, instead of scanning per image
+    anns_by_image = index_by_image(gt_og['annotations'])
+    im_infos = {i['id']: i for i in gt_og['images']}
+    
+    # Plan every scene's chips, reading only the image headers
+    tasks = []
+    for im_id in tqdm(get_im_ids(coco_gt), desc = 'Planning chips'):
+        if im_id in done:
+            continue
+        im_info = im_infos[im_id]
+        im_name = image_folder + im_info['file_name']
+        if not os.path.exists(im_name):
             print(f'Issue with {im_id}')
+            continue
+        with Image.open(im_name) as img:
+            (w, h) = img.size
+        
+        chip_images, chip_anns, chips = plan_chips(im_info, anns_by_image.get(im_id, []), w, h, chip_size, chip_num, new_image_folder)
+        chip_num += len(chip_images)
+        tasks.append((im_id, chip_images, chip_anns, (im_name, None, chips)))
+    
+    # Cut them in parallel
+    write_chips(resample_and_chip, tasks, new_images, new_anns, workers, manifest)
         
     # Save out new gt file
     new_gt = gt_og.copy()
@@ -267,46 +895,15 @@ def clip_anns_to_ims(coco_gt):
     
     # check the annotations
     for a in tqdm(anns['annotations']):
-        new_ann = a.copy()
-        x1,y1,w,h = a['bbox']
-        x2 = x1+w
-        y2 = y1+h
-
         im_id = a['image_id']
         for i in anns['images']:
           if i['id'] == im_id:
             im_w = i['width']
             im_h = i['height']
-            
-        # check coordinates which are too large 
-        if (y2 > im_h) or (x2 > im_w):
-            xc = (x1+x2)/2
-            yc = (y1+y2)/2
-            if (x1 < im_h) and (y2 < im_h):
-                if (xc < im_h) and (yc < im_h):
-                  if (x2 > im_w):
-                    w = im_w - x1
-                    x2 = x1 + w
-                  if (y2 > im_h):
-                    h = im_h - y1
-                    y2 = y1 + h
-        # check coordinates which are too small         
-        if (y1 < 0) or (x2 < 0):
-            xc = (x1+x2)/2
-            yc = (y1+y2)/2
-            if (xc > 0) and (yc > 0):
-              if y1 < 0:
-                y1 = 0
-                h = y2 - y1
-              if x1 < 0:
-                x1 = 0
-                w = x2 - x1
         
-        # make sure that after all modifications the annotation still has
-        # a width and a height
-        if (w > 0) and (h > 0):
-                    new_ann['bbox'] = [x1,y1,w,h]
-                    new_anns.append(new_ann)
+        new_ann = clip_ann(a, im_w, im_h)
+        if new_ann is not None:
+            new_anns.append(new_ann)
     anns['annotations'] = new_anns
     
     # save out the modified annotations
@@ -336,6 +933,7 @@ def add_gsd_to_chips(full_gt_fp, chip_gt_fp):
     with open(chip_gt_fp, 'r') as f:
         data_chip = json.load(f)
     images_chip = data_chip['images']
+    gsd_by_id = {i['id']: i.get('gsd') for i in data_full['images']}
 
     new_images_c = []
 
@@ -344,13 +942,13 @@ def add_gsd_to_chips(full_gt_fp, chip_gt_fp):
         # copy the data
         new_i_c = i_c.copy()
 
-        # get the full image info from the chip name
-        im_name_c = i_c['file_name']
-
-        full_im_id = int(im_name_c.split('_')[1])
+        # get the full image from the chip's lineage
+        full_im_id = detections.chip_parent(i_c)[0]
 
         # add gsd
-        new_i_c['gsd'] = get_im_gsd_from_id(full_im_id, data_full)
+        if full_im_id not in gsd_by_id:
+            print(f'GSD Missing: Image {full_im_id}')
+        new_i_c['gsd'] = gsd_by_id.get(full_im_id)
         new_images_c.append(new_i_c)
 
     data_chip['images'] = new_images_c
@@ -365,21 +963,31 @@ def add_gsd_to_chips(full_gt_fp, chip_gt_fp):
 
     return chip_anns_gsd
 
-def convert_rgb(image_folder):
+def convert_rgb(image_folder, workers = None):
     '''
     Purpose: force all images in folder to assume kosher image format
+
+    Images are converted in parallel. Only the header is read to check the mode,
+    so images that are already RGB are skipped, and converted images are written
+    to a temporary file that then replaces the original, so a crash never leaves
+    a half-written image
+    IN:
+     - image_folder: str, folder of images, converted in place
+     - workers: int number of processes, by default one per cpu
+    OUT:
+     - counts: dict of how many images were 'converted', 'skipped' and 'failed'
     '''
     test_images = os.listdir(image_folder)
-    test_images = [image_folder + i for i in test_images]
-    count  = 0
-    for i in test_images:   
-        img = Image.open(i).convert('RGB')
-        img.save(i)
-        count += 1
-        if count % 250 == 0:
-            print(count)
-    
-    return
+    # .tmp files are conversions a crash cut short, not images
+    test_images = [image_folder + i for i in test_images if os.path.isfile(image_folder + i) and not i.endswith('.tmp')]
+
+    counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+    with Pool(workers) as pool:
+        for result in tqdm(pool.imap_unordered(convert_one, test_images, chunksize = 16), total = len(test_images)):
+            counts[result] += 1
+
+    print(f"{counts['converted']} images converted, {counts['skipped']} already RGB, {counts['failed']} failed")
+    return counts
 
 def gsd_norm(target_gsd, image_dir, ann_path, new_exp_dir):
     # Create new experimental directory
@@ -407,21 +1015,14 @@ def gsd_norm(target_gsd, image_dir, ann_path, new_exp_dir):
         
         
         new_im_info = im_info.copy()
-
-        #pull old image information
-        old_im_h = im_info['height']
-        old_im_w = im_info['width']
-        # Get old gsd
-        old_gsd = im_info['gsd']
         
         anns = anns_on_image(im_id, gt)
         
         try:
-            if old_gsd is not None:
-
-                # Create new image height and width
-                new_im_h = int(float((old_im_h*old_gsd)/target_gsd))
-                new_im_w = int(float((old_im_w*old_gsd)/target_gsd))
+            # Create new image height and width, if the gsd is known
+            new_size = gsd_norm_size(im_info, target_gsd)
+            if new_size is not None:
+                (new_im_w, new_im_h) = new_size
 
                 new_im_info['height'] = new_im_h
                 new_im_info['width'] = new_im_w
@@ -429,45 +1030,179 @@ def gsd_norm(target_gsd, image_dir, ann_path, new_exp_dir):
 
                 new_gt['images'].append(new_im_info)
                 
-                new_path = new_im_dir + im_info['file_name']
-                old_path = image_dir + im_info['file_name']
-                
-                img = Image.open(old_path)
-                
-                img = img.resize((new_im_w, new_im_h))
-                
-                img.save(new_path)
+                resize_image(image_dir + im_info['file_name'], new_size, new_im_dir + im_info['file_name'])
 
-                for a in anns:
-                    new_a = a.copy()
+                # Scale the bboxes and polygons to the new size
+                new_gt['annotations'] += scale_anns(anns, im_info['width'], im_info['height'], new_im_w, new_im_h)
 
-                    # get current annotation bbox for each annotation
-                    [old_x1, old_y1, old_w, old_h] = a['bbox']
+                
+        except:
+            print(im_id, 'problem')
+            
 
-                    # Created scaled versions of the bbox
-                    scaled_x1 = old_x1/old_im_w
-                    scaled_w = old_w/old_im_w
+    with open(new_json, 'w') as f:
+        json.dump(new_gt, f)
 
-                    scaled_y1 = old_y1/old_im_h
-                    scaled_h = old_h/old_im_h
+    return
 
-                    # Create new bbox
-                    x1 = scaled_x1 * new_im_w
-                    w = scaled_w * new_im_w
+def gsd_norm_chip(target_gsd, image_dir, ann_path, new_exp_dir, chip_size, workers = None):
+    '''
+    PURPOSE: gsd_norm followed by chip in one pass, decoding each scene once and
+    never writing the resampled scenes to disk. Chips and annotations are planned
+    from the annotations alone, then scenes are resized and chipped in parallel.
+    For lossless scenes the chips are pixel for pixel those of gsd_norm then chip
+    IN:
+     - target_gsd: float, gsd to resample every scene to
+     - image_dir: folder of the original scenes
+     - ann_path: coco gt file of the scenes, with a 'gsd' for each image
+     - new_exp_dir: folder for the new images/ folder and gt file
+     - chip_size: int, size of the square chips
+     - workers: int number of processes, by default one per cpu
+    OUT:
+     - new_json: str, path to the chip gt file
+    '''
+    new_im_dir = new_exp_dir + 'images/'
+    if not os.path.exists(new_im_dir):
+        os.makedirs(new_im_dir)
+    new_json = new_exp_dir + os.path.basename(ann_path).split('_')[-1].replace('.json', f'_{chip_size}.json')
 
-                    y1 = scaled_y1 * new_im_h
-                    h = scaled_h * new_im_h
+    with open(ann_path, 'r') as f:
+        gt = json.load(f)
+    anns_by_image = index_by_image(gt['annotations'])
 
-                    new_a['bbox'] = [x1, y1, w, h]
+    new_images = []
+    new_anns = []
+    tasks = []
+    chip_num = 0
+    for im_info in tqdm(gt['images'], desc = 'Planning chips'):
+        im_id = im_info['id']
+        new_size = gsd_norm_size(im_info, target_gsd)
+        if new_size is None:
+            print(f'GSD Missing: Image {im_id}')
+            continue
 
-                    new_gt['annotations'].append(new_a)
+        # Same sizes as gsd_norm, and same windows, names and annotation assignment as chip. The
+        # scales are those of the rounded sizes, the ones the annotations are scaled by
+        new_im_w, new_im_h = new_size
+        anns = scale_anns(anns_by_image.get(im_id, []), im_info['width'], im_info['height'], new_im_w, new_im_h)
+        chip_images, chip_anns, chips = plan_chips(im_info, anns, new_im_w, new_im_h, chip_size, chip_num, new_im_dir,
+                                                   gsd = target_gsd, scale = new_im_w/im_info['width'],
+                                                   scale_y = new_im_h/im_info['height'])
+        chip_num += len(chip_images)
+        tasks.append((im_id, chip_images, chip_anns, (image_dir + im_info['file_name'], new_size, chips)))
 
-                
-        except:
-            print(im_id, 'problem')
-            
+    written = write_chips(resample_and_chip, tasks, new_images, new_anns, workers)
 
+    new_gt = gt.copy()
+    new_gt['images'] = new_images
+    new_gt['annotations'] = new_anns
     with open(new_json, 'w') as f:
         json.dump(new_gt, f)
 
-    return
\ No newline at end of file
+    print(f'{written} chips written from {len(tasks)} scenes')
+    print('New ground truth:', new_json)
+    print('New images:', new_im_dir)
+
+    return new_json
+
+def geo_chip(coco_gt, image_folder, new_image_folder, footprint_m, chip_size = None, align = 'image',
+             cell_deg = None, workers = None, resume = False):
+    '''
+    PURPOSE: Chip scenes into tiles of a fixed ground footprint instead of a fixed
+    number of pixels, so chips from different sensors cover comparable areas.
+    Windows and annotations are planned from the annotations alone, then scenes
+    are cropped and resampled in parallel, as in gsd_norm_chip
+    IN:
+     - coco_gt: str, coco gt file of the scenes
+     - image_folder: folder of the scenes
+     - new_image_folder: folder the chips are written to
+     - footprint_m: float, side of each chip on the ground, in meters
+     - chip_size: optional int, every chip is resampled to this many pixels; by
+       default chips keep their scene's resolution (footprint_m/gsd pixels)
+     - align: 'image' tiles each scene from its top left corner using its 'gsd';
+       'geo' tiles on a lat/lon grid shared by every scene, placed using the
+       annotations' 'bbox_geos', so chips of overlapping scenes line up
+     - cell_deg: optional (lon, lat) grid cell size in degrees for align = 'geo',
+       by default footprint_m at the mean latitude of the dataset
+     - workers: int number of processes, by default one per cpu
+     - resume: if True, finished scenes are recorded in a manifest and skipped
+       when run again, as in chip
+    OUT:
+     - gt_new_path: str, path to the chip gt file. Chip records link back to their
+       scene like chip's, with 'parent_scale' from scene pixels to chip pixels
+       (and 'parent_scale_y' along y where it differs)
+    '''
+    if align not in ('image', 'geo'):
+        raise ValueError(f'align must be image or geo, not {align}')
+
+    with open(coco_gt, 'r') as f:
+        gt_og = json.load(f)
+    gt_new_path = coco_gt.replace('.json', '_{}m.json'.format(footprint_m))
+    if not os.path.exists(new_image_folder):
+        os.makedirs(new_image_folder)
+
+    anns_by_image = index_by_image(gt_og['annotations'])
+    if align == 'geo' and cell_deg is None:
+        bounds = geococo.geo_bounds(gt_og['annotations'])
+        lat_ref = np.nanmean((bounds[:, 1] + bounds[:, 3])/2)
+        lat_deg = footprint_m/geococo.M_PER_DEG
+        cell_deg = (lat_deg/np.cos(np.radians(lat_ref)), lat_deg)
+
+    # Pick up the scenes finished by an earlier run
+    done = set()
+    new_images = []
+    new_anns = []
+    manifest = None
+    if resume:
+        done, new_images, new_anns, manifest = resume_manifest(gt_new_path)
+    chip_num = max([i['id'] for i in new_images], default = -1) + 1
+
+    tasks = []
+    for im_info in tqdm(gt_og['images'], desc = 'Planning chips'):
+        im_id = im_info['id']
+        if im_id in done:
+            continue
+        im_anns = anns_by_image.get(im_id, [])
+        windows = footprint_windows(im_info, im_anns, footprint_m, align, cell_deg)
+        if windows is None:
+            print(f'Issue with {im_id}')
+            continue
+
+        chips = []
+        chip_images = []
+        chip_anns = []
+        bboxes = np.array([a['bbox'][:4] for a in im_anns], dtype = float).reshape(-1, 4)
+        for x1, y1, x2, y2 in windows:
+            size = chip_size if chip_size is not None else max(int(round(x2 - x1)), 1)
+            anns = window_anns(im_anns, bboxes, (x1, y1, x2, y2), size)
+            if len(anns) == 0:
+                continue
+            # Geo windows are not quite square, so each axis keeps its own scale
+            scale, scale_y = size/(x2 - x1), size/(y2 - y1)
+            chip_name = str(chip_num) + '_' + str(im_id) + '_{}_{}_{}_{}'.format(int(round(y1)), int(round(x1)), size, size) + '.png'
+
+            # Offsets are in resampled scene pixels, as detections.stitch expects
+            gsd = footprint_m/size
+            chip_images.append(chip_record(chip_num, chip_name, size, im_info, x1*scale, y1*scale_y, gsd = gsd,
+                                           scale = scale, scale_y = scale_y))
+            for a in anns:
+                a['image_id'] = chip_num
+                chip_anns.append(a)
+            chips.append((new_image_folder + chip_name, (x1, y1, x2, y2), size))
+            chip_num += 1
+
+        tasks.append((im_id, chip_images, chip_anns, (image_folder + im_info['file_name'], chips)))
+
+    written = write_chips(crop_windows, tasks, new_images, new_anns, workers, manifest)
+
+    new_gt = gt_og.copy()
+    new_gt['images'] = new_images
+    new_gt['annotations'] = new_anns
+    with open(gt_new_path, 'w') as f:
+        json.dump(new_gt, f)
+
+    print(f'{written} chips written from {len(tasks)} scenes')
+    print('New ground truth:', gt_new_path)
+    print('New images:', new_image_folder)
+
+    return gt_new_path
@@ -0,0 +1,170 @@
+import os
+import sys
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stream as stream
+
+### support ###
+
+def category_maps(headers):
+    '''
+    PURPOSE: Unify categories by name, as make_ids_match does: the first file's
+    ids are kept, and names it doesn't have get new ids after them
+    IN:
+     - headers: list of each file's small sections (see stream.load_except)
+    OUT:
+     - categories: the merged categories
+     - cat_maps: list, per file, of dict of old category id to merged id
+    '''
+    categories = []
+    by_name = {}
+    cat_maps = []
+    for h in headers:
+        cat_map = {}
+        for c in h.get('categories', []):
+            if c['name'] not in by_name:
+                taken = [m['id'] for m in categories]
+                new_c = c.copy()
+                if c['id'] in taken:
+                    new_c['id'] = max(taken) + 1
+                by_name[c['name']] = new_c['id']
+                categories.append(new_c)
+            cat_map[c['id']] = by_name[c['name']]
+        cat_maps.append(cat_map)
+    return categories, cat_maps
+
+def license_maps(headers):
+    '''
+    PURPOSE: Unify licenses by name and url, giving each distinct one a new id
+    IN:
+     - headers: see category_maps, 'licenses' may be a list or (as fair1m
+       writes it) a single 'license' record
+    OUT:
+     - licenses: the merged licenses
+     - lic_maps: list, per file, of dict of old license id to merged id
+    '''
+    licenses = []
+    by_key = {}
+    lic_maps = []
+    for h in headers:
+        lics = h.get('licenses', h.get('license', []))
+        if isinstance(lics, dict):
+            lics = [lics]
+        lic_map = {}
+        for l in lics:
+            key = (l.get('name'), l.get('url'))
+            if key not in by_key:
+                by_key[key] = len(licenses)
+                new_l = l.copy()
+                new_l['id'] = len(licenses)
+                licenses.append(new_l)
+            lic_map[l['id']] = by_key[key]
+        lic_maps.append(lic_map)
+    return licenses, lic_maps
+
+def iter_images(coco_paths, im_maps, licenses, lic_maps, prefixes):
+    '''
+    PURPOSE: Stream every file's images with new sequential ids, recording each
+    file's old to new image ids in im_maps as it goes. A license id a file
+    doesn't list (e.g. chips, which always say license 1) gets a placeholder
+    license of its own, added to licenses, so it can't collide with another
+    file's
+    '''
+    new_id = 0
+    for k, path in enumerate(coco_paths):
+        for i in tqdm(stream.iter_array(path, 'images'), desc = f'Images {k}'):
+            im_maps[k][i['id']] = new_id
+            i['id'] = new_id
+            new_id += 1
+            if 'license' in i:
+                if i['license'] not in lic_maps[k]:
+                    lic_maps[k][i['license']] = len(licenses)
+                    licenses.append({'id': len(licenses), 'name': f'license {i["license"]} of {os.path.basename(path)}', 'url': ''})
+                i['license'] = lic_maps[k][i['license']]
+            if prefixes is not None:
+                i['file_name'] = prefixes[k] + i['file_name']
+            yield i
+
+def iter_annotations(coco_paths, im_maps, cat_maps, skipped, unknown_cats):
+    '''
+    PURPOSE: Stream every file's annotations with new sequential ids, their image
+    and category ids remapped. Annotations of unknown images are counted in
+    skipped, those of categories their file doesn't list in unknown_cats, and
+    both are left out
+    '''
+    ann_id = 0
+    for k, path in enumerate(coco_paths):
+        for a in tqdm(stream.iter_array(path, 'annotations'), desc = f'Annotations {k}'):
+            if a['image_id'] not in im_maps[k]:
+                skipped[k] += 1
+                continue
+            if a['category_id'] not in cat_maps[k]:
+                unknown_cats[k] += 1
+                continue
+            a['id'] = ann_id
+            a['image_id'] = im_maps[k][a['image_id']]
+            a['category_id'] = cat_maps[k][a['category_id']]
+            ann_id += 1
+            yield a
+
+### functions ###
+
+def merge(coco_paths, output_fp, prefixes = None):
+    '''
+
+    Parameters
+    ----------
+    coco_paths : list,
+        file paths to the coco ground truth files to merge, for example
+        several datasets' to_coco outputs or several chipped splits
+    output_fp : str,
+        where the merged file is written
+    prefixes : list, optional
+        one str per file, added to the front of its images' file names, e.g.
+        their folder relative to a shared image folder, when file names
+        collide across datasets. The default is None.
+
+    Combines the files, giving images and annotations new sequential ids,
+    unifying categories by name (the first file's ids are kept) and licenses
+    by name and url. Images and annotations are streamed from each input
+    straight to the output, so only the id mappings are held in memory.
+    Licenses are written after the images, so the placeholders for license
+    ids a file doesn't list can be added as they turn up. The output is only
+    put in place once it is complete
+    -------
+    Returns output_fp
+
+    '''
+    if prefixes is not None and len(prefixes) != len(coco_paths):
+        raise ValueError('Give one prefix per file')
+
+    # The small sections are read first, walking past images and annotations
+    headers = [stream.load_except(p, skip = ('images', 'annotations')) for p in coco_paths]
+    categories, cat_maps = category_maps(headers)
+    licenses, lic_maps = license_maps(headers)
+    info = {
+        'description': 'Merged from ' + ', '.join(os.path.basename(p) for p in coco_paths),
+        'sources': [h.get('info') for h in headers]
+    }
+
+    im_maps = [{} for _ in coco_paths]
+    skipped = [0 for _ in coco_paths]
+    unknown_cats = [0 for _ in coco_paths]
+    counts = stream.write_object(output_fp, {
+        'info': info,
+        'categories': categories,
+        'images': iter_images(coco_paths, im_maps, licenses, lic_maps, prefixes),
+        'licenses': licenses,
+        'annotations': iter_annotations(coco_paths, im_maps, cat_maps, skipped, unknown_cats)
+    })
+
+    for path, im_map, n_skipped, n_unknown in zip(coco_paths, im_maps, skipped, unknown_cats):
+        print(f'{path}: {len(im_map)} images')
+        if n_skipped:
+            print(f'  {n_skipped} annotations on missing images left out')
+        if n_unknown:
+            print(f'  {n_unknown} annotations of categories missing from its categories left out')
+    print(f'{counts["images"]} images, {counts["annotations"]} annotations, {len(categories)} categories:', output_fp)
+    return output_fp
@@ -1,5 +1,6 @@
 import os
 import random
+import hashlib
 import shutil
 import json
 from tqdm import tqdm
@@ -36,6 +37,33 @@ def anns_on_image(im_id, contents):
     
     return on_image
 
+def gt_subset(gt_content, im_names):
+    '''
+    PURPOSE: The part of a dataset on a list of images, found by file name
+    IN:
+        - gt_content: the content from a coco ground truth file
+        - im_names: list of str image file names
+    OUT:
+        - contents: coco contents with only those images and their annotations
+    '''
+    # Look images and annotations up once, instead of scanning per image
+    by_name = {i['file_name']: i for i in gt_content['images']}
+    anns_by_image = {}
+    for a in gt_content['annotations']:
+        anns_by_image.setdefault(a['image_id'], []).append(a)
+
+    contents = gt_content.copy()
+    contents['images'] = []
+    contents['annotations'] = []
+    for image in tqdm(im_names, desc = 'building annotations file'):
+        im_info = by_name.get(image)
+        if im_info is None:
+            print('Missing Image', image)
+            continue
+        contents['images'].append(im_info)
+        contents['annotations'].extend(anns_by_image.get(im_info['id'], []))
+    return contents
+
 ### functions ###
 
 def train_test(chip_folder, test_percentage, gt, chip_size):
@@ -158,25 +186,8 @@ def gt_from_im_list(full_gt, img_list, new_gt_path):
     with open(full_gt, 'r') as f:
         gt = json.load(f)
 
-    # Initialize key storage containers
-    contents = gt.copy()
-    contents['images'] = []
-    contents['annotations'] = []
-    images = []
-    annotations = []
-
-    # Process one image at a time
-    for image in tqdm(img_list):
-        i = get_im_id_from_name(image, gt)
-        anns = anns_on_image(i, gt) 
-        annotations.extend(anns)
-        for im_info in gt['images']:
-            if im_info['id'] == i:
-                images.append(im_info)
-
     # Load new data into appropriate format and save
-    contents['images'] = images
-    contents['annotations'] = annotations
+    contents = gt_subset(gt, img_list)
 
     if os.path.exists(new_gt_path):
         os.remove(new_gt_path)
@@ -191,27 +202,11 @@ def gt_from_im_folder(full_gt, img_folder, new_gt_path):
     with open(full_gt, 'r') as f:
         gt = json.load(f)
 
-    # Initialize key storage containers
-    contents = gt.copy()
-    contents['images'] = []
-    contents['annotations'] = []
-    images = []
-    annotations = []
-
-    # Process one image at a time
+    # Every image in the folder
     ims = os.listdir(img_folder)
 
-    for image in tqdm(ims, desc = 'building annotations file'):
-        i = int(image.split('_')[0])
-        anns = anns_on_image(i, gt) 
-        annotations.extend(anns)
-        for im_info in gt['images']:
-            if im_info['id'] == i:
-                images.append(im_info)
-
     # Load new data into appropriate format and save
-    contents['images'] = images
-    contents['annotations'] = annotations
+    contents = gt_subset(gt, ims)
 
     if os.path.exists(new_gt_path):
         os.remove(new_gt_path)
@@ -219,4 +214,35 @@ def gt_from_im_folder(full_gt, img_folder, new_gt_path):
     with open(new_gt_path, 'w') as f:
         json.dump(contents, f)
 
-    return
\ No newline at end of file
+    return
+
+def split_by_hash(gt_content, test_percentage = 0.2, val_percentage = 0.0, group_fn = None):
+    '''
+    PURPOSE: Split a dataset by a hash of each image's file name instead of a
+    random shuffle, so an image always lands in the same split no matter what
+    else is added, removed or changed
+    IN:
+        - gt_content: the content from a coco ground truth file
+        - test_percentage, val_percentage: float share of the images in each split
+        - group_fn: optional function of an image's info returning the name to hash,
+          e.g. the parent scene of a chip so that all of a scene's chips stay together
+    OUT:
+        - splits: dict of 'train', 'val' (if val_percentage) and 'test' to coco contents
+    '''
+    names = ['test', 'val', 'train'] if val_percentage else ['test', 'train']
+    cuts = [test_percentage, test_percentage + val_percentage, 1.0] if val_percentage else [test_percentage, 1.0]
+
+    im_split = {}
+    for i in gt_content['images']:
+        name = group_fn(i) if group_fn is not None else i['file_name']
+        # The first 8 bytes of the hash as a number in [0, 1)
+        u = int(hashlib.sha256(str(name).encode()).hexdigest()[:16], 16)/16**16
+        im_split[i['id']] = next(n for n, c in zip(names, cuts) if u < c)
+
+    splits = {}
+    for n in names:
+        contents = gt_content.copy()
+        contents['images'] = [i for i in gt_content['images'] if im_split[i['id']] == n]
+        contents['annotations'] = [a for a in gt_content['annotations'] if im_split.get(a['image_id']) == n]
+        splits[n] = contents
+    return splits
@@ -0,0 +1,251 @@
+import json
+import os
+from contextlib import contextmanager
+
+'''########################### Helper Functions ########################### '''
+
+DECODER = json.JSONDecoder()
+WHITESPACE = ' \t\n\r'
+
+def read_more(state):
+    '''
+    IN:
+        - state: dict holding the open file 'f', text buffer 'buf', position 'pos' and 'block' size
+    OUT:
+        - True if more text was read into the buffer, False at end of file
+    '''
+    # Drop the part of the buffer that has already been consumed
+    if state['pos'] > 0:
+        state['buf'] = state['buf'][state['pos']:]
+        state['pos'] = 0
+
+    text = state['f'].read(state['block'])
+    if not text:
+        return False
+    state['buf'] += text
+    return True
+
+def next_char(state):
+    '''
+    IN:
+        - state: stream state from read_more
+    OUT:
+        - the next non-whitespace character in the stream (not consumed), or '' at end of file
+    '''
+    while True:
+        buf = state['buf']
+        pos = state['pos']
+        while pos < len(buf) and buf[pos] in WHITESPACE:
+            pos += 1
+        state['pos'] = pos
+        if pos < len(buf):
+            return buf[pos]
+        if not read_more(state):
+            return ''
+
+def expect(state, chars):
+    '''
+    IN:
+        - state: stream state from read_more
+        - chars: str of the characters allowed next in the stream
+    OUT:
+        - the character that was found and consumed
+    '''
+    c = next_char(state)
+    if c == '' or c not in chars:
+        raise ValueError(f'Expected one of {chars!r} at offset {state["pos"]}, found {c!r}')
+    state['pos'] += 1
+    return c
+
+def decode_value(state):
+    '''
+    IN:
+        - state: stream state from read_more
+    OUT:
+        - the next complete json value in the stream, decoded
+    '''
+    next_char(state)
+    while True:
+        try:
+            value, end = DECODER.raw_decode(state['buf'], state['pos'])
+            # A number that ends exactly at the buffer edge may continue in the next block
+            if end < len(state['buf']):
+                state['pos'] = end
+                return value
+        except json.JSONDecodeError:
+            pass
+        if not read_more(state):
+            # Last chance: the value ends exactly at the end of the file
+            value, end = DECODER.raw_decode(state['buf'], state['pos'])
+            state['pos'] = end
+            return value
+        # Values larger than a block get progressively larger reads
+        state['block'] *= 2
+
+def iter_items(state):
+    '''
+    IN:
+        - state: stream state positioned at the opening '[' of a json array
+    OUT:
+        - generator over each element of the array, decoded one at a time
+    '''
+    expect(state, '[')
+    if next_char(state) == ']':
+        state['pos'] += 1
+        return
+    while True:
+        yield decode_value(state)
+        if expect(state, ',]') == ']':
+            return
+
+'''############################# Reading ############################# '''
+
+def iter_array(json_path, key = None, block = 1 << 20):
+    '''
+    PURPOSE: Read the elements of a json array one at a time, without ever loading the whole file
+    IN:
+        - json_path: path to a json file
+        - key: if None, the file is a top level array (e.g. a coco detections file), else the
+               name of a top level array in a json object (e.g. 'annotations' in a coco gt file)
+        - block: int number of characters read from disk at once
+    OUT:
+        - generator over the decoded elements of the array
+    '''
+    with open(json_path, 'r') as f:
+        state = {'f': f, 'buf': '', 'pos': 0, 'block': block}
+
+        if key is None:
+            yield from iter_items(state)
+            return
+
+        # Walk the top level object, skipping every other section in constant memory
+        expect(state, '{')
+        if next_char(state) == '}':
+            return
+        while True:
+            k = decode_value(state)
+            expect(state, ':')
+            if next_char(state) == '[':
+                if k == key:
+                    yield from iter_items(state)
+                    return
+                for _ in iter_items(state):
+                    pass
+            else:
+                decode_value(state)
+            if expect(state, ',}') == '}':
+                return
+
+def iter_chunks(json_path, key = None, chunk_size = 100000):
+    '''
+    PURPOSE: Read a json array in lists of at most chunk_size elements
+    IN:
+        - json_path: path to a json file
+        - key: see iter_array
+        - chunk_size: int maximum number of elements per chunk
+    OUT:
+        - generator over lists of decoded elements
+    '''
+    chunk = []
+    for item in iter_array(json_path, key):
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def load_except(json_path, skip = ('annotations',)):
+    '''
+    PURPOSE: Load every top level section of a coco file except the (large) ones listed in skip
+    IN:
+        - json_path: path to a coco json file
+        - skip: sections that are walked past without being loaded
+    OUT:
+        - dict of the remaining top level sections
+    '''
+    contents = {}
+    with open(json_path, 'r') as f:
+        state = {'f': f, 'buf': '', 'pos': 0, 'block': 1 << 20}
+        expect(state, '{')
+        if next_char(state) == '}':
+            return contents
+        while True:
+            k = decode_value(state)
+            expect(state, ':')
+            if k in skip and next_char(state) == '[':
+                for _ in iter_items(state):
+                    pass
+            else:
+                contents[k] = decode_value(state)
+            if expect(state, ',}') == '}':
+                return contents
+
+'''############################# Writing ############################# '''
+
+@contextmanager
+def open_atomic(json_path):
+    '''
+    PURPOSE: Open json_path + '.tmp' for writing, and only replace json_path with it once everything
+    was written, so an error partway through a stream never leaves a truncated file behind
+    '''
+    tmp_path = json_path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            yield f
+        os.replace(tmp_path, json_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def write_array(json_path, items):
+    '''
+    PURPOSE: Write a json array one element at a time, so it never has to be held in memory
+    IN:
+        - json_path: path of the json file to write
+        - items: iterable of json serializable elements
+    OUT:
+        - n: int number of elements written
+    '''
+    n = 0
+    with open_atomic(json_path) as f:
+        f.write('[')
+        for item in items:
+            if n:
+                f.write(',')
+            f.write(json.dumps(item, separators = (',', ':')))
+            n += 1
+        f.write(']')
+    return n
+
+def write_object(json_path, sections):
+    '''
+    PURPOSE: Write a json object (e.g. a coco file) whose large sections are written one element at a time
+    IN:
+        - json_path: path of the json file to write
+        - sections: dict of key to value, where lists, dicts and other json values are written as they are
+                    and any other iterable (e.g. a generator) is written as an array as it is consumed
+    OUT:
+        - counts: dict of the number of elements written for each streamed section
+    '''
+    counts = {}
+    with open_atomic(json_path) as f:
+        f.write('{')
+        for i, (key, value) in enumerate(sections.items()):
+            if i:
+                f.write(',')
+            f.write(json.dumps(key) + ':')
+            if isinstance(value, (list, dict, str, int, float, bool)) or value is None:
+                f.write(json.dumps(value, separators = (',', ':')))
+                continue
+            n = 0
+            f.write('[')
+            for item in value:
+                if n:
+                    f.write(',')
+                f.write(json.dumps(item, separators = (',', ':')))
+                n += 1
+            f.write(']')
+            counts[key] = n
+        f.write('}')
+    return counts
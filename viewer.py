@@ -0,0 +1,411 @@
+import json
+import os
+import sys
+import threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+
+cwd = os.getcwd() + '/hot_coco'
+if os.path.exists(cwd):
+    sys.path.append(cwd)
+
+import display as display
+
+TILE_SIZE = 256
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>hot_coco viewer</title>
+<style>
+body { margin: 0; font-family: sans-serif; background: #111; color: #eee; overflow: hidden; }
+#bar { position: absolute; top: 0; left: 0; right: 0; padding: 6px; background: rgba(40,40,40,0.9); z-index: 1; }
+canvas { display: block; }
+</style>
+</head>
+<body>
+<div id="bar">
+<select id="image"></select>
+<label><input id="gt" type="checkbox" checked> gt</label>
+<label><input id="dt" type="checkbox" checked> dt</label>
+score &ge; <input id="conf" type="number" value="0.5" min="0" max="1" step="0.05" style="width:60px">
+<label><input id="text" type="checkbox" checked> labels</label>
+<span id="info"></span>
+</div>
+<canvas id="view"></canvas>
+<script>
+const canvas = document.getElementById('view');
+const ctx = canvas.getContext('2d');
+const $ = (id) => document.getElementById(id);
+let meta = null, view = {x: 0, y: 0, scale: 1}, anns = {gt: [], dt: []};
+const tiles = new Map();
+
+function resize() { canvas.width = window.innerWidth; canvas.height = window.innerHeight; draw(); }
+window.addEventListener('resize', resize);
+
+function level() {
+  // coarsest level that still has at least one image pixel per screen pixel
+  let z = Math.floor(Math.log2(1 / view.scale));
+  return Math.max(0, Math.min(meta.levels, z));
+}
+
+function tile(z, tx, ty) {
+  const key = meta.id + '/' + z + '/' + tx + '_' + ty;
+  let img = tiles.get(key);
+  if (!img) {
+    img = new Image();
+    img.onload = draw;
+    img.src = 'tiles/' + key + '.jpg';
+    tiles.set(key, img);
+  }
+  return img;
+}
+
+function draw() {
+  ctx.fillStyle = '#111';
+  ctx.fillRect(0, 0, canvas.width, canvas.height);
+  if (!meta) { return; }
+  const z = level(), span = meta.tile_size * Math.pow(2, z);
+  const x0 = view.x, y0 = view.y;
+  const x1 = x0 + canvas.width / view.scale, y1 = y0 + canvas.height / view.scale;
+  for (let ty = Math.max(0, Math.floor(y0 / span)); ty * span < Math.min(y1, meta.height); ty++) {
+    for (let tx = Math.max(0, Math.floor(x0 / span)); tx * span < Math.min(x1, meta.width); tx++) {
+      const img = tile(z, tx, ty);
+      if (img.complete && img.naturalWidth) {
+        ctx.drawImage(img, (tx * span - x0) * view.scale, (ty * span - y0) * view.scale,
+                      img.naturalWidth * Math.pow(2, z) * view.scale, img.naturalHeight * Math.pow(2, z) * view.scale);
+      }
+    }
+  }
+  const layers = [];
+  if ($('dt').checked) { layers.push(['dt', anns.dt]); }
+  if ($('gt').checked) { layers.push([$('dt').checked ? 'gt_under_dt' : 'gt', anns.gt]); }
+  let total = layers.reduce((n, l) => n + l[1].length, 0);
+  for (const [style, boxes] of layers) {
+    const s = meta.styles[style];
+    ctx.setLineDash(s.ls === '--' ? [6, 4] : []);
+    ctx.textAlign = s.ha;
+    for (const b of boxes) {
+      ctx.strokeStyle = meta.palette[b[4]] || '#fff';
+      const px = (b[0] - x0) * view.scale, py = (b[1] - y0) * view.scale;
+      ctx.strokeRect(px, py, b[2] * view.scale, b[3] * view.scale);
+      if ($('text').checked && total <= meta.max_labels) {
+        ctx.fillStyle = s.text_color === 'b' ? '#00f' : '#fff';
+        ctx.fillText(meta.names[b[4]] || 'None', px, py);
+      }
+    }
+  }
+  $('info').textContent = 'level ' + z + ' | ' + anns.gt.length + ' gt, ' + anns.dt.length + ' dt in view';
+}
+
+let pending = null;
+function fetchAnns() {
+  // wait for panning and zooming to settle before asking for the boxes in view
+  clearTimeout(pending);
+  pending = setTimeout(async () => {
+    if (!meta) { return; }
+    const q = new URLSearchParams({x0: view.x, y0: view.y, x1: view.x + canvas.width / view.scale,
+                                   y1: view.y + canvas.height / view.scale, conf: $('conf').value});
+    const r = await fetch('api/anns/' + meta.id + '?' + q);
+    anns = await r.json();
+    draw();
+  }, 120);
+}
+
+async function open_image(id) {
+  const r = await fetch('api/meta/' + id);
+  meta = await r.json();
+  view.scale = Math.min(canvas.width / meta.width, canvas.height / meta.height);
+  view.x = 0; view.y = 0;
+  anns = {gt: [], dt: []};
+  draw(); fetchAnns();
+}
+
+let drag = null;
+canvas.addEventListener('mousedown', (e) => { drag = [e.clientX, e.clientY]; });
+window.addEventListener('mouseup', () => { drag = null; });
+window.addEventListener('mousemove', (e) => {
+  if (!drag) { return; }
+  view.x -= (e.clientX - drag[0]) / view.scale; view.y -= (e.clientY - drag[1]) / view.scale;
+  drag = [e.clientX, e.clientY]; draw(); fetchAnns();
+});
+canvas.addEventListener('wheel', (e) => {
+  e.preventDefault();
+  const f = Math.exp(-e.deltaY * 0.001);
+  const mx = view.x + e.clientX / view.scale, my = view.y + e.clientY / view.scale;
+  view.scale *= f; view.x = mx - e.clientX / view.scale; view.y = my - e.clientY / view.scale;
+  draw(); fetchAnns();
+}, {passive: false});
+for (const id of ['gt', 'dt', 'text']) { $(id).addEventListener('change', draw); }
+$('conf').addEventListener('input', fetchAnns);
+$('image').addEventListener('change', () => open_image($('image').value));
+
+(async () => {
+  resize();
+  const r = await fetch('api/images');
+  for (const im of await r.json()) { $('image').add(new Option(im.file_name, im.id)); }
+  if ($('image').value) { open_image($('image').value); }
+})();
+</script>
+</body>
+</html>
+'''
+
+'''############################ Spatial Index ############################ '''
+
+def grid_index(bboxes, cell):
+    '''
+    PURPOSE: Bucket boxes into a uniform grid so the boxes in any window can be found without a scan
+    IN:
+        - bboxes: array of shape (n, 4) of coco [x, y, w, h] boxes
+        - cell: int, grid cell size in pixels
+    OUT:
+        - index: dict with the cell size, the grid width, and the box rows sorted by cell key
+    '''
+    bboxes = np.asarray(bboxes, dtype = float).reshape(-1, 4)
+    cx0 = np.floor(np.maximum(bboxes[:, 0], 0)/cell).astype(np.int64)
+    cy0 = np.floor(np.maximum(bboxes[:, 1], 0)/cell).astype(np.int64)
+    cx1 = np.maximum(np.floor((bboxes[:, 0] + bboxes[:, 2])/cell).astype(np.int64), cx0)
+    cy1 = np.maximum(np.floor((bboxes[:, 1] + bboxes[:, 3])/cell).astype(np.int64), cy0)
+    n_cols = int(cx1.max()) + 1 if len(bboxes) else 1
+
+    # Expand every box into each of the cells it covers
+    wx = cx1 - cx0 + 1
+    n_cells = wx*(cy1 - cy0 + 1)
+    rows = np.repeat(np.arange(len(bboxes)), n_cells)
+    k = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    keys = (cy0[rows] + k // wx[rows])*n_cols + cx0[rows] + k % wx[rows]
+
+    order = np.argsort(keys, kind = 'stable')
+    index = {'cell': cell, 'n_cols': n_cols, 'keys': keys[order], 'rows': rows[order], 'bboxes': bboxes}
+    return index
+
+def grid_query(index, rect):
+    '''
+    IN:
+        - index: output of grid_index
+        - rect: [x0, y0, x1, y1] window in pixels
+    OUT:
+        - sorted array of the rows of every box overlapping the window
+    '''
+    cell = index['cell']
+    x0, y0, x1, y1 = rect
+    cx0 = max(int(np.floor(x0/cell)), 0)
+    cy0 = max(int(np.floor(y0/cell)), 0)
+    cx1 = min(int(np.floor(x1/cell)), index['n_cols'] - 1)
+    cy1 = int(np.floor(y1/cell))
+    if cx1 < cx0 or cy1 < cy0 or len(index['keys']) == 0:
+        return np.zeros(0, dtype = np.int64)
+
+    # Each grid row of the window is one contiguous run of keys
+    cy = np.arange(cy0, cy1 + 1)
+    starts = np.searchsorted(index['keys'], cy*index['n_cols'] + cx0, side = 'left')
+    ends = np.searchsorted(index['keys'], cy*index['n_cols'] + cx1, side = 'right')
+    rows = np.unique(np.concatenate([index['rows'][s:e] for s, e in zip(starts, ends)]))
+
+    b = index['bboxes'][rows]
+    hit = (b[:, 0] <= x1) & (b[:, 0] + b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 1] + b[:, 3] >= y0)
+    return rows[hit]
+
+'''################################ Tiles ################################ '''
+
+def cut_tiles(im_path, tile_folder, tile_size = TILE_SIZE):
+    '''
+    PURPOSE: Cut every level of an image's pyramid (see display.build_pyramid) into tiles, once.
+    Tiles are saved as {tile_folder}/{z}/{x}_{y}.jpg, where level z is downsampled by 2**z
+    IN:
+        - im_path: path to a full resolution image
+        - tile_folder: folder for this image's tiles
+        - tile_size: int, tile width and height in pixels
+    OUT:
+        - n_levels: int, the number of levels above full resolution
+    '''
+    done_path = os.path.join(tile_folder, 'done.json')
+    if os.path.exists(done_path) and os.path.getmtime(done_path) >= os.path.getmtime(im_path):
+        with open(done_path, 'r') as f:
+            done = json.load(f)
+        if done['tile_size'] == tile_size:
+            return done['levels']
+
+    levels = [im_path] + display.build_pyramid(im_path, min_size = tile_size)
+    for z, level_path in enumerate(levels):
+        z_folder = os.path.join(tile_folder, str(z))
+        os.makedirs(z_folder, exist_ok = True)
+        with Image.open(level_path) as img:
+            img = img.convert('RGB')
+            w, h = img.size
+            for ty in range(0, h, tile_size):
+                for tx in range(0, w, tile_size):
+                    t = img.crop((tx, ty, min(tx + tile_size, w), min(ty + tile_size, h)))
+                    t.save(os.path.join(z_folder, f'{tx // tile_size}_{ty // tile_size}.jpg'), quality = 90)
+
+    with open(done_path, 'w') as f:
+        json.dump({'tile_size': tile_size, 'levels': len(levels) - 1}, f)
+    return len(levels) - 1
+
+'''################################ Server ################################ '''
+
+def hex_palette(gt):
+    '''
+    IN: loaded coco gt contents
+    OUT: dict of category id to the hex color display.make_palette gives it
+    '''
+    pal = display.make_palette(gt)
+    colors = display.palette_colors([c['id'] for c in gt['categories']], pal)
+    return {c['id']: '#%02x%02x%02x' % tuple(int(255*v) for v in color) for c, color in zip(gt['categories'], colors)}
+
+def make_handler(state):
+    '''
+    Build the request handler class for one dataset, see serve for what state holds
+    '''
+    class Handler(BaseHTTPRequestHandler):
+
+        def send(self, body, content_type, code = 200):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, data):
+            self.send(json.dumps(data).encode(), 'application/json')
+
+        def log_message(self, *args):
+            return
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [p for p in url.path.split('/') if p]
+            try:
+                if not parts:
+                    self.send(PAGE.encode(), 'text/html; charset=utf-8')
+                elif parts == ['api', 'images']:
+                    self.send_json([{'id': i['id'], 'file_name': i['file_name']} for i in state['gt']['images']])
+                elif parts[:2] == ['api', 'meta']:
+                    self.send_json(image_meta(state, parts[2]))
+                elif parts[:2] == ['api', 'anns']:
+                    q = {k: float(v[0]) for k, v in parse_qs(url.query).items()}
+                    self.send_json(anns_in_view(state, parts[2], [q['x0'], q['y0'], q['x1'], q['y1']], q.get('conf', 0)))
+                elif parts[0] == 'tiles' and len(parts) == 4:
+                    im = state['images'][parts[1]]
+                    tile = tile_name(parts[2], parts[3])
+                    if tile is None:
+                        self.send(b'bad tile', 'text/plain', 400)
+                        return
+                    with open(os.path.join(state['tile_folder'], str(im['id']), *tile), 'rb') as f:
+                        self.send(f.read(), 'image/jpeg')
+                else:
+                    self.send(b'not found', 'text/plain', 404)
+            except (KeyError, FileNotFoundError, ValueError):
+                self.send(b'not found', 'text/plain', 404)
+
+    return Handler
+
+def tile_name(z, name):
+    '''
+    IN: the level and file name parts of a tile url
+    OUT: (z, '{x}_{y}.jpg') as cut_tiles names it, or None if they are not whole numbers
+    '''
+    x, _, y = name[:-len('.jpg')].partition('_') if name.endswith('.jpg') else ('', '', '')
+    if not all(v.isdigit() and v.isascii() for v in (z, x, y)):
+        return None
+    return str(int(z)), f'{int(x)}_{int(y)}.jpg'
+
+def image_meta(state, im_key):
+    '''
+    Cut the image's tiles and index its boxes the first time it is opened, then describe it to the viewer.
+    Each image has its own lock, so cutting one image's tiles doesn't hold up the others
+    '''
+    im = state['images'][im_key]
+    with state['lock']:
+        im_lock = state['locks'].setdefault(im_key, threading.Lock())
+    with im_lock:
+        if im_key not in state['cache']:
+            n_levels = cut_tiles(state['image_folder'] + im['file_name'],
+                                 os.path.join(state['tile_folder'], str(im['id'])), state['tile_size'])
+            bboxes, cat_ids = display.ann_arrays(state['gt_by_im'].get(im['id'], []))
+            state['cache'][im_key] = {
+                'levels': n_levels,
+                'gt': (grid_index(bboxes, state['tile_size']), cat_ids)
+            }
+    meta = {
+        'id': im['id'],
+        'width': im['width'],
+        'height': im['height'],
+        'levels': state['cache'][im_key]['levels'],
+        'tile_size': state['tile_size'],
+        'palette': state['palette'],
+        'names': state['names'],
+        'styles': display.STYLES,
+        'max_labels': state['max_labels']
+    }
+    return meta
+
+def anns_in_view(state, im_key, rect, conf_thresh):
+    '''
+    OUT: dict of 'gt' and 'dt' lists of [x, y, w, h, category_id] boxes overlapping rect
+    '''
+    im = state['images'][im_key]
+    index, cat_ids = state['cache'][im_key]['gt']
+    rows = grid_query(index, rect)
+    out = {'gt': np.column_stack([index['bboxes'][rows], cat_ids[rows]]).tolist(), 'dt': []}
+
+    if state['dt_index'] is not None:
+        # detections are few per image once thresholded, so an exact overlap test is enough
+        b, c, s = display.dt_on_image(im['id'], state['dt_index'], conf_thresh)
+        x0, y0, x1, y1 = rect
+        hit = (b[:, 0] <= x1) & (b[:, 0] + b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 1] + b[:, 3] >= y0)
+        out['dt'] = np.column_stack([b[hit], c[hit]]).tolist()
+    return out
+
+def serve(gt_path, image_folder, dt_path = None, tile_folder = None, port = 8000, tile_size = TILE_SIZE,
+          max_labels = display.MAX_LABELS):
+    '''
+    PURPOSE: Browse giant scenes and their annotations in a web browser. A local server hands out
+    pre-cut pyramid tiles and only the boxes inside the current view, found through a grid index,
+    so panning and zooming stay interactive with thousands of boxes
+    IN:
+        - gt_path: coco gt file
+        - image_folder: folder where images in gt_path are located
+        - dt_path: optional coco dt file or index from display.index_dt
+        - tile_folder: where tiles are cached, by default a '_tiles' folder beside the image folder
+        - port: int, open http://localhost:port in a browser
+        - tile_size: int, tile width and height in pixels
+        - max_labels: labels are hidden when more boxes than this are in view
+    OUT: None, serves until interrupted
+    '''
+    with open(gt_path, 'r') as f:
+        gt = json.load(f)
+    if dt_path is not None and not isinstance(dt_path, dict):
+        dt_path = display.index_dt(dt_path)
+    if tile_folder is None:
+        tile_folder = os.path.abspath(image_folder) + '_tiles/'
+
+    state = {
+        'gt': gt,
+        'images': {str(i['id']): i for i in gt['images']},
+        'gt_by_im': display.index_anns(gt['annotations']),
+        'dt_index': dt_path,
+        'image_folder': image_folder,
+        'tile_folder': tile_folder,
+        'tile_size': tile_size,
+        'palette': hex_palette(gt),
+        'names': display.get_category_names(gt),
+        'max_labels': max_labels,
+        'cache': {},
+        'lock': threading.Lock(),
+        'locks': {}
+    }
+
+    server = ThreadingHTTPServer(('localhost', port), make_handler(state))
+    print(f'Viewer running at http://localhost:{port} (Ctrl+C to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return